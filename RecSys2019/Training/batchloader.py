@@ -2,6 +2,8 @@ import torch
 from torch import _utils
 from fastai.torch_core import to_device
 
+SHUFFLE_MODES = ('reorder', 'random', 'block')
+
 class BatchDataset(object):
     """An abstract class representing a Batch Dataset.
     All other datasets should subclass this. All subclasses should override
@@ -32,14 +34,28 @@ class TensorBatchDataset(BatchDataset):
         batch_size: The size of the batch to return
         pin_memory (bool, optional): If ``True``, the dataset will be pinned memory for faster copy to GPU.
         I saw no performance improvement to doing so but results may vary.
+        shuffle_mode (str, optional): how ``shuffle`` randomizes the data (default: ``'reorder'``).
+            ``'reorder'``: gather every tensor into a new random order, each batch is then a contiguous slice.
+            This briefly holds two copies of the data.
+            ``'random'``: keep the tensors in place and store a random permutation of the rows, each batch
+            is gathered through it.
+            ``'block'``: like ``'random'`` but the permutation shuffles blocks of ``block_size`` contiguous
+            rows, then the rows inside each block, so batches read from a few contiguous regions.
+        block_size (int, optional): number of contiguous rows per block for ``shuffle_mode='block'``
+            (default: ``batch_size``)
     """
 
-    def __init__(self, tensors, batch_size=1, pin_memory=False):
+    def __init__(self, tensors, batch_size=1, pin_memory=False, shuffle_mode='reorder', block_size=None):
         assert all(tensors[0].size(0) == tensor.size(0) for tensor in tensors)
+        assert shuffle_mode in SHUFFLE_MODES, 'shuffle_mode should be one of {}'.format(SHUFFLE_MODES)
         
         
         self.tensors = tensors
         self.batch_size = batch_size
+        self.shuffle_mode = shuffle_mode
+        self.block_size = block_size if block_size is not None else batch_size
+        # row order of the current epoch when shuffling through a permutation, None means storage order
+        self.permutation = None
 
         self.num_samples = tensors[0].size(0)
 
@@ -58,13 +74,19 @@ class TensorBatchDataset(BatchDataset):
         # Need to handle odd sized batches if data isn't divisible by batchsize
         if idx < self.num_samples and (
                 idx + self.batch_size < self.num_samples or self.num_samples % self.batch_size == 0):
-            return [tensor[idx:idx + self.batch_size] for tensor in self.tensors]
+            return self._get_rows(idx, idx + self.batch_size)
 
         elif idx < self.num_samples and idx + self.batch_size > self.num_samples:
-            return [tensor[idx:] for tensor in self.tensors]
+            return self._get_rows(idx, self.num_samples)
         else:
             raise IndexError
 
+    def _get_rows(self, start, end):
+        if self.permutation is None:
+            return [tensor[start:end] for tensor in self.tensors]
+        rows = self.permutation[start:end]
+        return [tensor[rows] for tensor in self.tensors]
+
     def __add__(self, tensors):
         assert all(tensors[0].size(0) == tensor.size(0) for tensor in tensors)
         assert len(self.tensors) == len(tensors)
@@ -73,10 +95,29 @@ class TensorBatchDataset(BatchDataset):
         num_add_samples = tensors[0].size(0)
         self.num_samples = self.num_samples + num_add_samples
         self.tensors = [torch.cat((self_tensor, tensor)) for self_tensor, tensor in zip(self.tensors, tensors)]
+        self.permutation = None
 
     def shuffle(self):
-        idx = torch.randperm(self.num_samples, dtype=torch.int64)
-        self.tensors = [tensor[idx] for tensor in self.tensors]
+        if self.shuffle_mode == 'reorder':
+            idx = torch.randperm(self.num_samples, dtype=torch.int64)
+            self.tensors = [tensor[idx] for tensor in self.tensors]
+        else:
+            block_size = self.block_size if self.shuffle_mode == 'block' else 1
+            self.permutation = block_permutation(self.num_samples, block_size, device=self.tensors[0].device)
+
+
+def block_permutation(num_samples, block_size, device=None):
+    """Returns a permutation of ``range(num_samples)`` that visits blocks of ``block_size``
+    contiguous rows in random order and the rows inside each block in random order.
+    ``block_size=1`` gives a uniformly random permutation."""
+    if block_size <= 1:
+        return torch.randperm(num_samples, dtype=torch.int64, device=device)
+    num_blocks = (num_samples + block_size - 1) // block_size
+    block_start = torch.randperm(num_blocks, dtype=torch.int64, device=device) * block_size
+    offset = torch.rand(num_blocks, block_size, device=device).argsort(dim=1)
+    idx = (block_start.unsqueeze(1) + offset).view(-1)
+    # the last block may be partial: drop the positions past the end of the data
+    return idx[idx < num_samples]
         
         
 
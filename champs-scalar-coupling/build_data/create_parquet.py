@@ -15,6 +15,12 @@
 #     'coupling_0', ...., 'coupling_COUPLING_MAX*9'
 #     'gaussrank_0', ....., 'gaussrank_COUPLING_MAX'
 #
+# The ragged (CSR) alternative stores the molecules without padding in a directory of 
+# parquet files : 
+#     molecules.parquet : 'molecule_name', 'num_node', 'num_edge', 'num_coupling', 
+#                         'node_offset', 'edge_offset', 'coupling_offset'
+#     nodes.parquet, edges.parquet, couplings.parquet : the rows of all the molecules, 
+#                         concatenated in the order of molecules.parquet 
 #
 #
 #####################################################################################
@@ -59,6 +65,14 @@ def get_one_vector_from_graph(molecule_file):
     infor = [molecule_name, num_node, num_edge, num_coupling, node_dim, edge_dim, coupling_dim]
     return  infor, node_feats.reshape(num_node*node_dim), edge_feats.reshape(num_edge*edge_dim), coupling.reshape(num_coupling*coupling_dim)
 
+def pad_frame(frame, width): 
+    '''
+    Zero pad the columns of frame up to width columns 
+    '''
+    assert frame.shape[1] <= width, 'frame has %s columns, more than %s' %(frame.shape[1], width)
+    d = dict.fromkeys([str(i) for i in range(frame.shape[1], width)], 0.0)
+    return frame.assign(**d).fillna(0.0)
+
 def build_general_frame(graph_dir, parquet_dir='/rapids/notebooks/srabhi/champs-2019/input/parquet/'):
     ''' 
         Args: 
@@ -88,20 +102,11 @@ def build_general_frame(graph_dir, parquet_dir='/rapids/notebooks/srabhi/champs-
                                                         pd.DataFrame(nodes), pd.DataFrame(edges), pd.DataFrame(coupling))
 
     ### Get a multiple 8 for gpu ops 
-    # pad  29 nodes to node_max 32 : 
-    pad_cols = 21
-    d = dict.fromkeys([str(i) for i in range(node_frame.shape[1], node_frame.shape[1]+pad_cols)], 0.0)
-    node_frame = node_frame.assign(**d).fillna(0.0)
-
-    # pad edge_max 812 to 816
-    pad_cols = 20
-    d = dict.fromkeys([str(i) for i in range(edge_frame.shape[1], edge_frame.shape[1]+pad_cols)], 0.0)
-    edge_frame = edge_frame.assign(**d).fillna(0.0)
-
-    # pad coupling_max to 136
-    pad_cols = 9
-    d = dict.fromkeys([str(i) for i in range(coupling_frame.shape[1], coupling_frame.shape[1]+pad_cols)], 0.0)
-    coupling_frame = coupling_frame.assign(**d).fillna(0.0)
+    # pad nodes to node_max 32, edges to edge_max 816 (812 for fully connected graphs, fewer with a 
+    # distance cutoff / kNN graph) and couplings to coupling_max 136 
+    node_frame = pad_frame(node_frame, NODE_MAX*7)
+    edge_frame = pad_frame(edge_frame, EDGE_MAX*5)
+    coupling_frame = pad_frame(coupling_frame, COUPLING_MAX*9)
 
     # concat the whole frame 
     general_frame = pd.concat([info_frame, node_frame, edge_frame, coupling_frame], axis=1)
@@ -153,26 +158,14 @@ def build_cv_ranks_parquet(data, fold, DATA_DIR = '/rapids/notebooks/srabhi/cham
     print('Getting gaussrank transformation for train/validation data took %s seconds' %(time()-t0))
     print(grm.coupling_order)
     # Get the rank coupling values at the molecule level and pad coupling rank values to 136 : 
-    validation_gaussrank = validation.groupby('molecule_name').apply(lambda x : x['transformed_coupling'].values)
-    train_gaussrank = train.groupby('molecule_name').apply(lambda x : x['transformed_coupling'].values)
-    
-    val_ranks = pd.DataFrame(validation_gaussrank.tolist()).fillna(0.0)
-    num_cols = val_ranks.shape[1]
-    pad_cols = 136 - num_cols
-    d = dict.fromkeys([str(i) for i in range(num_cols, num_cols+pad_cols)], 0.0)
-    val_ranks = val_ranks.assign(**d)
-    val_ranks = val_ranks.astype(float)
-    val_ranks.columns = ['gaussrank_%s'%i for i in range(136)]
-    val_ranks['molecule_name'] = validation_gaussrank.index
-
-    train_ranks = pd.DataFrame(train_gaussrank.tolist()).fillna(0.0)
-    num_cols = train_ranks.shape[1]
-    pad_cols = 136 - num_cols
-    d = dict.fromkeys([str(i) for i in range(num_cols, num_cols+pad_cols)], 0.0)
-    train_ranks = train_ranks.assign(**d)
-    train_ranks = train_ranks.astype(float)
-    train_ranks.columns = ['gaussrank_%s'%i for i in range(136)]
-    train_ranks['molecule_name'] = train_gaussrank.index
+    rank_cols = ['gaussrank_%s'%i for i in range(COUPLING_MAX)]
+    molecule_names, ranks = pad_by_molecule(validation, ['transformed_coupling'], COUPLING_MAX)
+    val_ranks = pd.DataFrame(ranks.reshape(len(molecule_names), COUPLING_MAX), columns=rank_cols)
+    val_ranks['molecule_name'] = molecule_names
+
+    molecule_names, ranks = pad_by_molecule(train, ['transformed_coupling'], COUPLING_MAX)
+    train_ranks = pd.DataFrame(ranks.reshape(len(molecule_names), COUPLING_MAX), columns=rank_cols)
+    train_ranks['molecule_name'] = molecule_names
 
     # Merge with node /edge/coupling frame 
     id_valid = gd.DataFrame()
@@ -203,6 +196,123 @@ def build_cv_ranks_parquet(data, fold, DATA_DIR = '/rapids/notebooks/srabhi/cham
     validation_frame.to_parquet(parquet_dir+'/validation.parquet')                
                            
     # save mapping 
-    for i, (type_, frame) in enumerate(zip(grm.coupling_order, grm.training_maps)): 
-        frame.to_csv(parquet_dir+'/mapping_type_%s_order_%s.csv'%(type_, i), index=False)
-    pass 
+    grm.save(parquet_dir+'/gaussrank_map.npz')
+    pass
+
+
+#####################################################################################
+#
+#                     Ragged (CSR) molecule frames : no padding 
+#
+#####################################################################################
+
+RAGGED_COUNTS = ['num_node', 'num_edge', 'num_coupling']
+RAGGED_OFFSETS = ['node_offset', 'edge_offset', 'coupling_offset']
+RAGGED_EDGE_COLS = ['atom_index_0', 'atom_index_1', 'edge_type', 'distance', 'angle']
+RAGGED_COUPLING_COLS = ['atom_index_0', 'atom_index_1', 'coupling_type', 'scalar_coupling', 'fc', 'sd', 'pso', 'dso', 'id']
+
+
+def write_ragged_frames(ragged_dir, molecules, nodes, edges, couplings): 
+    '''
+    Save the molecule table, with the offsets of each molecule, and the concatenated node / edge / coupling rows 
+    '''
+    if not os.path.exists(ragged_dir):
+        os.makedirs(ragged_dir)
+    molecules = molecules[['molecule_name'] + RAGGED_COUNTS].reset_index(drop=True)
+    for count, offset in zip(RAGGED_COUNTS, RAGGED_OFFSETS): 
+        molecules[offset] = molecules[count].cumsum() - molecules[count]
+    molecules.to_parquet(os.path.join(ragged_dir, 'molecules.parquet'))
+    for name, frame in zip(['nodes', 'edges', 'couplings'], [nodes, edges, couplings]):
+        frame.reset_index(drop=True).to_parquet(os.path.join(ragged_dir, '%s.parquet' %name))
+
+
+def read_ragged_frames(ragged_dir): 
+    return [pd.read_parquet(os.path.join(ragged_dir, '%s.parquet' %name)) 
+            for name in ['molecules', 'nodes', 'edges', 'couplings']]
+
+
+def select_ragged(molecules, nodes, edges, couplings, mask): 
+    '''
+    Keep the molecules of the boolean `mask` and their rows, in storage order 
+    '''
+    mask = np.asarray(mask)
+    rows = [frame[np.repeat(mask, molecules[count].values)] for frame, count in zip([nodes, edges, couplings], RAGGED_COUNTS)]
+    return [molecules[mask]] + rows
+
+
+def build_ragged_frame(graph_dir, ragged_dir='/rapids/notebooks/srabhi/champs-2019/input/ragged/'):
+    ''' 
+        Ragged alternative to build_general_frame : the molecules are not padded to NODE_MAX / EDGE_MAX / COUPLING_MAX
+        Args: 
+            - graph_dir to use for getting molecule information (see build_general_frame)
+            - ragged_dir: output directory of the molecules / nodes / edges / couplings parquet files 
+    '''
+    files = glob.glob(graph_dir+'/*.pickle')
+    tabular_data = parallel_process(files, get_one_vector_from_graph)
+
+    molecules = pd.DataFrame([i[0] for i in tabular_data], columns=['molecule_name', 'num_node', 'num_edge', 'num_coupling', 
+                                                                   'node_dim', 'edge_dim', 'coupling_dim'])
+    node_dim, edge_dim, coupling_dim = molecules[['node_dim', 'edge_dim', 'coupling_dim']].values[0]
+    nodes = pd.DataFrame(np.concatenate([i[1] for i in tabular_data]).reshape(-1, node_dim).astype(np.float32), 
+                         columns=['node_%s'%i for i in range(node_dim)])
+    edges = pd.DataFrame(np.concatenate([i[2] for i in tabular_data]).reshape(-1, edge_dim).astype(np.float32), 
+                         columns=RAGGED_EDGE_COLS)
+    couplings = pd.DataFrame(np.concatenate([i[3] for i in tabular_data]).reshape(-1, coupling_dim).astype(np.float32), 
+                             columns=RAGGED_COUPLING_COLS)
+    
+    print('Ragged frames created for %s molecules, %s nodes, %s edges, %s couplings' %(molecules.shape[0], 
+                                                            nodes.shape[0], edges.shape[0], couplings.shape[0]))
+    write_ragged_frames(ragged_dir, molecules, nodes, edges, couplings)
+
+
+def build_cv_ranks_ragged(fold, ragged_dir='/rapids/notebooks/srabhi/champs-2019/input/ragged/', 
+                          DATA_DIR = '/rapids/notebooks/srabhi/champs-2019/input'):
+    '''
+    Ragged alternative to build_cv_ranks_parquet : adds the gaussrank of each coupling as 
+    column 'gaussrank_coupling' (after 'scalar_coupling', the layout of the collate functions) and saves the 
+    train / validation molecules of the fold to ragged_dir/fold_%s/train and ragged_dir/fold_%s/validation 
+    '''
+    ### Get data 
+    id_train_ = np.load(DATA_DIR + '/split/train_split_by_mol_hash.%s.npy'%fold, allow_pickle=True)
+    id_valid_ = np.load(DATA_DIR + '/split/valid_split_by_mol_hash.%s.npy'%fold, allow_pickle=True)
+    df = pd.read_csv(DATA_DIR + '/csv/train.csv')
+    train = df[df.molecule_name.isin(id_train_)]
+    validation = df[df.molecule_name.isin(id_valid_)]
+
+    # Get GaussRank of coupling values 
+    t0 = time()
+    grm = GaussRankMap()
+    transformed_training = grm.fit_training(train, reset=True)
+    transformed_validation = grm.convert_df(validation, from_coupling=True)
+    print('Getting gaussrank transformation for train/validation data took %s seconds' %(time()-t0))
+    # fit_training and convert_df return the ranks in the row order of their frame 
+    ranks = pd.concat([pd.Series(transformed_training.values, index=train['id'].values), 
+                       pd.Series(transformed_validation['sct'].values, index=validation['id'].values)])
+
+    molecules, nodes, edges, couplings = read_ragged_frames(ragged_dir)
+    coupling_ranks = ranks.reindex(couplings['id'].values.astype(np.int64))
+    couplings.insert(4, 'gaussrank_coupling', coupling_ranks.fillna(0.0).values.astype(np.float32))
+    
+    fold_dir = os.path.join(ragged_dir, 'fold_%s' %fold)
+    for name, ids in [('train', id_train_), ('validation', id_valid_)]: 
+        mask = molecules.molecule_name.isin(ids).values
+        # every coupling of the fold molecules is in train.csv : a missing rank is a broken id mapping 
+        assert not coupling_ranks[np.repeat(mask, molecules['num_coupling'].values)].isna().any(), \
+            'couplings of the %s molecules of fold %s have no gaussrank value' %(name, fold)
+        frames = select_ragged(molecules, nodes, edges, couplings, mask)
+        write_ragged_frames(os.path.join(fold_dir, name), *frames)
+                           
+    # save mapping 
+    grm.save(fold_dir+'/gaussrank_map.npz')
+
+
+def build_test_ragged(ragged_dir='/rapids/notebooks/srabhi/champs-2019/input/ragged/', 
+                      DATA_DIR = '/rapids/notebooks/srabhi/champs-2019/input'):
+    '''
+    Ragged alternative to build_test_data : test molecules with a zero gaussrank column, saved to ragged_dir/test
+    '''
+    df = pd.read_csv(DATA_DIR + '/csv/test.csv')
+    molecules, nodes, edges, couplings = read_ragged_frames(ragged_dir)
+    couplings.insert(4, 'gaussrank_coupling', np.float32(0.0))
+    frames = select_ragged(molecules, nodes, edges, couplings, molecules.molecule_name.isin(df.molecule_name.unique()).values)
+    write_ragged_frames(os.path.join(ragged_dir, 'test'), *frames)
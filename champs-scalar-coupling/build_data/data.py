@@ -131,8 +131,57 @@ edge_feature :
 #                                                                                                           #
 #############################################################################################################
 
+def make_edge_features(mol, xyz, categorical_encoding='one_hot', cutoff=None, knn=None): 
+    """
+    Edge features of the molecule graph, in the order of the atom pairs (i, j), i != j, sorted by i then j 
+    
+    Args: 
+        - mol : rdkit molecule 
+        - xyz (array): [num_atom, 3] atoms coordinates 
+        - categorical_encoding (str): encoding of the bond type : label vs one-hot 
+        - cutoff (float), knn (int): None for the fully connected graph. Otherwise keep the bonded pairs, the pairs 
+          closer than cutoff and the pairs where one atom is among the knn nearest atoms of the other 
+    Returns: 
+        edge_index [num_edge, 2], bond_type [num_edge, 1 or len(BOND_TYPE)], distance [num_edge, 1], angle [num_edge, 1]
+    """
+    num_atom = len(xyz)
+    # bond type label of each pair of atoms, 0 when they are not bonded 
+    bond_label = np.zeros((num_atom, num_atom), np.uint8)
+    for bond in mol.GetBonds(): 
+        i, j = bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()
+        bond_label[i, j] = bond_label[j, i] = label_encoding(bond.GetBondType(), BOND_TYPE)
+    
+    # all pairs distances and cosine angles in one broadcast, the diagonal (i == j) is dropped by the mask 
+    off_diagonal = ~np.eye(num_atom, dtype=bool)
+    distance = ((xyz[:, None, :] - xyz[None, :, :])**2).sum(-1)**0.5
+    norm_xyz = preprocessing.normalize(xyz, norm='l2')
+    angle = (norm_xyz[:, None, :]*norm_xyz[None, :, :]).sum(-1)
+    
+    edge_mask = off_diagonal
+    if cutoff is not None or knn is not None: 
+        neighbour = bond_label > 0
+        if cutoff is not None: 
+            neighbour |= distance <= cutoff
+        if knn is not None: 
+            # rank of j among the atoms sorted by distance to i, the atom itself (rank 0) excluded 
+            rank = np.empty((num_atom, num_atom), np.int64)
+            rank[np.arange(num_atom)[:, None], np.argsort(distance, axis=1, kind='stable')] = np.arange(num_atom)
+            nearest = (rank >= 1) & (rank <= knn)
+            neighbour |= nearest | nearest.T
+        edge_mask = off_diagonal & neighbour
+    
+    edge_index = np.stack(np.nonzero(edge_mask), 1).astype(np.uint8)
+    distance, angle, bond_label = distance[edge_mask], angle[edge_mask], bond_label[edge_mask]
+    
+    if categorical_encoding == 'one_hot': 
+        bond_type = (bond_label.reshape(-1, 1) == np.arange(1, len(BOND_TYPE)+1)).astype(np.uint8)
+    else: 
+        bond_type = bond_label.reshape(-1, 1)
+    return edge_index, bond_type, distance.reshape(-1, 1).astype(np.float32), angle.reshape(-1, 1).astype(np.float32)
+
+
 def make_graph(molecule_name, gb_structure, gb_scalar_coupling,
-               categorical_encoding='one_hot', normalize_coupling=False, rank=False) :
+               categorical_encoding='one_hot', normalize_coupling=False, rank=False, cutoff=None, knn=None) :
     """
     make_graph --> returns graph as 'Struct' object  (see /lib/utility/file.py)
     
@@ -141,6 +190,8 @@ def make_graph(molecule_name, gb_structure, gb_scalar_coupling,
         - gb_structure (DataFrame GroupBy):  groupby structure:  data groupped by molecule name 
         - gb_scalar_coupling (DataFrame GroupBy): The coupling contributions data groupped by molecule name 
         - categorical_encoding (str):  How represent categorical variables : label vs one-hot enconding 
+        - cutoff (float), knn (int): keep only the bonded, closer than cutoff and k-nearest atom pairs as edges 
+          (default: fully connected graph, see make_edge_features) 
     """
     #---- Coupling informatiom
     # ['id', 'molecule_name', 'atom_index_0', 'atom_index_1', 'type', 'scalar_coupling_constant', 'fc', 'sd', 'pso', 'dso'],
@@ -208,29 +259,7 @@ def make_graph(molecule_name, gb_structure, gb_scalar_coupling,
                     acceptor[i] = 1
                             
         ## ** edge features **
-        num_edge = num_atom*num_atom - num_atom
-        edge_index = np.zeros((num_edge,2), np.uint8) # int tuples 
-        bond_type  = np.zeros((num_edge,len(BOND_TYPE)), np.uint8) #category
-        distance   = np.zeros((num_edge,1),np.float32) #real
-        angle      = np.zeros((num_edge,1),np.float32) #real
-        relative_angle = np.zeros((num_edge,1),np.float32) #real
-
-        norm_xyz = preprocessing.normalize(xyz, norm='l2')
-
-        ij=0
-        for i in range(num_atom):
-            for j in range(num_atom):
-                if i==j: continue
-                edge_index[ij] = [i,j]
-
-                bond = mol.GetBondBetweenAtoms(i, j)
-                if bond is not None:
-                    bond_type[ij] = one_hot_encoding(bond.GetBondType(),BOND_TYPE)
-
-                distance[ij] = ((xyz[i] - xyz[j])**2).sum()**0.5
-                angle[ij] = (norm_xyz[i]*norm_xyz[j]).sum()
-
-                ij+=1
+        edge_index, bond_type, distance, angle = make_edge_features(mol, xyz, categorical_encoding, cutoff, knn)
                        
     elif categorical_encoding =='label': 
         ## ** node features **
@@ -260,27 +289,7 @@ def make_graph(molecule_name, gb_structure, gb_scalar_coupling,
                     acceptor[i] = 1
                     
         ## ** edge features **
-        num_edge = num_atom*num_atom - num_atom
-        edge_index = np.zeros((num_edge,2), np.uint8) # int tuples 
-        bond_type  = np.zeros((num_edge,1), np.uint8) #category
-        distance   = np.zeros((num_edge,1),np.float32) #real
-        angle      = np.zeros((num_edge,1),np.float32) #real
-
-        norm_xyz = preprocessing.normalize(xyz, norm='l2')
-
-        ij=0
-        for i in range(num_atom):
-            for j in range(num_atom):
-                if i==j: continue
-                edge_index[ij] = [i,j]
-
-                bond = mol.GetBondBetweenAtoms(i, j)
-                if bond is not None:
-                    bond_type[ij] = label_encoding(bond.GetBondType(),BOND_TYPE)
-
-                distance[ij] = ((xyz[i] - xyz[j])**2).sum()**0.5
-                angle[ij] = (norm_xyz[i]*norm_xyz[j]).sum()
-                ij+=1
+        edge_index, bond_type, distance, angle = make_edge_features(mol, xyz, categorical_encoding, cutoff, knn)
          
     else : 
             raise Exception(f"""{categorical_encoding} invalid categorical labeling""")
@@ -347,11 +356,29 @@ def load_csv():
     df_scalar_coupling = pd.merge(df_scalar_coupling, df_scalar_coupling_contribution,
             how='left', on=['molecule_name','atom_index_0','atom_index_1','atom_index_0','type'])
 
-    gb_scalar_coupling = df_scalar_coupling.groupby('molecule_name')
-    gb_structure       = df_structure.groupby('molecule_name')
+    gb_scalar_coupling = MoleculeGroups(df_scalar_coupling)
+    gb_structure       = MoleculeGroups(df_structure, sort_by=['molecule_name', 'atom_index'])
     return gb_structure, gb_scalar_coupling
 
 
+class MoleculeGroups(object):
+    """
+    Rows of a DataFrame sorted by molecule name with the offset of each molecule in contiguous arrays. 
+    Drop-in replacement of the DataFrame GroupBy used by make_graph: get_group is a slice, and the whole table is 
+    shared with the worker processes once instead of being pickled with each task. 
+    """
+    def __init__(self, df, sort_by=['molecule_name']):
+        # stable sort: keep the order of the rows inside each molecule, as groupby does 
+        self.frame = df.sort_values(sort_by, kind='mergesort').reset_index(drop=True)
+        self.molecule_names, start = np.unique(self.frame.molecule_name.values, return_index=True)
+        self.offsets = np.append(start, len(self.frame))
+        self.index = dict(zip(self.molecule_names, range(len(self.molecule_names))))
+
+    def get_group(self, molecule_name):
+        i = self.index[molecule_name]
+        return self.frame.iloc[self.offsets[i]:self.offsets[i+1]]
+
+
 #############################################################################################################
 #                                                                                                           #
 #                                            Tests check .                                                  #
@@ -421,40 +448,57 @@ def run_check_graph():
 #                                                                                                           #
 #############################################################################################################
 
-def do_one(p, categorical_encoding='one_hot', normalize_coupling=False):
+def do_one(p, categorical_encoding='one_hot', normalize_coupling=False, cutoff=None, knn=None):
     ''' Create and save the graph of molecule name: p '''
     i, molecule_name, gb_structure, gb_scalar_coupling, graph_file = p
 
-    g = make_graph(molecule_name, gb_structure, gb_scalar_coupling, categorical_encoding, normalize_coupling)
+    g = make_graph(molecule_name, gb_structure, gb_scalar_coupling, categorical_encoding, normalize_coupling, 
+                   cutoff=cutoff, knn=knn)
     print(i, g.molecule_name, g.smiles)
     write_pickle_to_file(graph_file,g)
 
+##---- inputs of the graph workers, set once per process by init_graph_worker 
+_GRAPH_INPUTS = {}
+
+def init_graph_worker(gb_structure, gb_scalar_coupling, graph_dir): 
+    ''' Pool initializer: with fork the tables are inherited by the workers, not pickled per task '''
+    _GRAPH_INPUTS.update(gb_structure=gb_structure, gb_scalar_coupling=gb_scalar_coupling, graph_dir=graph_dir)
+
+def do_chunk(indices, categorical_encoding='one_hot', normalize_coupling=False, cutoff=None, knn=None): 
+    ''' Create and save the graphs of a chunk of molecule indices '''
+    gb_structure, gb_scalar_coupling = _GRAPH_INPUTS['gb_structure'], _GRAPH_INPUTS['gb_scalar_coupling']
+    for i in indices: 
+        molecule_name = gb_scalar_coupling.molecule_names[i]
+        graph_file = _GRAPH_INPUTS['graph_dir'] + '/%s.pickle'%molecule_name
+        do_one((i, molecule_name, gb_structure, gb_scalar_coupling, graph_file), categorical_encoding, normalize_coupling, 
+               cutoff, knn)
+
 ##----
-def run_convert_to_graph(categorical_encoding='one_hot', normalize_coupling = False , graph_dir='/champs-2019/input/structure/graph1'):
+def run_convert_to_graph(categorical_encoding='one_hot', normalize_coupling = False , graph_dir='/champs-2019/input/structure/graph1',
+                         processes=16, chunk_size=256, num_serial=2000, cutoff=None, knn=None):
     '''
     Convert Train and Test data to graph structures and save each graph as .pkl file in graph_dir path 
+    
+    The molecules tables are loaded once and handed to each worker by the pool initializer, the tasks only carry 
+    chunks of `chunk_size` molecule indices. The first `num_serial` molecules are converted in the main process 
+    to catch errors early. 
+    cutoff / knn build sparse neighbour graphs instead of fully connected ones (see make_edge_features). 
     '''
     # graph_dir = '/champs-2019/input/structure/graph1'
     os.makedirs(graph_dir, exist_ok=True)
 
     gb_structure, gb_scalar_coupling = load_csv()
-    molecule_names = list(gb_scalar_coupling.groups.keys())
-    molecule_names = np.sort(molecule_names)
-
-    param=[]
-    for i, molecule_name in enumerate(molecule_names):
-
-        graph_file = graph_dir + '/%s.pickle'%molecule_name
-        p = (i, molecule_name, gb_structure, gb_scalar_coupling, graph_file)
-
-        if i<2000:
-            do_one(p, categorical_encoding, normalize_coupling)
-        else:
-            param.append(p)
-
-    if 1:
-        pool = mp.Pool(processes=16)
-        pool.map(partial(do_one, categorical_encoding=categorical_encoding, normalize_coupling=normalize_coupling), param)
+    init_graph_worker(gb_structure, gb_scalar_coupling, graph_dir)
+    num_molecules = len(gb_scalar_coupling.molecule_names)
+    convert = partial(do_chunk, categorical_encoding=categorical_encoding, normalize_coupling=normalize_coupling, 
+                      cutoff=cutoff, knn=knn)
+    
+    convert(range(min(num_serial, num_molecules)))
+    chunks = [range(start, min(start + chunk_size, num_molecules)) for start in range(num_serial, num_molecules, chunk_size)]
+    with mp.Pool(processes=processes, initializer=init_graph_worker, 
+                 initargs=(gb_structure, gb_scalar_coupling, graph_dir)) as pool: 
+        for _ in pool.imap_unordered(convert, chunks): 
+            pass
 
 
 
@@ -519,6 +563,8 @@ if __name__ == '__main__':
     parser.add_argument('--folds', type=int, help='number of validation folds', required=False)
     parser.add_argument('--categorical_encoding', type=str, help='How to encode categorical values: "one_hot" vs "label"', required=False )
     parser.add_argument('--graph_dir', type=str, help='output dir for saving the graph structure of all the molecules', required=False)
+    parser.add_argument('--cutoff', type=float, default=None, help='keep only edges shorter than cutoff (+ bonds and knn edges)')
+    parser.add_argument('--knn', type=int, default=None, help='keep only edges to the k nearest atoms (+ bonds and cutoff edges)')
     parser.add_argument('--normalize', default=False, action ='store_true', help='whether to normalize couplings', required=False)
     
     args = parser.parse_args()
@@ -532,4 +578,4 @@ if __name__ == '__main__':
     
     # Convert data to graphs 
     if args.graph_dir: 
-        run_convert_to_graph(args.categorical_encoding, args.normalize, args.graph_dir)
+        run_convert_to_graph(args.categorical_encoding, args.normalize, args.graph_dir, cutoff=args.cutoff, knn=args.knn)
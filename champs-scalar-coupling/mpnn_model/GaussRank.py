@@ -1,96 +1,163 @@
+import glob
+import os
 import numpy as np
 from scipy.special import erfinv
-from bisect import bisect_left
-import pandas as pd 
+import pandas as pd
 class GaussRankMap():
+    """
+    GaussRank transform of the scalar coupling constant, fitted per coupling type.
+    The maps of all the types are stored as two numpy arrays sorted by type then by coupling value:
+        sc: the coupling values of the training data, sct: their gaussrank values,
+        offsets: the map of the type coupling_order[i] is sc[offsets[i]:offsets[i+1]]
+    so that the transform of a frame with mixed types is one searchsorted and one interpolation.
+    Args:
+        training_maps: optional list of frames with columns sc, sct (the former csv persistence), one per type
+        coupling_order: the type of each map
+    """
 
-    def __init__(self, training_maps=[], coupling_order=[]):
+    def __init__(self, training_maps=None, coupling_order=None):
         self.epsilon = 0.001
         self.lower = -1 + self.epsilon
         self.upper = 1 - self.epsilon
         self.range = self.upper - self.lower
-        
-        self.training_maps = training_maps
-        self.coupling_order = coupling_order
+
+        self.coupling_order = list(coupling_order or [])
+        self.sc = np.zeros(0, dtype=np.float64)
+        self.sct = np.zeros(0, dtype=np.float64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        if training_maps:
+            self._set_maps([frame['sc'].values for frame in training_maps],
+                           [frame['sct'].values for frame in training_maps])
+
+    def _set_maps(self, sc, sct):
+        # sort each map by coupling value (then gaussrank value for ties) so that both columns are non-decreasing
+        order = [np.lexsort((t, s)) for s, t in zip(sc, sct)]
+        self.sc = np.concatenate([np.asarray(s, dtype=np.float64)[o] for s, o in zip(sc, order)])
+        self.sct = np.concatenate([np.asarray(t, dtype=np.float64)[o] for t, o in zip(sct, order)])
+        self.offsets = np.cumsum([0] + [len(o) for o in order]).astype(np.int64)
+
+    @property
+    def training_maps(self):
+        """ the map of each type as a frame with columns sc, sct """
+        return [pd.DataFrame({'sc': self.sc[start:end], 'sct': self.sct[start:end]})
+                for start, end in zip(self.offsets[:-1], self.offsets[1:])]
 
     def fit_training(self, df, reset=False):
-        if self.training_maps and reset == True:
-            self.training_maps = []
-            self.coupling_order = []
-        elif self.training_maps:
+        """
+        Fit the maps of all the types of df (columns type, scalar_coupling_constant) in one sort.
+        Returns the gaussrank values of df as a Series with the index of df
+        """
+        if self.coupling_order and reset == False:
             print('GaussRank Mapping already exists.  To overide set reset=True.')
             return
-        
-        tf = None
-        
-        for coupling_type in df['type'].unique():
-            self.coupling_order.append(coupling_type)
-            X = df[df['type']==coupling_type]['scalar_coupling_constant']
-            i = np.argsort(X, axis=0)
-            j = np.argsort(i, axis=0)
-
-            assert (j.min() == 0).all()
-            assert (j.max() == len(j) - 1).all()
-
-            j_range = len(j) - 1
-            self.divider = j_range / self.range
-
-            transformed = j / self.divider
-            transformed = transformed - self.upper
-            transformed = erfinv(transformed)
-            
-            #print(coupling_type, len(X), len(transformed))
-            
-            if tf is None:
-                tf = transformed.copy(deep=True)
-
-            else:
-                tf = tf.append(transformed.copy(deep=True))
-
-            
-            training_map = pd.concat([X, transformed], axis=1)
-            training_map.columns=['sc','sct']
-            training_map.sort_values(['sc'], ascending=[1], inplace=True)
-            training_map.reset_index(inplace=True, drop=True)
-            
-            self.training_maps.append(training_map)
-        return tf
+
+        codes, self.coupling_order = pd.factorize(df['type'], sort=False)
+        self.coupling_order = list(self.coupling_order)
+        sc = df['scalar_coupling_constant'].values.astype(np.float64)
+
+        # rank of each coupling within its type
+        order = np.lexsort((sc, codes))
+        counts = np.bincount(codes, minlength=len(self.coupling_order))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        j = np.arange(len(order)) - self.offsets[codes[order]]
+
+        divider = np.maximum(counts - 1, 1)[codes[order]] / self.range
+        self.sc = sc[order]
+        self.sct = erfinv(j / divider - self.upper)
+
+        transformed = np.empty(len(order), dtype=np.float64)
+        transformed[order] = self.sct
+        return pd.Series(transformed, index=df.index)
+
+    def transform(self, values, coupling_type, from_coupling=True):
+        """
+        Map values (numpy array) of the types coupling_type (array of type names) from the coupling values to the
+        gaussrank values, or back with from_coupling=False. Values between two points of the map of their type are
+        interpolated, values out of it extrapolated with its first / last segment.
+        """
+        column, target = (self.sc, self.sct) if from_coupling else (self.sct, self.sc)
+        values = np.asarray(values, dtype=np.float64)
+        codes = pd.Index(self.coupling_order).get_indexer(np.asarray(coupling_type))
+        if (codes < 0).any():
+            raise ValueError('no GaussRank map for the types %s' %set(np.asarray(coupling_type)[codes < 0]))
+
+        # shift the maps of each type past the previous one : one searchsorted for all the types
+        low = min(column.min(), values.min()) if len(values) else 0
+        span = max(column.max(), values.max()) - low + 1 if len(values) else 1
+        keys = column - low + span * np.repeat(np.arange(len(self.coupling_order)), np.diff(self.offsets))
+        shifted = values - low + span * codes
+
+        # searching the values in sorted order is much more cache friendly on millions of rows
+        order = np.argsort(shifted)
+        pos = np.empty(len(shifted), dtype=np.int64)
+        pos[order] = np.searchsorted(keys, shifted[order], side='left')
+        pos = np.clip(pos, self.offsets[codes] + 1, self.offsets[codes + 1] - 1)
+        x1, x2 = keys[pos], keys[pos-1]
+        y1, y2 = target[pos], target[pos-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative = np.where(x1 == x2, 1.0, (shifted - x2) / (x1 - x2))
+        return (1 - relative) * y2 + relative * y1
 
     def convert_df(self, df, from_coupling=True):
-        #coupling_idx = self.coupling_order.index(coupling_type)
+        """
+        Transform the column scalar_coupling_constant (from_coupling=True) or prediction of df w.r.t its column type.
+        Returns a frame with the index of df and the column sct or sc
+        """
         if from_coupling==True:
-            column = 'sc'
             target = 'sct'
             df_column = 'scalar_coupling_constant'
-            
         else:
-            column = 'sct'
             target = 'sc'
             df_column = 'prediction'
+        output = self.transform(df[df_column].values, df['type'].values, from_coupling)
+        return pd.DataFrame({target: output}, index=df.index)
+
+    def save(self, path):
+        """ save the maps to one .npz file """
+        np.savez(path, sc=self.sc, sct=self.sct, offsets=self.offsets, coupling_order=np.array(self.coupling_order))
+
+    @classmethod
+    def load(cls, path):
+        grm = cls()
+        with np.load(path) as data:
+            grm.sc, grm.sct, grm.offsets = data['sc'], data['sct'], data['offsets']
+            grm.coupling_order = [str(t) for t in data['coupling_order']]
+        return grm
+
+
+def load_gaussrank_map(directory):
+    """
+    GaussRankMap saved with the parquet files of a fold: gaussrank_map.npz, or the former
+    mapping_type_<type>_order_<i>.csv files
+    """
+    if os.path.exists(os.path.join(directory, 'gaussrank_map.npz')):
+        return GaussRankMap.load(os.path.join(directory, 'gaussrank_map.npz'))
+    files = glob.glob(os.path.join(directory, 'mapping_type_*_order_*.csv'))
+    mapping_frames = ['']*len(files)
+    coupling_order = ['']*len(files)
+    for file in files:
+        type_ = os.path.basename(file).split('_')[2]
+        order = int(os.path.basename(file).split('_')[-1][:-len('.csv')])
+        coupling_order[order] = type_
+        mapping_frames[order] = pd.read_csv(file)
+    return GaussRankMap(mapping_frames, coupling_order)
+
+
+def pad_by_molecule(frame, columns, num_max=136, molecule_names=None):
+    """
+    Scatter the rows of frame into a zero padded [num_molecules, num_max, len(columns)] array: the i-th row of a
+    molecule (in frame order) goes to position i, found with a cumcount instead of a per-molecule groupby.apply.
+    Molecules are in order of first appearance in frame, or in the order of molecule_names when given.
+    Returns: molecule_names, values
+    """
+    if molecule_names is None:
+        molecule, molecule_names = pd.factorize(frame['molecule_name'], sort=False)
+    else:
+        molecule = pd.Index(molecule_names).get_indexer(frame['molecule_name'])
+        assert (molecule >= 0).all(), 'frame has molecules which are not in molecule_names'
+    position = pd.Series(molecule).groupby(molecule).cumcount().values
+    assert len(position) == 0 or position.max() < num_max, 'a molecule has more than %s rows' %num_max
 
-        output = None
-        # Do all of the sorts per coupling type in a single operation
-        for coupling_type in df['type'].unique():
-            training_map = self.training_maps[self.coupling_order.index(coupling_type)]     
-            #training_map = cudf.DataFrame.from_pandas(self.training_maps[self.coupling_order.index(coupling_type)])    
-            pos = training_map[column].searchsorted(df[df['type']==coupling_type][df_column], side='left')
-            pos[pos>=len(training_map)] = len(training_map)-1
-            pos[pos-1<=0] = 0
-            
-            x1 = training_map[column].iloc[pos].reset_index(drop=True)
-            x2 = training_map[column].iloc[pos-1].reset_index(drop=True) # larger of the two
-            y1 = training_map[target].iloc[pos].reset_index(drop=True)
-            y2 = training_map[target].iloc[pos-1].reset_index(drop=True)
-            z = df[df['type']==coupling_type].reset_index(drop=False)[['index',df_column]]
-
-            relative = z['index'],(z[df_column]-x2)  / (x1-x2)
-            if output is None:
-                output = pd.DataFrame(list(zip(relative[0],((1-relative[1])*y2 + (relative[1]*y1)))))
-            else:
-                output = output.append(pd.DataFrame(list(zip(relative[0],((1-relative[1])*y2 + (relative[1]*y1))))))
-           
-        output.columns = ['index',target]
-        output = output.set_index('index', drop=True)
-        # output = output.sort_index()
-        # < min or > max
-        return output #pd.DataFrame(list(zip(relative[0],((1-relative[1])*y2 + (relative[1]*y1)))))
\ No newline at end of file
+    values = np.zeros((len(molecule_names), num_max, len(columns)), dtype=np.float64)
+    values[molecule, position] = frame[columns].values
+    return np.asarray(molecule_names), values
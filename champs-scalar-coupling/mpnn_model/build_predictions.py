@@ -12,63 +12,114 @@ from mpnn_model.train_loss import lmae_criterion
 from mpnn_model.callback import * 
 
 from time import time 
+#############################################################################################################
+#                                                                                                           #
+#                                     Preallocated prediction arrays                                        #
+#                                                                                                           #
+#############################################################################################################
+class PredictionArrays(object):
+    """
+    Outputs of do_test preallocated from the total number of couplings and filled batch by batch, so that no 
+    per-batch lists are concatenated at the end of the predictions. 
+    Args: 
+        num_coupling (int): expected number of couplings, the arrays grow if more are written 
+        out_dir (str): when given, the arrays are .npy files memory-mapped in out_dir instead of held in memory 
+    The molecule representations (net.pool: one row per coupling) and the contributions are allocated at the 
+    first batch which writes them, as their dimension comes from the model. 
+    """
+    def __init__(self, num_coupling, out_dir=None):
+        self.out_dir = out_dir
+        self.size = 0
+        self.arrays = {}
+        self.capacity = num_coupling
+        for name, dtype in [('id', np.int64), ('predict', np.float32), 
+                            ('coupling_type', np.int32), ('coupling_value', np.float32)]:
+            self.arrays[name] = self._empty(name, (num_coupling,), dtype)
+
+    def _empty(self, name, shape, dtype): 
+        if self.out_dir is None: 
+            return np.empty(shape, dtype=dtype)
+        os.makedirs(self.out_dir, exist_ok=True)
+        return np.lib.format.open_memmap(os.path.join(self.out_dir, '%s.npy'%name), mode='w+', dtype=dtype, shape=shape)
+
+    def _grow(self, size): 
+        # the expected number of couplings was too small: double the capacity (in memory) 
+        self.capacity = max(size, 2*self.capacity)
+        for name, array in self.arrays.items(): 
+            grown = np.empty((self.capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:self.size] = array[:self.size]
+            self.arrays[name] = grown
+
+    def write(self, **batch): 
+        """ write the tensors of a batch: id, predict, coupling_type, coupling_value [, molecule_representation, contributions] """
+        num = batch['id'].size(0)
+        if self.size + num > self.capacity: 
+            self._grow(self.size + num)
+        for name, tensor in batch.items(): 
+            tensor = tensor.detach().cpu().numpy()
+            if name not in self.arrays: 
+                self.arrays[name] = self._empty(name, (self.capacity,) + tensor.shape[1:], np.float32)
+            self.arrays[name][self.size:self.size + num] = tensor.reshape(num, *self.arrays[name].shape[1:])
+        self.size += num
+
+    def __getitem__(self, name): 
+        if name not in self.arrays: 
+            return None
+        return self.arrays[name][:self.size]
+
+
 #############################################################################################################
 #                                                                                                           #
 #                                     Get prediction function                                               #
 #                                                                                                           #
 #############################################################################################################
-def do_test(net, test_loader, test_len, num_output, predict_type, grm, normalize=False, gaussrank=False):
+def do_test(net, test_loader, test_len, num_output, predict_type, grm, normalize=False, gaussrank=False, 
+            embeddings=False, out_dir=None):
     """
     do_test -> return list of (indices, predictions)
     
     Input arguments: 
         net (nn.module) : the graph neural network model 
         test_loader (Dataloader):  Test data loader
-        test_len (int):  length of test dataset     
+        test_len (int):  length of test dataset: number of couplings, used to preallocate the outputs 
+        embeddings (bool): also return the molecule representations net.pool (one row per coupling), otherwise None 
+        out_dir (str): memory-map the outputs to .npy files in out_dir instead of holding them in memory 
     """
     
-    test_num = 0
-    test_predict = []
-    test_coupling_type  = []
-    test_coupling_value = []
-    test_id = []
-    test_contributions = []
-    molecule_representation = []
+    outputs = PredictionArrays(test_len, out_dir)
     num_batches = 0
     test_loss = 0 
     start = timer()    
-    for b, (((node, edge, edge_index, node_index, coupling_index, type_, atomic), targets), infor) in enumerate(test_loader):
+    for b, (((node, edge, edge_index, node_index, coupling_index, type_, atomic, num_node), targets), infor) in enumerate(test_loader):
         net.eval()
         with torch.no_grad():
             
             coupling_value = targets[0]
-            predict =  net(node, edge, edge_index, node_index, coupling_index, type_, atomic)
+            predict =  net(node, edge, edge_index, node_index, coupling_index, type_, atomic, num_node)
             
             if predict_type: 
                 predict = torch.gather(predict[0], 1, targets[3].unsqueeze(1)).view(-1)
                 predict = [predict, [], []]
                 
             if normalize: 
-                coupling_mean = torch.gather(COUPLING_TYPE_MEAN, 0, targets[3])
-                coupling_std = torch.gather(COUPLING_TYPE_STD, 0, targets[3])
+                coupling_mean = torch.gather(COUPLING_TYPE_MEAN.to(targets[3].device), 0, targets[3])
+                coupling_std = torch.gather(COUPLING_TYPE_STD.to(targets[3].device), 0, targets[3])
                 predict = (predict * coupling_std) + coupling_mean
                 coupling_value = (coupling_value * coupling_std) + coupling_mean
                 predict = [predict, [], []]
                 
             loss = lmae_criterion(predict, coupling_value, coupling_value, [], [])
                 
+        batch = dict(id=infor, predict=predict[0], coupling_type=coupling_index[:,-2], coupling_value=coupling_value)
+        if embeddings: 
+            batch['molecule_representation'] = net.pool
+        if num_output==5: 
+            batch['contributions'] = predict[1]
+        outputs.write(**batch)
                 
         batch_size = test_loader.batch_size
-        test_id.extend(list(infor.data.cpu().numpy()))
-        
-        test_predict.append(predict[0].data.cpu().numpy())
-        molecule_representation.append(net.pool.data.cpu().numpy())
-        
-        test_coupling_type.append(coupling_index[:,-2].data.cpu().numpy())
-        test_coupling_value.append(coupling_value.data.cpu().numpy())
-
         test_loss += loss.item()*batch_size
-        test_num = len(test_id)
+        test_num = outputs.size
         num_batches += batch_size 
         
         print('\r %8d/%8d     %0.2f  %s'%( test_num, test_len, test_num/test_len,
@@ -80,18 +131,14 @@ def do_test(net, test_loader, test_len, num_output, predict_type, grm, normalize
     print('\n')
     
     print('predict')
-    predict  = np.concatenate(test_predict)
-    
-    if num_output==5:
-        contributions = np.concatenate(test_contributions)
-    else:
-        contributions = []
-        
-    test_coupling_value = np.concatenate(test_coupling_value)
-    test_coupling_type  = np.concatenate(test_coupling_type).astype(np.int32)
-    molecule_representation = np.concatenate(molecule_representation)
+    predict = outputs['predict']
+    contributions = outputs['contributions'] if num_output==5 else []
+    test_id = outputs['id']
+    test_coupling_value = outputs['coupling_value']
+    test_coupling_type  = outputs['coupling_type']
+    molecule_representation = outputs['molecule_representation']
     
-    # convert gaussrank test predictions to their actual values 
+    # convert gaussrank test predictions to their actual values: one pass over all the predictions 
     if gaussrank: 
         print('compute the reverse frame')
         reverse_frame = get_reverse_frame(test_id, predict, test_coupling_type, test_coupling_value, grm)
@@ -99,11 +146,8 @@ def do_test(net, test_loader, test_len, num_output, predict_type, grm, normalize
     
     else: 
         print('build preds frame')
-        reverse_frame = pd.DataFrame(predict)
-        reverse_frame['type'] = test_coupling_type
-        reverse_frame.columns = ['scalar_coupling_constant', 'type_ind']
-        reverse_frame['id'] = test_id
-        reverse_frame['true_scalar_coupling_constant'] = test_coupling_value
+        reverse_frame = pd.DataFrame({'scalar_coupling_constant': predict, 'type_ind': test_coupling_type, 
+                                      'id': test_id, 'true_scalar_coupling_constant': test_coupling_value})
         
     
     mae, log_mae   = compute_kaggle_metric(reverse_frame.scalar_coupling_constant, reverse_frame.true_scalar_coupling_constant, reverse_frame.type_ind)
@@ -1,7 +1,11 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
+
 import numpy as np 
 import pandas as pd 
 
-from fastai.callbacks import SaveModelCallback
+from fastai.callbacks import SaveModelCallback, TrackerCallback
 from fastai.callbacks import Callback
 from fastai.torch_core import add_metrics
 
@@ -12,9 +16,11 @@ import torch.nn.functional as F
 import pdb
 
 from mpnn_model.common_constants import NUM_COUPLING_TYPE, COUPLING_TYPE_MEAN, COUPLING_TYPE_STD, REVERSE_COUPLING_TYPE
+from mpnn_model.profiling import PhaseProfiler
 
 
-__all__ = ['get_reverse_frame', 'lmae', 'compute_kaggle_metric', 'LMAE']
+__all__ = ['get_reverse_frame', 'lmae', 'lmae_from_sums', 'compute_kaggle_metric', 'GaussRankInverse', 'LMAE',
+           'atomic_save', 'AsyncCheckpoint', 'ProfilePhases']
 
 # reverse the gaussrank predictions to the actual distribution
 def get_reverse_frame(test_id, predictions, coupling_type, target, grm,):
@@ -39,6 +45,13 @@ def lmae(truth,pred,types):
     return np.mean(x)   
 
 
+# lmae from the per-type sums of absolute errors and counts : same value as lmae() 
+def lmae_from_sums(abs_error, count):
+    present = count > 0
+    mae = abs_error[present] / count[present].to(abs_error.dtype)
+    return torch.log(mae + 1e-8).mean().item()
+
+
 #  lmae w.r.t  8 coupling types : kaggle metric 
 def compute_kaggle_metric(predict, coupling_value, coupling_type):
     """
@@ -68,10 +81,50 @@ def compute_kaggle_metric(predict, coupling_value, coupling_type):
     return mae, log_mae
 
 
+# reverse the gaussrank predictions on tensors 
+class GaussRankInverse(object):
+    '''
+    Map gaussrank predictions of mixed coupling types back to coupling values on their device. 
+    The 'sct' -> 'sc' maps of the types are concatenated, each type shifted by type * OFFSET so that the keys stay 
+    sorted: a whole batch is mapped with one searchsorted and one linear interpolation. Values out of the map 
+    are extrapolated with its first / last segment, as in GaussRankMap.transform. 
+    '''
+    OFFSET = 16. # larger than the range of the gaussrank values (|erfinv| < 4)
+
+    def __init__(self, grm, device='cpu'):
+        keys, values, start, end = [], [], [0]*NUM_COUPLING_TYPE, [0]*NUM_COUPLING_TYPE
+        size = 0 
+        for t in range(NUM_COUPLING_TYPE):
+            start[t] = size 
+            if REVERSE_COUPLING_TYPE[t] in grm.coupling_order: 
+                i = grm.coupling_order.index(REVERSE_COUPLING_TYPE[t])
+                # the maps of the GaussRankMap are sorted by sc, with sct non-decreasing 
+                keys.append(grm.sct[grm.offsets[i]:grm.offsets[i+1]] + t*self.OFFSET)
+                values.append(grm.sc[grm.offsets[i]:grm.offsets[i+1]])
+                size += len(keys[-1])
+            end[t] = size 
+        self.keys = torch.tensor(np.concatenate(keys), dtype=torch.float64, device=device)
+        self.values = torch.tensor(np.concatenate(values), dtype=torch.float64, device=device)
+        self.start = torch.tensor(start, device=device)
+        self.end = torch.tensor(end, device=device)
+
+    def __call__(self, predict, types):
+        key = predict.view(-1).double() + types.double()*self.OFFSET
+        # interpolate between pos-1 and pos, with pos kept inside the map of the type 
+        pos = torch.searchsorted(self.keys, key)
+        pos = torch.min(torch.max(pos, self.start[types] + 1), self.end[types] - 1)
+        x1, x2 = self.keys[pos], self.keys[pos-1]
+        y1, y2 = self.values[pos], self.values[pos-1]
+        relative = (key - x2) / (x1 - x2)
+        return (1 - relative) * y2 + relative * y1
+
+
 # Callback to calculate LMAE at the end of each epoch
 class LMAE(Callback):
     '''
     Comput LMAE for the prediction of the coupling value 
+    The absolute errors are summed per type as the validation batches arrive (denormalized or gaussrank reversed 
+    on their device), only the 8 sums and counts are kept during the epoch. 
     '''
     _order = -20 #Needs to run before the recorder
 
@@ -81,49 +134,238 @@ class LMAE(Callback):
         self.normalize_coupling = normalize_coupling
         self.grm = grm 
         self.coupling_rank = coupling_rank 
+        self.inverse = None 
     def on_train_begin(self, **kwargs): self.learn.recorder.add_metric_names(['LMAE'])
-    def on_epoch_begin(self, **kwargs): self.output, self.target, self.types = [], [], []
+    def on_epoch_begin(self, **kwargs): self.abs_error, self.count = None, None
 
     def on_batch_end(self, last_target, last_output, train, **kwargs):
         if not train:
-            self.target.append(last_target[0])
-            self.types.append(last_target[3])
+            target = last_target[0].view(-1)
+            types = last_target[3].view(-1)
             if self.predict_type: 
-                coupling = torch.gather(last_output[0], 1, last_target[3].unsqueeze(1)).view(-1)
-                self.output.append(coupling)
+                output = torch.gather(last_output[0], 1, types.unsqueeze(1)).view(-1)
             else:
-                self.output.append(last_output[0])
-            
-    def on_epoch_end(self, last_metrics, **kwargs):
-        if len(self.output) > 0:
-            output = torch.cat(self.output)
-            target = torch.cat(self.target)
-            types = torch.cat(self.types)
+                output = last_output[0].view(-1)
             
             if self.normalize_coupling : 
                 # Denormalize w.r.t to type 
-                means = torch.gather(COUPLING_TYPE_MEAN, 0, types)
-                stds = torch.gather(COUPLING_TYPE_STD, 0, types)
+                means = torch.gather(COUPLING_TYPE_MEAN.to(types.device), 0, types)
+                stds = torch.gather(COUPLING_TYPE_STD.to(types.device), 0, types)
                 output = (output * stds) + means
                 target = (target * stds) + means 
-                metric = lmae(output.data.cpu().numpy(), target.data.cpu().numpy(), types.data.cpu().numpy())
                 
             elif self.coupling_rank: 
-                # Reverse using grm mapping frames 
-                preds = pd.DataFrame(output.data.cpu().numpy())
-                preds['type'] = types.data.cpu().numpy()
-                preds.columns = ['prediction', 'type']
-                preds['type'] = preds['type'].map(REVERSE_COUPLING_TYPE)
-                preds['true_scalar_coupling_constant'] = target.data.cpu().numpy()
-                preds['scalar_coupling_constant'] = self.grm.convert_df(preds, from_coupling=False) 
-                
-                # compute metric for reversed scalar coupling predictions  
-                metric = lmae(preds['scalar_coupling_constant'], preds['true_scalar_coupling_constant'], preds['type'])
-                
-            else: 
-                preds = output.data.cpu().numpy().reshape(-1,)
-                type_ = types.data.cpu().numpy()
-                targets =  target.data.cpu().numpy()
-                metric = lmae(targets, preds, type_)
-                
+                # Reverse using grm mapping frames, moved once to the device of the predictions 
+                if self.inverse is None or self.inverse.keys.device != output.device: 
+                    self.inverse = GaussRankInverse(self.grm, output.device)
+                output = self.inverse(output, types)
+            
+            error = (output.double() - target.double()).abs()
+            if self.abs_error is None: 
+                self.abs_error = torch.zeros(NUM_COUPLING_TYPE, dtype=torch.float64, device=types.device)
+                self.count = torch.zeros(NUM_COUPLING_TYPE, dtype=torch.int64, device=types.device)
+            self.abs_error.scatter_add_(0, types, error)
+            self.count += torch.bincount(types, minlength=NUM_COUPLING_TYPE)
+            
+    def on_epoch_end(self, last_metrics, **kwargs):
+        if self.count is not None:
+            metric = lmae_from_sums(self.abs_error, self.count)
             return add_metrics(last_metrics, [metric])
+
+
+# torch.save to a temporary file renamed over path: a reader never sees a partially written checkpoint 
+def atomic_save(obj, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# Callback to save the checkpoints on a background thread 
+class AsyncCheckpoint(TrackerCallback):
+    '''
+    Drop-in for SaveModelCallback which does not block the training on the disk: at the end of an epoch (every 
+    epoch or on improvement of the monitored metric) the state_dict is copied to cpu memory and written by a 
+    background thread, to a temporary file renamed over the checkpoint. 
+    Files, in learn.path/learn.model_dir: 
+        name_epoch_<k>.pth : state_dict of epoch k, only the last keep_last and the best keep_best are kept 
+        name.pth : the best state_dict, hard link to its epoch file (with every='improvement', loaded at the end 
+                   of the training as SaveModelCallback does, with learn.load(name)) 
+    Arguments: 
+        - every: 'improvement' or 'epoch' 
+        - keep_last, keep_best: number of epoch files kept 
+        - max_pending: snapshots queued for the writer before the training waits for it (bounds the cpu memory) 
+        - log: Logger, for the summary of the timings at the end of the training 
+    The timings of each checkpoint (snapshot on the training thread, wait for the writer, write in the background) 
+    are kept in self.timings. 
+    '''
+    def __init__(self, learn, monitor='LMAE', mode='min', every='improvement', name='bestmodel', keep_last=1, 
+                 keep_best=1, max_pending=2, log=None): 
+        super().__init__(learn, monitor=monitor, mode=mode)
+        assert every in ['improvement', 'epoch'], 'every should be improvement or epoch'
+        self.every = every 
+        self.name = name 
+        self.keep_last = keep_last 
+        self.keep_best = max(keep_best, 1)
+        self.max_pending = max_pending 
+        self.log = log 
+        self.writer = None 
+        
+    def _path(self, name): 
+        return os.path.join(str(self.learn.path), str(self.learn.model_dir), name + '.pth')
+
+    def on_train_begin(self, **kwargs): 
+        super().on_train_begin(**kwargs)
+        os.makedirs(os.path.dirname(self._path(self.name)), exist_ok=True)
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.pending, self.saved, self.timings = [], [], []
+        
+    def on_epoch_end(self, epoch, **kwargs): 
+        current = self.get_monitor_value()
+        improved = current is not None and bool(self.operator(current, self.best))
+        if improved: 
+            self.best = current 
+        if not improved and self.every == 'improvement': 
+            return 
+        
+        timing = {'epoch': epoch, 'value': None if current is None else float(current), 'best': improved}
+        # bound the snapshots in memory: wait for the oldest write 
+        start = timer()
+        while len(self.pending) >= self.max_pending: 
+            self.pending.pop(0).result()
+        timing['wait_ms'] = (timer() - start) * 1000 
+        
+        start = timer()
+        state = {k: v.detach().to('cpu', copy=True) for k, v in self.learn.model.state_dict().items()}
+        timing['snapshot_ms'] = (timer() - start) * 1000 
+        
+        # files kept after this checkpoint: the last keep_last epochs and the best keep_best 
+        self.saved.append((epoch, current))
+        ranked = sorted([s for s in self.saved if s[1] is not None], key=lambda s: s[1], 
+                        reverse=self.operator == np.greater)
+        keep = set(e for e, _ in (self.saved[-self.keep_last:] if self.keep_last > 0 else []))
+        keep |= set(e for e, _ in ranked[:self.keep_best])
+        removed = [e for e, _ in self.saved if e not in keep]
+        self.saved = [s for s in self.saved if s[0] in keep]
+        self.pending.append(self.writer.submit(self._write, state, epoch, improved, removed, timing))
+        self.timings.append(timing)
+
+    def _write(self, state, epoch, improved, removed, timing): 
+        start = timer()
+        path = self._path('%s_epoch_%s' % (self.name, epoch))
+        atomic_save(state, path)
+        if improved: 
+            best = self._path(self.name)
+            try: 
+                os.link(path, best + '.tmp')
+                os.replace(best + '.tmp', best)
+            except OSError: 
+                atomic_save(state, best)
+        for e in removed: 
+            old = self._path('%s_epoch_%s' % (self.name, e))
+            if os.path.exists(old): 
+                os.remove(old)
+        timing['write_ms'] = (timer() - start) * 1000 
+        timing['size_mb'] = os.path.getsize(path) / 2**20 
+
+    def on_train_end(self, **kwargs): 
+        start = timer()
+        self.writer.shutdown(wait=True)
+        for future in self.pending: 
+            future.result()
+        self.pending = []
+        drain_ms = (timer() - start) * 1000 
+        if self.log is not None and self.timings: 
+            self.log.write('\ncheckpoints: %d, training blocked %0.1f ms (snapshot %0.1f ms + wait %0.1f ms), '
+                           'background writes %0.1f ms, final drain %0.1f ms\n' % (
+                               len(self.timings), 
+                               sum(t['snapshot_ms'] + t['wait_ms'] for t in self.timings), 
+                               sum(t['snapshot_ms'] for t in self.timings), sum(t['wait_ms'] for t in self.timings), 
+                               sum(t['write_ms'] for t in self.timings), drain_ms))
+        # as SaveModelCallback: back to the best epoch only when saving on improvement 
+        if self.every == 'improvement' and os.path.isfile(self._path(self.name)): 
+            self.learn.load(self.name, purge=False)
+
+
+# Callback to time the phases of the training steps 
+class ProfilePhases(Callback):
+    '''
+    Attach a PhaseProfiler to the Net and to the training loader for the training batches of each epoch, and time 
+    the steps of the fastai loop around them: forward, loss, backward, optimizer. The validation batches are not 
+    profiled. 
+    At the end of each epoch the table of the phases (calls, total, mean, share of the epoch training time) goes to 
+    the Logger (or stdout) and to self.history. 
+    Arguments: 
+        - log: Logger 
+        - trace_path: write the timeline of all the profiled phases to this Chrome trace .json file at the end 
+        - sync: synchronize cuda around each phase (default: when the model is on cuda) 
+    '''
+    def __init__(self, learn, log=None, trace_path=None, sync=None): 
+        self.learn = learn 
+        self.log = log 
+        self.trace_path = trace_path 
+        self.sync = sync 
+        self.history = []
+
+    def on_train_begin(self, **kwargs): 
+        sync = self.sync if self.sync is not None else next(self.learn.model.parameters()).is_cuda 
+        self.profiler = PhaseProfiler(sync=sync, trace=self.trace_path is not None)
+        self.learn.model.profiler = self.profiler 
+        self.learn.data.train_dl.profiler = self.profiler 
+
+    def on_epoch_begin(self, **kwargs): 
+        self.profiler.reset()
+        self.profiler.enabled = True 
+        self.num_train_batch = 0 
+        self.start = self.train_end = self.profiler.now()
+
+    def _lap(self, name): 
+        now = self.profiler.now()
+        self.profiler.record(name, self.mark, now)
+        self.mark = now 
+
+    def on_batch_begin(self, train, **kwargs): 
+        self.profiler.enabled = train 
+        if train: 
+            self.mark = self.profiler.now()
+
+    def on_loss_begin(self, train, **kwargs): 
+        if train: self._lap('forward')
+
+    def on_backward_begin(self, train, **kwargs): 
+        if train: self._lap('loss')
+
+    def on_backward_end(self, train, **kwargs): 
+        if train: self._lap('backward')
+
+    def on_step_end(self, train, **kwargs): 
+        if train: self._lap('optimizer')
+
+    def on_batch_end(self, train, **kwargs): 
+        if train: 
+            self.train_end = self.profiler.now()
+            # off after the last training batch: the collate / h2d of the first validation batch run before its 
+            # on_batch_begin 
+            self.num_train_batch += 1 
+            if self.num_train_batch >= len(self.learn.data.train_dl): 
+                self.profiler.enabled = False 
+
+    def on_epoch_end(self, epoch, **kwargs): 
+        train_time = self.train_end - self.start 
+        self.history.append({'epoch': epoch, 'train_time': train_time, 
+                             'phases': {name: {'calls': calls, 'total_ms': total_ms} 
+                                        for name, calls, total_ms, _ in self.profiler.summary()}})
+        message = '\nphases of the training steps, epoch %s (%0.1f s)\n%s' % (
+            epoch, train_time, self.profiler.format_summary(train_time))
+        if self.log is not None: 
+            self.log.write(message)
+        else: 
+            print(message)
+
+    def on_train_end(self, **kwargs): 
+        self.learn.model.profiler = None 
+        self.learn.data.train_dl.profiler = None 
+        if self.trace_path is not None: 
+            self.profiler.export_chrome_trace(self.trace_path)
@@ -5,10 +5,17 @@ from .lib.net.rate import *
 
 
 #---------------------------------------------------------------------------------
-COMMON_STRING ='@%s:  \n' % os.path.basename(__file__)
-
-if 1:
-    SEED = int(time.time()) #35202   #35202  #123  #
+# Importing mpnn_model has no side effect : the random seeds and the cudnn flags are only set by the training 
+# scripts, with set_environment 
+def set_environment(seed=None):
+    '''
+    Seed the random generators (default: seed from the current time) and set the cudnn flags
+    Returns: 
+        SEED, COMMON_STRING: the seed and a description of the environment for the log file 
+    '''
+    COMMON_STRING ='@%s:  \n' % os.path.basename(__file__)
+
+    SEED = int(time.time()) if seed is None else seed #35202   #35202  #123  #
     random.seed(SEED)
     np.random.seed(SEED)
     torch.manual_seed(SEED)
@@ -26,20 +33,18 @@ if 1:
     COMMON_STRING += '\t\ttorch.backends.cudnn.version() = %s\n'%torch.backends.cudnn.version()
     try:
         COMMON_STRING += '\t\tos[\'CUDA_VISIBLE_DEVICES\']     = %s\n'%os.environ['CUDA_VISIBLE_DEVICES']
-        NUM_CUDA_DEVICES = len(os.environ['CUDA_VISIBLE_DEVICES'].split(','))
     except Exception:
         COMMON_STRING += '\t\tos[\'CUDA_VISIBLE_DEVICES\']     = None\n'
-        NUM_CUDA_DEVICES = 1
 
     COMMON_STRING += '\t\ttorch.cuda.device_count()      = %d\n'%torch.cuda.device_count()
     #print ('\t\ttorch.cuda.current_device()    =', torch.cuda.current_device())
 
-
-COMMON_STRING += '\n'
+    COMMON_STRING += '\n'
+    return SEED, COMMON_STRING
 
 #---------------------------------------------------------------------------------
 ## useful : http://forums.fast.ai/t/model-visualization/12365/2
 
 
 if __name__ == '__main__':
-    print (COMMON_STRING)
\ No newline at end of file
+    print (set_environment()[1])
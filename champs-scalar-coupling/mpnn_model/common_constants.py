@@ -19,8 +19,9 @@ NUM_COUPLING_TYPE = len(COUPLING_TYPE_STATS)//5
 COUPLING_TYPE      = [ COUPLING_TYPE_STATS[i*5  ] for i in range(NUM_COUPLING_TYPE)]
 REVERSE_COUPLING_TYPE = dict(zip(range(8), COUPLING_TYPE))
 
-COUPLING_TYPE_MEAN = torch.tensor([COUPLING_TYPE_STATS[i*5+1] for i in range(NUM_COUPLING_TYPE)], dtype=torch.float32).cuda()
-COUPLING_TYPE_STD  =  torch.tensor([ COUPLING_TYPE_STATS[i*5+2] for i in range(NUM_COUPLING_TYPE)], dtype=torch.float32).cuda()
+# cpu tensors : moved to the device of the predictions where they are used 
+COUPLING_TYPE_MEAN = torch.tensor([COUPLING_TYPE_STATS[i*5+1] for i in range(NUM_COUPLING_TYPE)], dtype=torch.float32)
+COUPLING_TYPE_STD  =  torch.tensor([ COUPLING_TYPE_STATS[i*5+2] for i in range(NUM_COUPLING_TYPE)], dtype=torch.float32)
 
 COUPLING_MIN_ = [ COUPLING_TYPE_STATS[i*5+3  ] for i in range(NUM_COUPLING_TYPE)]
 COUPLING_MAX_ = [ COUPLING_TYPE_STATS[i*5+4  ] for i in range(NUM_COUPLING_TYPE)]
@@ -111,6 +111,12 @@ class CustomTabularModel(nn.Module):
         return [self.n_emb + self.n_cont] + layers + [out_sz]
 
     def forward(self, x_cat:Tensor, x_cont:Tensor) -> Tensor:
+        x = self.encode_inputs(x_cat, x_cont)
+        x = self.layers(x)
+        return x
+
+    def encode_inputs(self, x_cat:Tensor, x_cont:Tensor) -> Tensor:
+        "Embeddings of the categorical variables concatenated with the normalized continuous ones: input of `layers`"
         #self.bsn(x_cat)
 
         if self.n_emb != 0:
@@ -120,7 +126,6 @@ class CustomTabularModel(nn.Module):
         if self.n_cont != 0:
             x_cont = self.bn_cont(x_cont)
             x = torch.cat([x, x_cont], 1) if self.n_emb != 0 else x_cont
-        x = self.layers(x)
         return x
     
     
@@ -142,7 +147,7 @@ def get_node_encoder(encoding, emb_sz, n_cont, node_dim, layers, activation, dro
         return CustomTabularModel(emb_szs = emb_sz, out_sz=2, n_cont=n_cont, layers=layers, ps=[dropout], emb_drop=0.)
 
 
-def get_edge_encoder(encoding, emb_sz, n_cont,  node_dim, edge_dim,  layers, activation, dropout=0.):
+def get_edge_encoder(encoding, emb_sz, n_cont,  node_dim, edge_dim,  layers, activation, dropout=0., out_dim=None):
     '''
     Get the MLP network to process edges features and build matrix representation
     Arguments:
@@ -154,10 +159,12 @@ def get_edge_encoder(encoding, emb_sz, n_cont,  node_dim, edge_dim,  layers, act
         - layers: list of int, the dimensions of hidden layers 
         - activation: str,  the activation to apply for layers. 
         - dropout: [float],   dropout of each hidden layer. 
+        - out_dim: int, the output dimension (default: node_dim*node_dim, a node_dim x node_dim matrix per edge)
     '''
+    out_dim = node_dim*node_dim if out_dim is None else out_dim
     if encoding == 'one_hot':
-        return  MlpBn(edge_dim, dimensions=layers+[node_dim*node_dim], activation=activation, dropout=dropout) 
+        return  MlpBn(edge_dim, dimensions=layers+[out_dim], activation=activation, dropout=dropout) 
 
     elif encoding== 'label': 
         # emb_sz = [(5,8)]
-        return CustomTabularModel(emb_szs = emb_sz, n_cont=n_cont , out_sz=2, layers=layers+[node_dim*node_dim], ps=[dropout], emb_drop=0.)
+        return CustomTabularModel(emb_szs = emb_sz, n_cont=n_cont , out_sz=2, layers=layers+[out_dim], ps=[dropout], emb_drop=0.)
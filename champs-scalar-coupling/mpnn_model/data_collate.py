@@ -3,13 +3,56 @@ import torch.nn.functional as F
 
 from mpnn_model.common import *
 from mpnn_model.common_constants import * 
-from mpnn_model.data import *
 
 import copy
 
 DATA_DIR = '/rapids/notebooks/srabhi/champs-2019/input'
 
-__all__ = ['tensor_collate_rnn', 'tensor_collate_baseline']
+__all__ = ['tensor_collate_rnn', 'tensor_collate_baseline', 'ragged_collate_rnn', 'ragged_collate_baseline', 
+           'sequence_mask', 'unpad_molecules', 'molecule_index']
+
+
+def sequence_mask(counts, max_len):
+    """
+    Boolean mask [len(counts), max_len] of the valid rows of each padded molecule, built on the device of counts 
+    """
+    return torch.arange(max_len, device=counts.device).unsqueeze(0) < counts.unsqueeze(1)
+
+
+def unpad_molecules(batch_node, batch_edge, batch_coupling, batch_num_node, batch_num_edge, batch_num_coupling):
+    """
+    Remove the padding of a batch of molecules with vectorized masks and offsets, on the device of the inputs
+    Args: 
+        batch_node [batch_size, NODE_MAX, node_dim], batch_edge [batch_size, EDGE_MAX, edge_dim], 
+        batch_coupling [batch_size, COUPLING_MAX, coupling_dim]: padded molecules 
+        batch_num_node, batch_num_edge, batch_num_coupling [batch_size]: number of valid rows of each molecule 
+    Returns: 
+        node, edge, coupling: the valid rows of the batch 
+        node_index [N_node], coupling_batch_index [N_coupling]: the molecule of each node / coupling 
+        edge_offset [N_edge], coupling_offset [N_coupling]: number of nodes of the previous molecules in the batch, 
+        to add to the atom indices of the edges / couplings 
+    """
+    node = batch_node[sequence_mask(batch_num_node, batch_node.shape[1])]
+    edge = batch_edge[sequence_mask(batch_num_edge, batch_edge.shape[1])]
+    coupling = batch_coupling[sequence_mask(batch_num_coupling, batch_coupling.shape[1])]
+    return (node, edge, coupling) + molecule_index(batch_num_node, batch_num_edge, batch_num_coupling)
+
+
+def molecule_index(batch_num_node, batch_num_edge, batch_num_coupling): 
+    """
+    Molecule of each node / coupling and node offset of each edge / coupling of a batch of unpadded molecules 
+    Returns: 
+        node_index [N_node], coupling_batch_index [N_coupling], edge_offset [N_edge], coupling_offset [N_coupling]
+    """
+    molecule = torch.arange(batch_num_node.shape[0], device=batch_num_node.device)
+    node_index = torch.repeat_interleave(molecule, batch_num_node)
+    coupling_batch_index = torch.repeat_interleave(molecule, batch_num_coupling)
+    
+    offset = batch_num_node.cumsum(0) - batch_num_node
+    edge_offset = torch.repeat_interleave(offset, batch_num_edge)
+    coupling_offset = torch.repeat_interleave(offset, batch_num_coupling)
+    return node_index, coupling_batch_index, edge_offset, coupling_offset
+
 
 def tensor_collate_rnn(batch, batch_size, COUPLING_MAX, mode='train'):
     """
@@ -23,6 +66,9 @@ def tensor_collate_rnn(batch, batch_size, COUPLING_MAX, mode='train'):
            edge_index [batch_size*molecules_num_edges,  2] : Index edges  of the same molecule
            node_index [batch_size*molecules_num_nodes,  1] : Index nodes of the same molecule 
            coupling_index
+           coupling_type_sequence, coupling_atomic : sequences of the coupling path (RNN model, [] for the baseline) 
+           batch_num_node [batch_size] : number of nodes of each molecule, its size gives the number of molecules 
+                                         of the batch without reading node_index back from the device 
        Y: 
            targets [N_coupling, 4]: tuple of four targets (scalar_coupling, coupling_gaussrank, coupling_contribs, coupling_type)
        Test info: 
@@ -35,20 +81,28 @@ def tensor_collate_rnn(batch, batch_size, COUPLING_MAX, mode='train'):
     batch_coupling = batch_coupling.reshape(-1, COUPLING_MAX, 21)
     batch_size = batch_node.shape[0]
     
-    #### Create nodes / edges / coupling masks : optimized V1 :  TO be optimized 
-    mask = torch.cat([F.pad(torch.ones(i, device='cuda'), (0,NODE_MAX-i)).unsqueeze(0) for i in batch_num_node], dim=0)
-    mask_coupling = torch.cat([F.pad(torch.ones(i, device='cuda'), (0,COUPLING_MAX-i)).unsqueeze(0) for i in batch_num_coupling], dim=0)
-    mask_edge = torch.cat([F.pad(torch.ones(i, device='cuda'), (0,EDGE_MAX-i)).unsqueeze(0) for i in batch_num_edge], dim=0)
-
     #### Build the output X:
-    # Get effective nodes / edges / coupling values : without padding 
-    node = batch_node[mask.bool()].view(-1, 7)
-    edge = batch_edge[mask_edge.bool()].view(-1, 5)
-    coupling = batch_coupling[mask_coupling.bool()].view(-1, 21)
-    
-    # node indices track nodes of the same molecule 
-    node_index = mask.nonzero()[:, 0]
-    
+    # Get effective nodes / edges / coupling values : without padding, with the molecule index and the node offset 
+    # of each row 
+    return _rnn_outputs(*unpad_molecules(batch_node, batch_edge, batch_coupling, 
+                                         batch_num_node, batch_num_edge, batch_num_coupling), batch_num_node, mode)
+
+
+def ragged_collate_rnn(batch, batch_size, COUPLING_MAX, mode='train'):
+    """
+    Same outputs as tensor_collate_rnn for a batch of the RaggedTensorBatchDataset : 
+        batch : node [N_node, 7], edge [N_edge, 5], coupling [N_coupling, 21] rows of the molecules, without padding 
+                and batch_num_node, batch_num_edge, batch_num_coupling
+    """
+    node, edge, coupling, batch_num_node, batch_num_edge, batch_num_coupling = batch
+    assert coupling.shape[1] == 21, \
+        'ragged couplings of %s columns: the RNN model needs the 21 columns with the coupling paths' %coupling.shape[1]
+    return _rnn_outputs(node.float(), edge, coupling, 
+                        *molecule_index(batch_num_node, batch_num_edge, batch_num_coupling), batch_num_node, mode)
+
+
+def _rnn_outputs(node, edge, coupling, node_index, batch_coupling_index, edge_offset, coupling_offset, batch_num_node, 
+                 mode): 
     # Get edges feats and indices 
     edge_feats = edge[:, 2:]
     edge_index = edge[:, :2].long()
@@ -58,23 +112,13 @@ def tensor_collate_rnn(batch, batch_size, COUPLING_MAX, mode='train'):
     num_coupling = coupling_index.shape[0]
     
     #get sequence of coupling type 
-    pad_vector = torch.zeros(num_coupling, device='cuda').long()-1
+    pad_vector = coupling.new_full((num_coupling,), -1).long()
     coupling_type_sequence =  torch.cat([pad_vector.view(-1,1), coupling[:, 14:17].long()], 1)
     
     
-    # batch_coupling_index : track coupling values of the same molecule 
-    batch_coupling_index = mask_coupling.nonzero()[:, 0]
-    
     # offset edge and coupling indices w.r.t to N of nodes in each molecule 
-    offset = torch.cat([torch.zeros(1, device='cuda').long(), batch_num_node[:-1]]).cumsum(0)
-    #edge 
-    expanded_offset = torch.cat([torch.zeros(num_edges, device='cuda')+offset[mol_index] for mol_index,num_edges in 
-                                 enumerate(batch_num_edge)], 0)
-    edge_index = torch.add(edge_index, expanded_offset.unsqueeze(1).long())
-    #coupling 
-    expanded_offset=torch.cat([torch.zeros(n_coupling, device='cuda')+offset[mol_index] for mol_index,n_coupling in 
-                               enumerate(batch_num_coupling)], 0)
-    coupling_index = torch.add(coupling_index, expanded_offset.unsqueeze(1).long())
+    edge_index = edge_index + edge_offset.unsqueeze(1)
+    coupling_index = coupling_index + coupling_offset.unsqueeze(1)
     # type_id 
     coupling_type = coupling[:, 2].long()
 
@@ -98,9 +142,11 @@ def tensor_collate_rnn(batch, batch_size, COUPLING_MAX, mode='train'):
 
     # mode flag to return additional information for test data 
     if mode == 'test':
-            return (node, edge_feats, edge_index, node_index, coupling_index, coupling_type_sequence, coupling_atomic), targets,  infor 
+            return (node, edge_feats, edge_index, node_index, coupling_index, coupling_type_sequence, coupling_atomic, 
+                    batch_num_node), targets,  infor 
 
-    return (node, edge_feats, edge_index, node_index, coupling_index, coupling_type_sequence, coupling_atomic),  targets
+    return (node, edge_feats, edge_index, node_index, coupling_index, coupling_type_sequence, coupling_atomic, 
+            batch_num_node),  targets
 
 def tensor_collate_baseline(batch, batch_size, COUPLING_MAX, mode='train'):
     """
@@ -114,6 +160,9 @@ def tensor_collate_baseline(batch, batch_size, COUPLING_MAX, mode='train'):
            edge_index [batch_size*molecules_num_edges,  2] : Index edges  of the same molecule
            node_index [batch_size*molecules_num_nodes,  1] : Index nodes of the same molecule 
            coupling_index
+           coupling_type_sequence, coupling_atomic : sequences of the coupling path (RNN model, [] for the baseline) 
+           batch_num_node [batch_size] : number of nodes of each molecule, its size gives the number of molecules 
+                                         of the batch without reading node_index back from the device 
        Y: 
            targets [N_coupling, 4]: tuple of four targets (scalar_coupling, coupling_gaussrank, coupling_contribs, coupling_type)
        Test info: 
@@ -126,39 +175,36 @@ def tensor_collate_baseline(batch, batch_size, COUPLING_MAX, mode='train'):
     batch_coupling = batch_coupling.reshape(-1, COUPLING_MAX, 10)
     batch_size = batch_node.shape[0]
     
-    #### Create nodes / edges / coupling masks : optimized V1 :  TO be optimized 
-    mask = torch.cat([F.pad(torch.ones(i, device='cuda'), (0,NODE_MAX-i)).unsqueeze(0) for i in batch_num_node], dim=0)
-    mask_coupling = torch.cat([F.pad(torch.ones(i, device='cuda'), (0,COUPLING_MAX-i)).unsqueeze(0) for i in batch_num_coupling], dim=0)
-    mask_edge = torch.cat([F.pad(torch.ones(i, device='cuda'), (0,EDGE_MAX-i)).unsqueeze(0) for i in batch_num_edge], dim=0)
-
     #### Build the output X:
-    # Get effective nodes / edges / coupling values : without padding 
-    node = batch_node[mask.bool()].view(-1, 7)
-    edge = batch_edge[mask_edge.bool()].view(-1, 5)
-    coupling = batch_coupling[mask_coupling.bool()].view(-1, 10)
-    
-    # node indices track nodes of the same molecule 
-    node_index = mask.nonzero()[:, 0]
-    
+    # Get effective nodes / edges / coupling values : without padding, with the molecule index and the node offset 
+    # of each row 
+    return _baseline_outputs(*unpad_molecules(batch_node, batch_edge, batch_coupling, 
+                                              batch_num_node, batch_num_edge, batch_num_coupling), batch_num_node, mode)
+
+
+def ragged_collate_baseline(batch, batch_size, COUPLING_MAX, mode='train'):
+    """
+    Same outputs as tensor_collate_baseline for a batch of the RaggedTensorBatchDataset : 
+        batch : node [N_node, 7], edge [N_edge, 5], coupling [N_coupling, 10] rows of the molecules, without padding 
+                and batch_num_node, batch_num_edge, batch_num_coupling
+    """
+    node, edge, coupling, batch_num_node, batch_num_edge, batch_num_coupling = batch
+    return _baseline_outputs(node.float(), edge, coupling, 
+                             *molecule_index(batch_num_node, batch_num_edge, batch_num_coupling), batch_num_node, mode)
+
+
+def _baseline_outputs(node, edge, coupling, node_index, batch_coupling_index, edge_offset, coupling_offset, 
+                      batch_num_node, mode): 
     # Get edges feats and indices 
     edge_feats = edge[:, 2:]
     edge_index = edge[:, :2].long()
     
     # Get coupling index 
     coupling_index = coupling[:, :2].long()
-    # batch_coupling_index : track coupling values of the same molecule 
-    batch_coupling_index = mask_coupling.nonzero()[:, 0]
     
     # offset edge and coupling indices w.r.t to N of nodes in each molecule 
-    offset = torch.cat([torch.zeros(1, device='cuda').long(), batch_num_node[:-1]]).cumsum(0)
-    #edge 
-    expanded_offset = torch.cat([torch.zeros(num_edges, device='cuda')+offset[mol_index] for mol_index,num_edges in 
-                                 enumerate(batch_num_edge)], 0)
-    edge_index = torch.add(edge_index, expanded_offset.unsqueeze(1).long())
-    #coupling 
-    expanded_offset=torch.cat([torch.zeros(n_coupling, device='cuda')+offset[mol_index] for mol_index,n_coupling in 
-                               enumerate(batch_num_coupling)], 0)
-    coupling_index = torch.add(coupling_index, expanded_offset.unsqueeze(1).long())
+    edge_index = edge_index + edge_offset.unsqueeze(1)
+    coupling_index = coupling_index + coupling_offset.unsqueeze(1)
     # type_id 
     coupling_type = coupling[:, 2].long()
 
@@ -183,7 +229,9 @@ def tensor_collate_baseline(batch, batch_size, COUPLING_MAX, mode='train'):
     coupling_type_sequence, coupling_atomic = [], []
     # mode flag to return additional information for test data 
     if mode == 'test':
-            return (node, edge_feats, edge_index, node_index, coupling_index, coupling_type_sequence, coupling_atomic), targets,  infor 
+            return (node, edge_feats, edge_index, node_index, coupling_index, coupling_type_sequence, coupling_atomic, 
+                    batch_num_node), targets,  infor 
 
-    return (node, edge_feats, edge_index, node_index, coupling_index, coupling_type_sequence, coupling_atomic),  targets
+    return (node, edge_feats, edge_index, node_index, coupling_index, coupling_type_sequence, coupling_atomic, 
+            batch_num_node),  targets
 
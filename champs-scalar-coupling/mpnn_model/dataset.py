@@ -25,10 +25,14 @@ from fastai import *
 
 import copy
 
+from mpnn_model.profiling import phase
+
 #EDGE_DIM   =  6
 #NODE_DIM   = 13 ##  93  13
 NUM_TARGET =  8  ## for 8 bond's types 
 NODE_MAX, EDGE_MAX, COUPLING_MAX = 32, 816, 136
+SHUFFLE_MODES = ('reorder', 'random', 'block')
+PACKING_MODES = (None, 'greedy', 'ffd')
 
 DATA_DIR = '/rapids/notebooks/srabhi/champs-2019/input'
 
@@ -62,6 +66,91 @@ class BatchDataset(object):
 
     def shuffle(self):
         raise NotImplementedError
+
+
+def pack_molecules(sizes, budget, order, method='greedy', bucket_size=1024): 
+    """
+    Pack molecules into batches whose total number of nodes / edges / couplings stays under `budget`
+    Args: 
+        sizes (array):  [num_molecules, 3] the num_node, num_edge, num_coupling of each molecule 
+        budget (list): the 3 limits of a batch, None for no limit 
+        order (array): the molecules to pack, in the order they are visited 
+        method: 'greedy': next-fit, close the current batch when the next molecule does not fit 
+                'ffd': first-fit-decreasing within buckets of `bucket_size` molecules of `order` 
+    Returns: 
+        list of arrays of molecule indices, a molecule larger than the budget gets a batch of its own 
+    """
+    limit = [float('inf') if b is None else b for b in budget]
+    sizes_list = sizes.tolist()
+    batches = []
+    if method == 'greedy': 
+        current, load = [], [0, 0, 0]
+        for i in order.tolist(): 
+            n, e, c = sizes_list[i]
+            if current and (load[0] + n > limit[0] or load[1] + e > limit[1] or load[2] + c > limit[2]): 
+                batches.append(current)
+                current, load = [], [0, 0, 0]
+            current.append(i)
+            load = [load[0] + n, load[1] + e, load[2] + c]
+        if current: 
+            batches.append(current)
+            
+    elif method == 'ffd': 
+        # decreasing w.r.t the fraction of the budget used by the molecule 
+        fraction = (sizes / np.array(limit, dtype=np.float64)).max(axis=1)
+        for start in range(0, len(order), bucket_size): 
+            bucket = order[start:start + bucket_size]
+            bucket = bucket[np.argsort(-fraction[bucket], kind='stable')]
+            bins, loads = [], []
+            for i in bucket.tolist(): 
+                n, e, c = sizes_list[i]
+                for b, load in enumerate(loads): 
+                    if load[0] + n <= limit[0] and load[1] + e <= limit[1] and load[2] + c <= limit[2]: 
+                        bins[b].append(i)
+                        loads[b] = [load[0] + n, load[1] + e, load[2] + c]
+                        break
+                else: 
+                    bins.append([i])
+                    loads.append([n, e, c])
+            batches.extend(bins)
+    else: 
+        raise Exception(f"""{method} invalid packing method""")
+    return [np.array(b, dtype=np.int64) for b in batches]
+
+
+def equalize_batches(batches, sizes, budget, num_batches): 
+    """
+    Bring the packed `batches` to exactly `num_batches` batches: split the fullest batch in two while there are too 
+    few, merge the two emptiest ones while there are too many (the merged batch may exceed the budget). 
+    The fullness of a batch is the largest fraction of the budget it uses. 
+    """
+    limit = np.array([float('inf') if b is None else b for b in budget], dtype=np.float64)
+    batches = list(batches)
+    load = lambda b: (sizes[b].sum(axis=0) / limit).max()
+    while len(batches) < num_batches: 
+        i = max((i for i in range(len(batches)) if len(batches[i]) > 1), key=lambda i: load(batches[i]))
+        batches[i:i+1] = np.array_split(batches[i], 2)
+    while len(batches) > num_batches: 
+        loads = [load(b) for b in batches]
+        i, j = sorted(np.argsort(loads)[:2].tolist())
+        batches[i] = np.concatenate([batches[i], batches.pop(j)])
+    return batches
+
+
+def block_permutation(num_samples, block_size, device=None):
+    """Returns a permutation of ``range(num_samples)`` that visits blocks of ``block_size``
+    contiguous rows in random order and the rows inside each block in random order.
+    ``block_size=1`` gives a uniformly random permutation."""
+    if block_size <= 1:
+        return torch.randperm(num_samples, dtype=torch.int64, device=device)
+    num_blocks = (num_samples + block_size - 1) // block_size
+    block_start = torch.randperm(num_blocks, dtype=torch.int64, device=device) * block_size
+    offset = torch.rand(num_blocks, block_size, device=device).argsort(dim=1)
+    idx = (block_start.unsqueeze(1) + offset).view(-1)
+    # the last block may be partial: drop the positions past the end of the data
+    return idx[idx < num_samples]
+
+
 #############################################################################################################
 #                                                                                                           #
 #                                             Batch dataset                                                 #
@@ -80,6 +169,28 @@ class TensorBatchDataset(BatchDataset):
             COUPLING_MAX: dimension of molecule coupling features vector 
             mode: ['train', 'test']: when mode == 'test' return addition infor vector with coupling observations ids 
             csv:  ['train', 'test']: source of data 
+            shuffle_mode: ['reorder', 'random', 'block']: how the data is randomized each epoch 
+                    'reorder': gather every tensor into the new order (briefly holds two copies of the data)
+                    'random': keep the tensors in place and gather each batch through a stored permutation  
+                    'block': as 'random', but shuffle blocks of `block_size` contiguous molecules, then the molecules 
+                             inside each block, so batches read from a few contiguous regions 
+            block_size: number of contiguous molecules per block when shuffle_mode == 'block' (default: batch_size)
+            packing: [None, 'greedy', 'ffd']: build batches under a node / edge / coupling budget instead of taking 
+                     `batch_size` molecules, so that each step does roughly the same amount of work. 
+                    'greedy': fill batches in the (shuffled) molecule order, starting a new one when a budget is exceeded
+                    'ffd': first-fit-decreasing packing within buckets of `bucket_size` shuffled molecules, tighter batches 
+                     The number of molecules per batch then varies. The number of batches is the one of the first 
+                     packing for every epoch (fastai sizes its lr schedule from it): the packing of an epoch splits 
+                     its fullest batches or merges its emptiest ones to match it. 
+            max_nodes, max_edges, max_couplings: budgets of a packed batch, None for no limit. When all three are None
+                     the node budget is batch_size times the mean number of nodes per molecule. 
+            bucket_size: number of molecules per bucket for packing == 'ffd' (default: 16*batch_size)
+            subset: LongTensor, the rows of the tensors which form the dataset, when the tensors are a molecule table 
+                    shared by several splits (see fold_cache). Shuffling and packing then move the subset only. 
+            gaussrank: [num_rows, COUPLING_MAX] tensor aligned with the rows of the tensors: replaces the 
+                    gaussrank_coupling field of the couplings of each batch (the gaussrank of a fold over a shared table)
+            coupling_type: type index: only keep the couplings of this type in each batch (per-type models over a 
+                    shared table) 
        
        Method __getitem__ returns: 
                  2 modes:
@@ -91,42 +202,101 @@ class TensorBatchDataset(BatchDataset):
             - Create the index matrices:  edge_index, node_index, to keep track the variable sizes of molecule graphs.
     """
 
-    def __init__(self, molecule_names, tensors, collate_fn, batch_size=1, pin_memory=False, COUPLING_MAX=136, mode = 'train', csv='train'):
+    def __init__(self, molecule_names, tensors, collate_fn, batch_size=1, pin_memory=False, COUPLING_MAX=136, mode = 'train', csv='train',
+                 shuffle_mode='reorder', block_size=None, packing=None, max_nodes=None, max_edges=None, max_couplings=None,
+                 bucket_size=None, subset=None, gaussrank=None, coupling_type=None):
         assert all(tensors[0].size(0) == tensor.size(0) for tensor in tensors)
+        assert shuffle_mode in SHUFFLE_MODES, 'shuffle_mode should be one of %s' %(SHUFFLE_MODES,)
+        assert packing in PACKING_MODES, 'packing should be one of %s' %(PACKING_MODES,)
 
         self.tensors = tensors
         self.batch_size = batch_size
-        self.num_samples = tensors[0].size(0)
+        self.subset = subset
+        self.num_samples = tensors[0].size(0) if subset is None else subset.size(0)
+        self.gaussrank = gaussrank
+        self.coupling_type = coupling_type
         self.mode = mode 
         self.csv = csv
         self.molecule_names = molecule_names
         self.COUPLING_MAX = COUPLING_MAX
         self.collate_fn = collate_fn
+        self.shuffle_mode = shuffle_mode
+        self.block_size = block_size if block_size is not None else batch_size
+        # molecule order of the current epoch for 'random' / 'block' shuffling, None means storage order
+        self.permutation = None
+        
+        self.packing = packing
+        if packing is not None: 
+            self.bucket_size = bucket_size if bucket_size is not None else 16 * batch_size
+            self.budget = [max_nodes, max_edges, max_couplings]
+            self._init_packing()
 
         if pin_memory:
             for tensor in self.tensors:
                 tensor.pin_memory()
 
     def __len__(self):
+        if self.packing is not None: 
+            return self.num_batches
         if self.num_samples % self.batch_size == 0:
             return self.num_samples // self.batch_size
         else:
             return self.num_samples // self.batch_size + 1
 
     def __getitem__(self, item):
+        if self.packing is not None: 
+            if item >= len(self): 
+                raise IndexError
+            start, end = self.batch_offsets[item], self.batch_offsets[item + 1]
+            return self.collate_fn(self._get_rows(start, end), end - start, self.COUPLING_MAX, self.mode)
         idx = item * self.batch_size
         # Need to handle odd sized batches if data isn't divisible by batchsize
         if idx < self.num_samples and (
                 idx + self.batch_size < self.num_samples or self.num_samples % self.batch_size == 0):
-            batch_data = [tensor[idx:idx + self.batch_size] for tensor in self.tensors]
+            batch_data = self._get_rows(idx, idx + self.batch_size)
 
         elif idx < self.num_samples and idx + self.batch_size > self.num_samples:
-            batch_data =  [tensor[idx:] for tensor in self.tensors]
+            batch_data = self._get_rows(idx, self.num_samples)
         else:
             raise IndexError
         return self.collate_fn(batch_data, self.batch_size, self.COUPLING_MAX, self.mode)
 
+    def _table_rows(self, start, end):
+        # rows of the tensors of the molecules start:end of the epoch order 
+        rows = slice(start, end) if self.permutation is None else self.permutation[start:end]
+        if self.subset is not None: 
+            rows = self.subset[rows]
+        return rows
+
+    def _get_rows(self, start, end):
+        rows = self._table_rows(start, end)
+        batch = [tensor[rows] for tensor in self.tensors]
+        if self.gaussrank is not None or self.coupling_type is not None: 
+            batch[2], batch[5] = self._select_couplings(batch[2], batch[5], rows)
+        return batch
+
+    def _select_couplings(self, coupling, num_coupling, rows): 
+        num_molecule = coupling.size(0)
+        coupling = coupling.view(num_molecule, self.COUPLING_MAX, -1)
+        if self.gaussrank is not None: 
+            # field 4 of a coupling : gaussrank_coupling 
+            coupling = coupling.clone()
+            coupling[:, :, 4] = self.gaussrank[rows].to(coupling.dtype)
+        if self.coupling_type is not None: 
+            # move the couplings of the type first, in their order, field 2 : coupling_type 
+            position = torch.arange(self.COUPLING_MAX, device=coupling.device).unsqueeze(0)
+            keep = (position < num_coupling.view(-1, 1)) & (coupling[:, :, 2] == self.coupling_type)
+            order = (position + (~keep).long() * self.COUPLING_MAX).argsort(dim=1)
+            coupling = torch.gather(coupling, 1, order.unsqueeze(2).expand_as(coupling))
+            num_coupling = keep.sum(1).to(num_coupling.dtype)
+        return coupling.reshape(num_molecule, -1), num_coupling
+
+    def _column(self, i): 
+        # column i of the molecules of the dataset 
+        return self.tensors[i] if self.subset is None else self.tensors[i][self.subset]
+
     def __add__(self, tensors):
+        assert self.subset is None, 'add the rows to the shared table instead'
         assert all(tensors[0].size(0) == tensor.size(0) for tensor in tensors)
         assert len(self.tensors) == len(tensors)
         assert all(self_tensor[0].shape == tensor[0].shape for self_tensor, tensor in zip(self.tensors, tensors))
@@ -134,23 +304,82 @@ class TensorBatchDataset(BatchDataset):
         num_add_samples = tensors[0].size(0)
         self.num_samples = self.num_samples + num_add_samples
         self.tensors = [torch.cat((self_tensor, tensor)) for self_tensor, tensor in zip(self.tensors, tensors)]
+        self.permutation = None
+        if self.packing is not None: 
+            self._init_packing()
 
     def shuffle_max(self): 
-        num_nodes = self.tensors[4]  #num nodes 
+        if self.packing is not None: 
+            self._pack(self._epoch_permutation(), shuffle_batches=True, largest_first=True)
+            return 
+        num_nodes = self._column(4)  #num nodes 
         # sort tensors w.r.t the number of nodes in each molecule: Get larger ones first 
         sort_id = num_nodes.argsort(descending=True)
         # Compute the first batch
         first_batch_id = sort_id[:self.batch_size]
+        if self.shuffle_mode != 'reorder': 
+            # Keep the epoch permutation for the rest, without the molecules moved to the first batch 
+            idx = self._epoch_permutation()
+            is_rest = torch.ones(self.num_samples, dtype=torch.bool, device=idx.device)
+            is_rest[first_batch_id.to(idx.device)] = False
+            self.permutation = torch.cat([first_batch_id.to(idx.device), idx[is_rest[idx]]])
+            return 
         # Shuffle the rest of indices 
-        idx = sort_id[self.batch_size:][torch.randperm(self.num_samples-self.batch_size, dtype=torch.int64, device='cuda')]
+        idx = sort_id[self.batch_size:][torch.randperm(self.num_samples-self.batch_size, dtype=torch.int64, 
+                                                       device=sort_id.device)]
         final_idx = torch.cat([first_batch_id, idx])
         #print(final_idx.shape)
+        if self.subset is not None: 
+            self.subset = self.subset[final_idx.to(self.subset.device)]
+            return 
         self.tensors = [tensor[final_idx] for tensor in self.tensors]
         
     def shuffle(self):
-        idx = torch.randperm(self.num_samples, dtype=torch.int64, device='cuda')
+        if self.packing is not None: 
+            self._pack(self._epoch_permutation(), shuffle_batches=True)
+            return 
+        if self.shuffle_mode != 'reorder': 
+            self.permutation = self._epoch_permutation()
+            return 
+        if self.subset is not None: 
+            self.subset = self.subset[torch.randperm(self.num_samples, dtype=torch.int64, device=self.subset.device)]
+            return 
+        idx = torch.randperm(self.num_samples, dtype=torch.int64, device=self.tensors[0].device)
         self.tensors = [tensor[idx] for tensor in self.tensors]
 
+    def _epoch_permutation(self): 
+        block_size = self.block_size if self.shuffle_mode == 'block' else 1
+        device = self.tensors[0].device if self.subset is None else self.subset.device
+        return block_permutation(self.num_samples, block_size, device=device)
+
+    def _init_packing(self): 
+        # per molecule [num_node, num_edge, num_coupling], kept on cpu for packing 
+        self.molecule_sizes = torch.stack([self._column(3), self._column(4), self._column(5)], 1).long().cpu().numpy()
+        if all(b is None for b in self.budget): 
+            self.budget = [int(self.batch_size * self.molecule_sizes[:, 0].mean()), None, None]
+        # pack in storage order until the first shuffle, which sets the number of batches of every epoch 
+        self.num_batches = None 
+        self._pack(torch.arange(self.num_samples))
+        self.num_batches = len(self.batch_offsets) - 1 
+
+    def _pack(self, order, shuffle_batches=False, largest_first=False): 
+        """
+        Pack the molecules visited in `order` into batches and store them as one permutation of the molecules 
+        with the offsets of each batch in it. 
+        """
+        batches = pack_molecules(self.molecule_sizes, self.budget, order.cpu().numpy(), self.packing, self.bucket_size)
+        if self.num_batches is not None: 
+            batches = equalize_batches(batches, self.molecule_sizes, self.budget, self.num_batches)
+        if shuffle_batches: 
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        if largest_first: 
+            # Put the batch with most nodes first so that its memory is allocated at the start of the epoch 
+            largest = int(np.argmax([self.molecule_sizes[b, 0].sum() for b in batches]))
+            batches.insert(0, batches.pop(largest))
+        self.batch_offsets = np.cumsum([0] + [len(b) for b in batches]).tolist()
+        device = self.tensors[0].device if self.subset is None else self.subset.device
+        self.permutation = torch.from_numpy(np.concatenate(batches)).to(device)
+
     def get_total_samples(self): 
         """
         Update total sample of dataset with the total number of coupling obs 
@@ -163,6 +392,81 @@ class TensorBatchDataset(BatchDataset):
         return mask
 
 
+class RaggedTensorBatchDataset(TensorBatchDataset):
+    """Batch Dataset over molecules stored without padding (CSR layout).
+        Args:
+            molecule_names: names of the molecules 
+            tensors (Tensor): 6 tensors are needed: 
+                                node [N_node, node_dim], edge [N_edge, edge_dim], coupling [N_coupling, coupling_dim]: 
+                                    the rows of all the molecules concatenated in molecule order 
+                                num_node, num_edge, num_coupling [num_molecules]: number of rows of each molecule 
+            collate_fn: ragged_collate_baseline, or ragged_collate_rnn for couplings with the 21 columns of the paths 
+                        (build_ragged_frame writes the 10 columns of the baseline model)
+            Other arguments as TensorBatchDataset: the shuffling and packing only move the per-molecule offsets and 
+            counts, the concatenated rows are gathered for each batch. 
+    """
+    def __init__(self, molecule_names, tensors, collate_fn, batch_size=1, pin_memory=False, **kwargs):
+        assert all(kwargs.get(arg) is None for arg in ['subset', 'gaussrank', 'coupling_type']), \
+            'subset, gaussrank and coupling_type are only supported for padded molecules'
+        self.rows = tensors[:3]
+        num_node, num_edge, num_coupling = tensors[3:]
+        offsets = [count.cumsum(0) - count for count in (num_node, num_edge, num_coupling)]
+        assert all(int(count.sum()) == rows.size(0) for count, rows in zip(tensors[3:], self.rows))
+        super(RaggedTensorBatchDataset, self).__init__(molecule_names, offsets + [num_node, num_edge, num_coupling], 
+                                                       collate_fn, batch_size=batch_size, pin_memory=pin_memory, **kwargs)
+        if pin_memory: 
+            for tensor in self.rows: 
+                tensor.pin_memory()
+
+    def _get_rows(self, start, end): 
+        molecules = super(RaggedTensorBatchDataset, self)._get_rows(start, end)
+        counts = molecules[3:]
+        rows = [tensor[ragged_index(offset, count)] for tensor, offset, count in zip(self.rows, molecules[:3], counts)]
+        return rows + counts
+
+    def __add__(self, tensors): 
+        num_node, num_edge, num_coupling = tensors[3:]
+        offsets = [count.cumsum(0) - count + rows.size(0) for count, rows in zip(tensors[3:], self.rows)]
+        self.rows = [torch.cat((self_rows, rows)) for self_rows, rows in zip(self.rows, tensors[:3])]
+        super(RaggedTensorBatchDataset, self).__add__(offsets + [num_node, num_edge, num_coupling])
+
+
+def ragged_index(offset, count): 
+    """
+    Index of the rows of the molecules starting at `offset` with `count` rows each, in the order of the molecules
+    """
+    start = torch.repeat_interleave(offset - (count.cumsum(0) - count), count)
+    return start + torch.arange(start.size(0), device=start.device)
+
+
+def load_ragged(path, device='cuda'): 
+    """
+    Load the ragged molecules frames written by build_data/create_parquet.build_ragged_frame
+    Returns: 
+        molecule_names, [node, edge, coupling, num_node, num_edge, num_coupling] tensors for RaggedTensorBatchDataset
+    """
+    molecules = pd.read_parquet(os.path.join(path, 'molecules.parquet'))
+    tensors = [torch.from_numpy(pd.read_parquet(os.path.join(path, '%s.parquet' %name)).values.astype(np.float32)) 
+               for name in ['nodes', 'edges', 'couplings']]
+    tensors += [torch.from_numpy(molecules[col].values.astype(np.int64)) for col in ['num_node', 'num_edge', 'num_coupling']]
+    return molecules.molecule_name.values, [tensor.to(device) for tensor in tensors]
+
+
+def load_padded(path, device='cuda'):
+    """
+    Load a padded molecules frame (one row per molecule: molecule_name, node_*, edge_*, coupling_*, num_nodes or 
+    num_node, num_edge, num_coupling) with pandas, for hosts without cudf
+    Returns:
+        molecule_names, [node, edge, coupling, num_node, num_edge, num_coupling] tensors for TensorBatchDataset
+    """
+    frame = pd.read_parquet(path)
+    tensors = [torch.from_numpy(frame.filter(regex='^%s_[0-9]+$' %prefix).values.astype(np.float32))
+               for prefix in ['node', 'edge', 'coupling']]
+    num_node = 'num_nodes' if 'num_nodes' in frame.columns else 'num_node'
+    tensors += [torch.from_numpy(frame[col].values.astype(np.int64)) for col in [num_node, 'num_edge', 'num_coupling']]
+    return frame.molecule_name.values, [tensor.to(device) for tensor in tensors]
+
+
 
 #############################################################################################################
 #                                                                                                           #
@@ -196,6 +500,8 @@ class BatchDataLoader(object):
         self.pin_memory = pin_memory
         self.drop_last = drop_last
         self.device = device
+        # PhaseProfiler of the collate / h2d phases, see mpnn_model.profiling and the ProfilePhases callback 
+        self.profiler = None 
 
 
     def __iter__(self):
@@ -218,6 +524,7 @@ class _BatchDataLoaderIter(object):
         self.pin_memory = loader.pin_memory and torch.cuda.is_available()
         self.drop_last = loader.drop_last
         self.device = loader.device
+        self.profiler = loader.profiler
         
         if loader.max_first: 
             self.batchdataset.shuffle_max()
@@ -237,18 +544,20 @@ class _BatchDataLoaderIter(object):
     def __next__(self):
         if self.idx >= len(self):
             raise StopIteration
-        if self.batchdataset.mode == 'test':
-            X, y, infor = self.batchdataset[self.idx]
-            batch = (X, y)
-        else: 
-            batch = self.batchdataset[self.idx]
+        with phase(self.profiler, 'collate'):
+            if self.batchdataset.mode == 'test':
+                X, y, infor = self.batchdataset[self.idx]
+                batch = (X, y)
+            else: 
+                batch = self.batchdataset[self.idx]
         # Note Pinning memory was ~10% _slower_ for the test examples I explored
         if self.pin_memory:
             batch = _utils.pin_memory.pin_memory_batch(batch)
         self.idx = self.idx+1
         
         # move the batch data to device 
-        batch = to_device(batch, self.device)
+        with phase(self.profiler, 'h2d'):
+            batch = to_device(batch, self.device)
         # return in the form of : xb,yb = (x_cat, x_cont), y
         if self.batchdataset.mode == 'test':
             return batch, infor
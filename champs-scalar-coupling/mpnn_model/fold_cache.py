@@ -0,0 +1,188 @@
+#
+#
+#      Memory-mapped molecule table shared by the folds and per-type splits
+#
+# One-time conversion of the padded parquet frames of a data directory :
+#     data_dir/fold_<k>/train.parquet, data_dir/fold_<k>/validation.parquet, data_dir/test.parquet
+# into a cache directory of .npy files :
+#     molecule_name.npy, node.npy, edge.npy, coupling.npy, num_node.npy, num_edge.npy, num_coupling.npy :
+#                       the molecule table, every train and test molecule once
+#     fold_<k>/train.npy, fold_<k>/validation.npy : rows of the table of the split
+#     fold_<k>/gaussrank.npy : [num_molecules, COUPLING_MAX] gaussrank_coupling of the fold (the gaussrank map is
+#                       fitted per fold, the other coupling fields are the same for all the folds)
+#     fold_<k>/<type>/train.npy, fold_<k>/<type>/validation.npy : rows of the molecules with couplings of the type
+#     test.npy, test_<type>.npy : rows of the test molecules, of the test molecules with couplings of the type
+#     cache.json : dimensions and folds
+#
+# The training jobs memory-map the table (FoldCache), so that the jobs of all the folds and types share one copy
+# on disk and in the page cache, and gather the rows of each batch.
+#
+#####################################################################################
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+
+from mpnn_model.common_constants import COUPLING_TYPE
+from mpnn_model.dataset import TensorBatchDataset
+
+__all__ = ['build_fold_cache', 'FoldCache']
+
+# fields of a padded coupling vector
+COUPLING_TYPE_FIELD, GAUSSRANK_FIELD = 2, 4
+
+
+def _padded_columns(path):
+    """ node_*, edge_*, coupling_* and count columns of a padded parquet frame, from its schema """
+    import pyarrow.parquet as pq
+    names = pq.ParquetFile(path).schema_arrow.names
+    columns = {prefix: [c for c in names if c.startswith(prefix + '_') and c[len(prefix) + 1:].isdigit()]
+               for prefix in ['node', 'edge', 'coupling']}
+    columns['num_node'] = 'num_nodes' if 'num_nodes' in names else 'num_node'
+    return columns
+
+
+def _iter_frames(path, columns, batch_size):
+    """ the row groups of a parquet file as pandas frames of at most batch_size rows """
+    import pyarrow.parquet as pq
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns):
+        yield batch.to_pandas()
+
+
+def _num_rows(path):
+    import pyarrow.parquet as pq
+    return pq.ParquetFile(path).metadata.num_rows
+
+
+def build_fold_cache(data_dir, cache_dir, folds, COUPLING_MAX=136, batch_size=4096):
+    """
+    Build the cache of data_dir in cache_dir: the table is filled from the frames of the first fold and the test
+    frame, only the molecule names and gaussrank fields are read from the frames of the other folds.
+    """
+    first = [os.path.join(data_dir, 'fold_%s' % folds[0], '%s.parquet' % split) for split in ['train', 'validation']]
+    sources = first + [os.path.join(data_dir, 'test.parquet')]
+    columns = _padded_columns(sources[0])
+    coupling_dim = len(columns['coupling']) // COUPLING_MAX
+    num_molecules = sum(_num_rows(path) for path in sources)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # molecule table
+    table = {name: np.lib.format.open_memmap(os.path.join(cache_dir, '%s.npy' % name), mode='w+', dtype=np.float32,
+                                             shape=(num_molecules, len(columns[name])))
+             for name in ['node', 'edge', 'coupling']}
+    counts = {name: np.zeros(num_molecules, dtype=np.int64) for name in ['num_node', 'num_edge', 'num_coupling']}
+    molecule_names = []
+    start = 0
+    for path in sources:
+        read = ['molecule_name', columns['num_node'], 'num_edge', 'num_coupling'] + \
+            columns['node'] + columns['edge'] + columns['coupling']
+        for frame in _iter_frames(path, read, batch_size):
+            end = start + len(frame)
+            for name in ['node', 'edge', 'coupling']:
+                table[name][start:end] = frame[columns[name]].values
+            counts['num_node'][start:end] = frame[columns['num_node']].values
+            counts['num_edge'][start:end] = frame['num_edge'].values
+            counts['num_coupling'][start:end] = frame['num_coupling'].values
+            molecule_names.append(np.asarray(frame['molecule_name'], dtype=str))
+            start = end
+    for array in table.values():
+        array.flush()
+    molecule_names = np.concatenate(molecule_names)
+    np.save(os.path.join(cache_dir, 'molecule_name.npy'), molecule_names)
+    for name, count in counts.items():
+        np.save(os.path.join(cache_dir, '%s.npy' % name), count)
+    row_of = pd.Index(molecule_names)
+    assert row_of.is_unique, 'a molecule is in several frames'
+
+    # couplings types of each molecule, for the per-type splits
+    coupling = table['coupling'].reshape(num_molecules, COUPLING_MAX, coupling_dim)
+    has_type = np.zeros((num_molecules, len(COUPLING_TYPE)), dtype=bool)
+    for s in range(0, num_molecules, batch_size):
+        valid = np.arange(COUPLING_MAX)[None] < counts['num_coupling'][s:s + batch_size, None]
+        types = coupling[s:s + batch_size, :, COUPLING_TYPE_FIELD].astype(np.int64)
+        for t in range(len(COUPLING_TYPE)):
+            has_type[s:s + batch_size, t] = ((types == t) & valid).any(1)
+
+    # folds : rows of each split, gaussrank of the fold
+    gaussrank_columns = columns['coupling'][GAUSSRANK_FIELD::coupling_dim]
+    for fold in folds:
+        fold_dir = os.path.join(cache_dir, 'fold_%s' % fold)
+        os.makedirs(fold_dir, exist_ok=True)
+        gaussrank = np.lib.format.open_memmap(os.path.join(fold_dir, 'gaussrank.npy'), mode='w+', dtype=np.float32,
+                                              shape=(num_molecules, COUPLING_MAX))
+        for split in ['train', 'validation']:
+            rows = []
+            for frame in _iter_frames(os.path.join(data_dir, 'fold_%s' % fold, '%s.parquet' % split),
+                                      ['molecule_name'] + gaussrank_columns, batch_size):
+                split_rows = row_of.get_indexer(np.asarray(frame['molecule_name'], dtype=str))
+                assert (split_rows >= 0).all(), 'fold %s has molecules which are not in the first fold' % fold
+                gaussrank[split_rows] = frame[gaussrank_columns].values
+                rows.append(split_rows)
+            rows = np.concatenate(rows).astype(np.int64)
+            np.save(os.path.join(fold_dir, '%s.npy' % split), rows)
+            for t, type_ in enumerate(COUPLING_TYPE):
+                os.makedirs(os.path.join(fold_dir, type_), exist_ok=True)
+                np.save(os.path.join(fold_dir, type_, '%s.npy' % split), rows[has_type[rows, t]])
+        gaussrank.flush()
+
+    num_test = _num_rows(sources[-1])
+    rows = np.arange(num_molecules - num_test, num_molecules, dtype=np.int64)
+    np.save(os.path.join(cache_dir, 'test.npy'), rows)
+    for t, type_ in enumerate(COUPLING_TYPE):
+        np.save(os.path.join(cache_dir, 'test_%s.npy' % type_), rows[has_type[rows, t]])
+    with open(os.path.join(cache_dir, 'cache.json'), 'w') as f:
+        json.dump({'folds': list(folds), 'COUPLING_MAX': COUPLING_MAX, 'coupling_dim': coupling_dim,
+                   'num_molecules': int(num_molecules), 'data_dir': data_dir}, f, indent=2)
+
+
+class FoldCache(object):
+    """
+    Memory-mapped molecule table of build_fold_cache. The .npy files are mapped copy-on-write: the pages are read
+    from the page cache shared by all the jobs on the host and the batches gathered from them on cpu.
+    Args:
+        cache_dir: directory written by build_fold_cache
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, 'cache.json')) as f:
+            self.infor = json.load(f)
+        self.COUPLING_MAX = self.infor['COUPLING_MAX']
+        self.molecule_names = np.load(os.path.join(cache_dir, 'molecule_name.npy'))
+        self.tensors = [self._load('%s.npy' % name)
+                        for name in ['node', 'edge', 'coupling', 'num_node', 'num_edge', 'num_coupling']]
+
+    def _load(self, *path):
+        return torch.from_numpy(np.load(os.path.join(self.cache_dir, *path), mmap_mode='c'))
+
+    def rows(self, fold, split, type_=None):
+        """ rows of the table of a split: 'train', 'validation' of a fold (optionally of a coupling type), or 'test' """
+        if split == 'test':
+            return self._load('test.npy' if type_ is None else 'test_%s.npy' % type_)
+        path = ['fold_%s' % fold] + ([type_] if type_ is not None else []) + ['%s.npy' % split]
+        return self._load(*path)
+
+    def dataset(self, fold, split, collate_fn, batch_size, type_=None, mode='train', **kwargs):
+        """
+        TensorBatchDataset of a split over the shared table: the couplings of the batches get the gaussrank of the
+        fold, and only the couplings of type_ when given.
+        """
+        rows = self.rows(fold, split, type_)
+        gaussrank = None if split == 'test' else self._load('fold_%s' % fold, 'gaussrank.npy')
+        coupling_type = None if type_ is None else COUPLING_TYPE.index(type_)
+        return TensorBatchDataset(self.molecule_names[rows.numpy()], tensors=self.tensors, collate_fn=collate_fn,
+                                  batch_size=batch_size, COUPLING_MAX=self.COUPLING_MAX, mode=mode,
+                                  csv='test' if split == 'test' else 'train', subset=rows, gaussrank=gaussrank,
+                                  coupling_type=coupling_type, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build the memory-mapped fold cache of a padded parquet directory')
+    parser.add_argument('data_dir', type=str, help='directory with fold_<k>/train.parquet, validation.parquet and test.parquet')
+    parser.add_argument('cache_dir', type=str)
+    parser.add_argument('--folds', type=int, nargs='+', default=[0, 1, 2, 3])
+    parser.add_argument('--COUPLING_MAX', type=int, default=136)
+    args = parser.parse_args()
+    build_fold_cache(args.data_dir, args.cache_dir, args.folds, args.COUPLING_MAX)
@@ -0,0 +1,312 @@
+#############################################################################################################
+#                                                                                                           #
+#                                   Batch inference of a trained Net on cpu                                 #
+#                                                                                                           #
+#############################################################################################################
+"""
+Standalone prediction of new molecule sets, without cuda and without the fastai Learner:
+    - load_net: the Net saved by the training scripts (full module or state dict)
+    - prepare_inference: fp32, dynamic int8 quantization and / or bf16 autocast inference modes
+    - export_torchscript: trace the Net with dynamic node / edge / coupling / molecule counts
+    - get_test_dataset: padded parquet frame or ragged directory -> TensorBatchDataset in 'test' mode
+    - FoldEnsemble: run the models of several folds on each collated batch and combine their predictions
+    - PredictionWriter: append the predictions of each batch to a csv(.gz) or parquet file
+    - run_inference: predict every batch, report molecules / sec and the p50 / p99 batch latency
+"""
+import copy
+import gzip
+import inspect
+import os
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+
+from mpnn_model.common_constants import COUPLING_TYPE_MEAN, COUPLING_TYPE_STD, REVERSE_COUPLING_TYPE
+
+__all__ = ['InferenceNet', 'load_net', 'prepare_inference', 'export_torchscript', 'load_torchscript', 
+           'get_test_dataset', 'FoldEnsemble', 'PredictionWriter', 'PredictionBuffer', 'run_inference', 
+           'latency_report', 'INFERENCE_MODES', 'ENSEMBLE_REDUCTIONS']
+
+INFERENCE_MODES = ('fp32', 'int8', 'bf16', 'int8_bf16')
+ENSEMBLE_REDUCTIONS = ('mean', 'median', 'stack')
+
+
+class InferenceNet(nn.Module):
+    """
+    Net with a single tensor output, the scalar coupling prediction of each coupling, as needed by the TorchScript
+    trace: the type predictions of predict_type models are gathered with the actual coupling type and normalized
+    predictions are mapped back to the coupling scale.
+    Inputs are the outputs X of the collate functions, without the empty sequence inputs of the baseline model.
+    With bf16, the Net runs under bfloat16 autocast on cpu and the predictions are returned in float32.
+    """
+    def __init__(self, net, normalize=False, bf16=False):
+        super(InferenceNet, self).__init__()
+        assert not bf16 or hasattr(torch, 'autocast'), \
+            'bf16 inference needs torch.autocast (torch >= 1.10), found torch %s' % torch.__version__
+        self.net = net
+        self.normalize = normalize
+        self.bf16 = bf16
+        self.register_buffer('coupling_mean', COUPLING_TYPE_MEAN.clone())
+        self.register_buffer('coupling_std', COUPLING_TYPE_STD.clone())
+
+    def forward(self, node, edge, edge_index, node_index, coupling_index, *inputs):
+        # the sequence inputs of the RNN model, then the number of nodes of each molecule
+        *sequence, batch_num_node = inputs
+        bond_type, x_atomic = sequence if sequence else ([], [])
+        if self.bf16:
+            with torch.autocast('cpu', dtype=torch.bfloat16):
+                predict = self.net(node, edge, edge_index, node_index, coupling_index, bond_type, x_atomic,
+                                   batch_num_node)[0]
+        else:
+            predict = self.net(node, edge, edge_index, node_index, coupling_index, bond_type, x_atomic,
+                               batch_num_node)[0]
+        predict = predict.float()
+        coupling_type = coupling_index[:, -2]
+        if self.net.predict_type:
+            predict = torch.gather(predict, 1, coupling_type.view(-1, 1))
+        predict = predict.view(-1)
+        if self.normalize:
+            predict = predict * self.coupling_std[coupling_type] + self.coupling_mean[coupling_type]
+        return predict
+
+
+def _load(path, device):
+    # full modules are pickled objects, not only weights
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        return torch.load(path, map_location=device, weights_only=False)
+    return torch.load(path, map_location=device)
+
+
+def load_net(path, cfg, device='cpu'):
+    """
+    Load a trained Net on device
+    Args:
+        path: the module saved with torch.save(learn.model, ...) by the training scripts, or a state dict
+              (fastai Learner.save keeps it under 'model')
+        cfg: the experiment config, used to build the Net of a state dict
+    """
+    checkpoint = _load(path, device)
+    if isinstance(checkpoint, nn.Module):
+        net = checkpoint
+    else:
+        from mpnn_model.model import Net
+        cfg = copy.deepcopy(cfg)
+        cfg['train']['device'] = device
+        net = Net(cfg, y_range=cfg['model']['y_range'])
+        # MessagePassing.bias is not a registered parameter of the cuda models: keep the one of the new Net
+        missing, unexpected = net.load_state_dict(checkpoint.get('model', checkpoint), strict=False)
+        assert not unexpected and set(missing) <= {'message_function.bias'}, (missing, unexpected)
+    net.device = device
+    return net.to(device).eval()
+
+
+def prepare_inference(net, mode='fp32', normalize=False):
+    """
+    InferenceNet of a copy of net for one of the INFERENCE_MODES:
+        'fp32': the trained model 
+        'int8': dynamic int8 quantization of the Linear layers (edge network, node encoder, regression head) and of 
+                the LSTM / GRU layers (BI_RNN_Nodes, Set2Set, GRUUpdate): int8 weights, activations quantized on the fly
+        'bf16': bfloat16 autocast on cpu 
+        'int8_bf16': both, the layers left in float run in bfloat16
+    """
+    assert mode in INFERENCE_MODES, 'inference mode should be one of %s' %(INFERENCE_MODES,)
+    net = copy.deepcopy(net).eval()
+    if 'int8' in mode:
+        net = torch.quantization.quantize_dynamic(net, {nn.Linear, nn.LSTM, nn.GRU}, dtype=torch.qint8)
+    return InferenceNet(net, normalize, bf16='bf16' in mode).eval()
+
+
+def export_torchscript(net, inputs, path=None, normalize=False):
+    """
+    Trace InferenceNet(net) (or an InferenceNet of prepare_inference) on the inputs X of one collated batch. The 
+    node / edge / coupling / molecule counts stay dynamic: the traced module predicts batches of any size.
+    """
+    model = (net if isinstance(net, InferenceNet) else InferenceNet(net, normalize)).eval()
+    inputs = tuple(x for x in inputs if torch.is_tensor(x))
+    with torch.no_grad():
+        traced = torch.jit.trace(model, inputs, check_trace=False)
+    traced = torch.jit.freeze(traced) if hasattr(torch.jit, 'freeze') else traced
+    if path is not None:
+        traced.save(path)
+    return traced
+
+
+def load_torchscript(path, device='cpu'):
+    return torch.jit.load(path, map_location=device).eval()
+
+
+def get_test_dataset(path, cfg, batch_size, device='cpu'):
+    """
+    TensorBatchDataset in 'test' mode of a padded parquet frame (file) or of ragged molecule frames (directory)
+    """
+    from mpnn_model.data_collate import tensor_collate_rnn, tensor_collate_baseline, ragged_collate_baseline
+    from mpnn_model.dataset import TensorBatchDataset, RaggedTensorBatchDataset, load_padded, load_ragged
+    rnn = cfg['model']['RNN']
+    if os.path.isdir(path):
+        # build_ragged_frame writes the coupling columns of the baseline model, not the paths of the RNN model
+        assert not rnn, 'the ragged molecule frames have no coupling path columns: use a padded frame for RNN models'
+        molecule_names, tensors = load_ragged(path, device=device)
+        return RaggedTensorBatchDataset(molecule_names, tensors, batch_size=batch_size, mode='test', csv='test',
+                                        collate_fn=ragged_collate_baseline)
+    molecule_names, tensors = load_padded(path, device=device)
+    return TensorBatchDataset(molecule_names, tensors, batch_size=batch_size, mode='test', csv='test',
+                              collate_fn=tensor_collate_rnn if rnn else tensor_collate_baseline)
+
+
+def reverse_gaussrank(grm, coupling_type, predict):
+    """ map the predictions (numpy arrays) back from the gaussrank scale of the GaussRankMap grm """
+    return grm.transform(predict, pd.Series(coupling_type).map(REVERSE_COUPLING_TYPE).values, from_coupling=False)
+
+
+class FoldEnsemble(object):
+    """
+    Predict each collated batch with the models of K folds (InferenceNet or TorchScript traces): the batch is 
+    collated and moved once for all the models. 
+    Args: 
+        models: the K fold models 
+        grms: the GaussRankMap of each fold for models trained on gaussrank targets: the predictions of each model 
+              are mapped back with the map of its fold before they are combined 
+        reduce: 'mean' / 'median' of the K predictions, or 'stack': [N_coupling, K] predictions 
+        parallel: run the K models in K threads (the torch ops release the GIL), otherwise one after the other. 
+                  Each thread uses torch.get_num_threads() intra-op threads: set it to the total / K 
+    """
+    def __init__(self, models, grms=None, reduce='mean', parallel=False):
+        assert reduce in ENSEMBLE_REDUCTIONS, 'reduce should be one of %s' %(ENSEMBLE_REDUCTIONS,)
+        assert grms is None or len(grms) == len(models)
+        self.models = models
+        self.grms = grms
+        self.reduce = reduce
+        self.pool = ThreadPoolExecutor(max_workers=len(models)) if parallel else None
+
+    def __call__(self, *inputs):
+        if self.pool is not None:
+            # grad mode is thread local: the worker threads do not inherit the no_grad of the caller
+            predicts = list(self.pool.map(lambda model: self._predict(model, inputs), self.models))
+        else:
+            predicts = [model(*inputs) for model in self.models]
+        if self.grms is not None:
+            coupling_type = inputs[4][:, -2].cpu().numpy()
+            predicts = [torch.from_numpy(reverse_gaussrank(grm, coupling_type, predict.cpu().numpy())).float()
+                        for grm, predict in zip(self.grms, predicts)]
+        predict = torch.stack(predicts, 1)
+        if self.reduce == 'mean':
+            return predict.mean(1)
+        if self.reduce == 'median':
+            return predict.median(1)[0]
+        return predict
+
+    @staticmethod
+    def _predict(model, inputs):
+        with torch.no_grad():
+            return model(*inputs)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+class PredictionWriter(object):
+    """
+    Append the predictions of each batch to `path`: csv (gzip compressed when path ends with .gz) or parquet
+    (one row group per batch). Columns: id, type, scalar_coupling_constant.
+    With a GaussRankMap `grm`, the predictions are mapped back from the gaussrank scale before writing.
+    Stacked [N_coupling, K] predictions (FoldEnsemble) are written as their mean and one column per model. 
+    """
+    def __init__(self, path, grm=None):
+        self.path = path
+        self.grm = grm
+        self.parquet = path.endswith('.parquet')
+        self.num_rows = 0
+        if self.parquet:
+            self.writer = None
+        else:
+            self.file = gzip.open(path, 'wt') if path.endswith('.gz') else open(path, 'w')
+
+    def write(self, ids, coupling_type, predict, coupling_value=None):
+        ids, coupling_type, predict = [x.detach().cpu().numpy() for x in (ids, coupling_type, predict)]
+        if self.grm is not None:
+            predict = reverse_gaussrank(self.grm, coupling_type, predict)
+        frame = pd.DataFrame({'id': ids.astype(np.int64), 'type': coupling_type.astype(np.int32),
+                              'scalar_coupling_constant': predict.reshape(len(ids), -1).mean(1).astype(np.float32)})
+        if predict.ndim == 2:
+            for k in range(predict.shape[1]):
+                frame['scalar_coupling_constant_%d' %k] = predict[:, k].astype(np.float32)
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            self.writer.write_table(table)
+        else:
+            frame.to_csv(self.file, header=self.num_rows == 0, index=False)
+        self.num_rows += len(frame)
+
+    def close(self):
+        if self.parquet:
+            if self.writer is not None:
+                self.writer.close()
+        else:
+            self.file.close()
+
+
+class PredictionBuffer(object):
+    """
+    Keep the predictions of each batch in memory, with the true coupling values, to score an inference mode 
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, ids, coupling_type, predict, coupling_value=None):
+        self.chunks.append([x.detach().cpu().numpy() for x in (ids, coupling_type, predict, coupling_value)])
+
+    def frame(self, grm=None):
+        """ id, type_ind, scalar_coupling_constant, true_scalar_coupling_constant of all the batches """
+        ids, coupling_type, predict, coupling_value = [np.concatenate(x) for x in zip(*self.chunks)]
+        if grm is not None:
+            from mpnn_model.callback import get_reverse_frame
+            return get_reverse_frame(ids, predict, coupling_type, coupling_value, grm)
+        return pd.DataFrame({'id': ids, 'type_ind': coupling_type, 'scalar_coupling_constant': predict,
+                             'true_scalar_coupling_constant': coupling_value})
+
+
+def run_inference(model, dataset, writer=None, warmup=1):
+    """
+    Predict every batch of a 'test' mode dataset with model (InferenceNet or its TorchScript trace).
+    The latency of a batch includes its collate. The first `warmup` batches (profiling runs of the TorchScript
+    executor) are predicted but left out of the timings.
+    Returns:
+        dict: molecules, couplings, seconds, molecules_per_sec, p50_ms, p99_ms
+    """
+    latency = []
+    num_molecules, num_couplings, timed_molecules = 0, 0, 0
+    with torch.no_grad():
+        for b in range(len(dataset)):
+            start = timer()
+            X, targets, infor = dataset[b]
+            inputs = [x for x in X if torch.is_tensor(x)]
+            predict = model(*inputs)
+            elapsed = timer() - start
+            if writer is not None:
+                writer.write(infor, targets[3], predict, targets[0])
+            batch_molecules = X[7].size(0)
+            num_molecules += batch_molecules
+            num_couplings += predict.size(0)
+            if b >= warmup:
+                latency.append(elapsed)
+                timed_molecules += batch_molecules
+    return dict(molecules=num_molecules, couplings=num_couplings, **latency_report(latency, timed_molecules))
+
+
+def latency_report(latency, num_molecules):
+    """ throughput and latency percentiles of the timed batches, latency: seconds per batch """
+    latency = np.array(latency if len(latency) else [np.nan])
+    seconds = float(np.nansum(latency))
+    return {'seconds': seconds,
+            'molecules_per_sec': num_molecules / seconds if seconds > 0 else float('nan'),
+            'p50_ms': float(np.percentile(latency, 50) * 1000),
+            'p99_ms': float(np.percentile(latency, 99) * 1000)}
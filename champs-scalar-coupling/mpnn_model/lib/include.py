@@ -4,14 +4,14 @@ PROJECT_PATH = os.path.dirname(os.path.realpath(__file__).replace('/lib',''))
 IDENTIFIER   = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
 
 
+# Only the libraries used by every module are imported here. The optional / slow ones (matplotlib, PIL, cv2, 
+# zipfile, multiprocessing, torch.nn.parallel) are imported by the functions that use them, on first call. 
+
 #numerical libs
 import math
 import numpy as np
 import random
-import PIL
 #import cv2
-import matplotlib
-print('matplotlib.get_backend : ', matplotlib.get_backend())
 
 # torch libs
 import torch
@@ -22,7 +22,6 @@ from torch.utils.data.sampler import *
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.nn.parallel.data_parallel import data_parallel
 
 from torch.nn.utils.rnn import *
 
@@ -36,12 +35,9 @@ import shutil
 from timeit import default_timer as timer
 import itertools
 from collections import OrderedDict
-from multiprocessing import Pool
-import multiprocessing as mp
 
 #from pprintpp import pprint, pformat
 import json
-import zipfile
 
 
 
@@ -50,14 +46,9 @@ import pandas as pd
 import pickle
 import glob
 import sys
-from distutils.dir_util import copy_tree
 import time
 
 
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-
-
 
 # constant #
 PI  = np.pi
@@ -298,6 +298,7 @@ if __name__ == '__main__':
 
 
     #plot
+    import matplotlib.pyplot as plt
     fig = plt.figure()
     plot_rates(fig, lrs, title=str(scheduler))
     plt.show()
@@ -3,7 +3,6 @@ import os
 os.environ['QT_XKB_CONFIG_ROOT']='/usr/share/X11/xkb/'
 
 from mpnn_model.lib.include import *
-import matplotlib.cm
 
 
 # draw -----------------------------------
@@ -117,8 +116,9 @@ def to_color(s, color=None):
     if type(color) in [str] or color is None:
         #https://matplotlib.org/xkcd/examples/color/colormaps_reference.html
 
+        import matplotlib.cm
         if color is None: color='cool'
-        color = matplotlib.get_cmap(color)(s)
+        color = matplotlib.cm.get_cmap(color)(s)
         b = int(255*color[2])
         g = int(255*color[1])
         r = int(255*color[0])
@@ -7,9 +7,13 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numbers
+from torch.utils.checkpoint import checkpoint
 
 
-__all__ = ['message_pass' , 'MessagePassing', 'GRUUpdate', 'Set2Set']
+__all__ = ['message_pass' , 'chunked_message_pass', 'low_rank_message_pass', 'sparse_edges', 'MessagePassing', 'GRUUpdate', 
+           'Set2Set', 'MESSAGE_KERNELS']
+
+MESSAGE_KERNELS = ('dense', 'chunked', 'low_rank')
 
 #############################################################################################################
 #                                                                                                           #
@@ -34,6 +38,87 @@ def message_pass(node_states, edge_index,  a_in):
     message = scatter_('mean', message, edge_index[1], dim_size=num_node)
     return message
 
+def chunked_message_pass(node_states, edge_index, edge_hidden, edge_head, chunk_size=4096):
+    """Computes the same messages as message_pass without materializing the matrices of all the edges.
+        The edge matrices are built from the last hidden layer of the edge network by slices of chunk_size edges, 
+        and built again in the backward pass (checkpointing): at most chunk_size matrices are alive at once. 
+      Args:
+        node_states: [batch_size*num_nodes, node_dim] tensor (h_{t-1})
+        edge_index [batch_size*num_edges, 2]: the indices of edges 
+        edge_hidden: [batch_size*num_edges, hidden_dim]: last hidden layer of the edge network 
+        edge_head: module mapping edge_hidden to the flattened node_dim x node_dim edge matrices 
+        chunk_size: number of edges processed at once 
+      Returns:
+        messages (torch.float32): [batch_size*num_nodes, node_dim] 
+    """
+    num_node, node_dim = node_states.shape
+    edge_index = edge_index.t().contiguous()
+    x_i  = torch.index_select(node_states, 0, edge_index[0])
+    
+    def edge_message(hidden, x): 
+        a_in = edge_head(hidden).view(-1, node_dim, node_dim)
+        return torch.matmul(x.view(-1,1,node_dim), a_in).view(-1, node_dim)
+    
+    # without autograd (inference) there is nothing to recompute 
+    run_chunk = checkpoint if torch.is_grad_enabled() else (lambda function, *args: function(*args))
+    message = torch.cat([run_chunk(edge_message, edge_hidden[start:start+chunk_size], x_i[start:start+chunk_size]) 
+                         for start in range(0, x_i.size(0), chunk_size)])
+    message = scatter_('mean', message, edge_index[1], dim_size=num_node)
+    return message
+
+def low_rank_message_pass(node_states, edge_index, u_in, v_in):
+    """Messages with rank-r edge matrices A(e_vw) = V_vw . U_vw, never built: 
+                a_t = sum_w (h^t . V_vw) . U_vw
+      Args:
+        node_states: [batch_size*num_nodes, node_dim] tensor (h_{t-1})
+        edge_index [batch_size*num_edges, 2]: the indices of edges 
+        u_in: [batch_size*num_edges, rank, node_dim], v_in: [batch_size*num_edges, node_dim, rank]: the edge factors 
+      Returns:
+        messages (torch.float32): [batch_size*num_nodes, node_dim] 
+    """
+    num_node, node_dim = node_states.shape
+    edge_index = edge_index.t().contiguous()
+    x_i  = torch.index_select(node_states, 0, edge_index[0])
+    message = torch.matmul(torch.matmul(x_i.view(-1,1,node_dim), v_in), u_in).view(-1, node_dim)
+    message = scatter_('mean', message, edge_index[1], dim_size=num_node)
+    return message
+
+def sparse_edges(edge, edge_index, num_node, cutoff=None, knn=None):
+    """Keeps the bonded edges, the edges shorter than cutoff and the edges (v, w) where w is among the knn nearest
+        atoms of v or v among the knn nearest atoms of w: the graph stays symmetric. Same rule as
+        data.make_edge_features, applied on a collated batch of fully connected molecules.
+      Args:
+        edge [batch_size*num_edges, edge_dim]: edge features [bond_type (label or one-hot), distance, angle]
+        edge_index [batch_size*num_edges, 2]: the indices of edges, with the node offset of each molecule
+        num_node: number of nodes in the batch
+        cutoff (float), knn (int): None to skip the criterion
+      Returns:
+        edge, edge_index: the kept edges, in the input order
+    """
+    if cutoff is None and knn is None:
+        return edge, edge_index
+    source, target = edge_index[:, 0], edge_index[:, 1]
+    distance = edge[:, -2]
+    keep = edge[:, :-2].sum(1) > 0
+    if cutoff is not None:
+        keep = keep | (distance <= cutoff)
+    if knn is not None:
+        # sort the edges by source node then distance : the rank of an edge is its position in its source group
+        order = torch.sort(distance, stable=True)[1]
+        order = order[torch.sort(source[order], stable=True)[1]]
+        count = torch.bincount(source, minlength=num_node)
+        rank = torch.arange(order.size(0), device=edge.device) - (count.cumsum(0) - count)[source[order]]
+        nearest = torch.zeros_like(keep)
+        nearest[order] = rank < knn
+        # (v, w) is kept when (v, w) or (w, v) is a knn edge. The keys end with num_node**2, larger than any key,
+        # so that searchsorted always returns a valid position
+        nearest_key = torch.sort(source[nearest]*num_node + target[nearest])[0]
+        nearest_key = F.pad(nearest_key, (0, 1), value=num_node*num_node)
+        reverse_key = target*num_node + source
+        reverse_nearest = nearest_key[torch.searchsorted(nearest_key, reverse_key)] == reverse_key
+        keep = keep | nearest | reverse_nearest
+    return edge[keep], edge_index[keep]
+
 class MessagePassing(nn.Module):
     '''
     A feed forward neural network is applied to each edge in the adjacency matrix,
@@ -41,6 +126,14 @@ class MessagePassing(nn.Module):
     node_dim x node_dim matrix, denoted NN(e). The message from node v -> w is
     then NN(e) h_v. This is a generalization of the message function in the
     GG-NN paper, which embeds the discrete edge label as a matrix.
+    
+    The message kernel is set by the optional section model: mpnn: message: of the config 
+        kernel: 'dense' (default): build the node_dim x node_dim matrix of every edge once per batch 
+                'chunked': same model and weights, the edge matrices are built by slices of chunk_size edges 
+                           at each step and never stored (needs the 'label' edge encoder)
+                'low_rank': the edge network outputs two node_dim x rank factors per edge 
+        chunk_size: number of edges per slice for the 'chunked' kernel (default: 4096) 
+        rank: rank of the edge matrices for the 'low_rank' kernel (default: 8) 
     '''
     def __init__(self, ConfigParams):
         '''
@@ -48,9 +141,22 @@ class MessagePassing(nn.Module):
         '''
         super(MessagePassing, self).__init__()
         self.encoding =  ConfigParams['model']['mpnn']['node_encoder']['encoding']
-        self.edge_encoder = get_edge_encoder(**ConfigParams['model']['mpnn']['edge_encoder'])
         self.node_dim = ConfigParams['model']['mpnn']['edge_encoder']['node_dim']
         self.device = ConfigParams['train']['device']
+        
+        message = ConfigParams['model']['mpnn'].get('message', {})
+        self.kernel = message.get('kernel', 'dense')
+        self.chunk_size = message.get('chunk_size', 4096)
+        self.rank = message.get('rank', 8)
+        assert self.kernel in MESSAGE_KERNELS, 'message kernel should be one of %s' %(MESSAGE_KERNELS,)
+        assert self.kernel != 'chunked' or ConfigParams['model']['mpnn']['edge_encoder']['encoding'] == 'label', \
+            'the chunked message kernel needs the label edge encoder'
+        # with dropout, the edge network ends with a BatchNorm of the edge matrices, which can not run by chunks 
+        assert self.kernel != 'chunked' or not ConfigParams['model']['mpnn']['edge_encoder'].get('dropout'), \
+            'the chunked message kernel needs an edge encoder without dropout'
+        
+        out_dim = 2*self.node_dim*self.rank if self.kernel == 'low_rank' else None
+        self.edge_encoder = get_edge_encoder(**ConfigParams['model']['mpnn']['edge_encoder'], out_dim=out_dim)
 
         if self.device == 'cuda':
             self.bias = nn.Parameter(torch.Tensor(self.node_dim)).cuda()
@@ -61,6 +167,11 @@ class MessagePassing(nn.Module):
         self.bias.data.uniform_(-1.0 / math.sqrt(self.node_dim), 1.0 / math.sqrt(self.node_dim))
 
         self._a_in = [] 
+    
+    def _edge_head_start(self): 
+        # index of the last linear layer of the edge network: the layers from it on map the last hidden layer to 
+        # the edge matrices 
+        return max(i for i, layer in enumerate(self.edge_encoder.layers) if isinstance(layer, nn.Linear))
      
     def _pre_encode_edges(self, edge):
         '''
@@ -70,15 +181,31 @@ class MessagePassing(nn.Module):
             A neural representation of the edge festures where each vector is represented as 
             matrix of shape node_dim x node_dim 
         '''
+        # modules pickled before the message kernels were added have no kernel / chunk_size / rank 
+        kernel = getattr(self, 'kernel', 'dense')
+        if kernel == 'chunked': 
+            # keep the last hidden layer only, the last (linear + relu) layers run in chunked_message_pass 
+            edge_cat = edge[:, 0].long().view(-1,1)
+            edge_cont = edge[:, 1:].float()
+            hidden = self.edge_encoder.layers[:self._edge_head_start()]
+            self._a_in = hidden(self.edge_encoder.encode_inputs(edge_cat, edge_cont))
+            return 
+        
         if self.encoding == 'label':
             edge_cat = edge[:, 0].long().view(-1,1)
             edge_cont = edge[:, 1:].float()
-            edge = self.edge_encoder(edge_cat, edge_cont).view(-1,self.node_dim,self.node_dim)
+            edge = self.edge_encoder(edge_cat, edge_cont)
 
         elif self.encoding == 'one_hot': 
-            edge    = self.edge_encoder(edge).view(-1, self.node_dim, self.node_dim)
+            edge    = self.edge_encoder(edge)
         
-        self._a_in = edge 
+        if kernel == 'low_rank': 
+            rank = getattr(self, 'rank', 8)
+            factors = edge.view(-1, 2, self.node_dim*rank)
+            self._a_in = (factors[:, 0].reshape(-1, rank, self.node_dim), 
+                          factors[:, 1].reshape(-1, self.node_dim, rank))
+        else: 
+            self._a_in = edge.view(-1, self.node_dim, self.node_dim)
         
     def forward(self, node_states, edge_index, edge, reuse_graph_tensors=True): 
         '''
@@ -94,7 +221,15 @@ class MessagePassing(nn.Module):
         '''
         if not reuse_graph_tensors:
             self._pre_encode_edges(edge)
-        new_state = message_pass(node_states, edge_index, self._a_in)
+        kernel = getattr(self, 'kernel', 'dense')
+        if kernel == 'chunked': 
+            new_state = chunked_message_pass(node_states, edge_index, self._a_in, 
+                                             self.edge_encoder.layers[self._edge_head_start():], 
+                                             getattr(self, 'chunk_size', 4096))
+        elif kernel == 'low_rank': 
+            new_state = low_rank_message_pass(node_states, edge_index, *self._a_in)
+        else: 
+            new_state = message_pass(node_states, edge_index, self._a_in)
         return  F.relu(new_state + self.bias)
         
 #############################################################################################################
@@ -152,23 +287,30 @@ class Set2Set(torch.nn.Module):
         self.lstm.reset_parameters()
 
 
-    def forward(self, x, batch_index):
-        h = (x.new_zeros((self.num_layer, self.batch_size, self.in_channel)),
-             x.new_zeros((self.num_layer, self.batch_size, self.in_channel)))
+    def forward(self, x, batch_index, num_graph=None):
+        """
+        Args: 
+            x: [num_node, in_channel] node states of the batch 
+            batch_index: [num_node] the molecule of each node 
+            num_graph: number of molecules in the batch, varies with packed batches (default: self.batch_size)
+        """
+        num_graph = self.batch_size if num_graph is None else num_graph
+        h = (x.new_zeros((self.num_layer, num_graph, self.in_channel)),
+             x.new_zeros((self.num_layer, num_graph, self.in_channel)))
         # zeros of shape:  bs x 2*node_dim : init q_star 
-        q_star = x.new_zeros(self.batch_size, self.out_channel)
+        q_star = x.new_zeros(num_graph, self.out_channel)
 
         # n readout steps 
         for i in range(self.processing_step): 
             # read from memory 
             q, h = self.lstm(q_star.unsqueeze(0), h)
-            q = q.view(self.batch_size, -1)
+            q = q.view(num_graph, -1)
             #energies : dot product between input_set and q 
             e = (x * q[batch_index]).sum(dim=-1, keepdim=True) #shape = num_node x 1
             # Compute attention  
-            a = self.softmax(e, batch_index, num=self.batch_size)   #shape = num_node x 1
+            a = self.softmax(e, batch_index, num=num_graph)   #shape = num_node x 1
             #compute readout            
-            r = scatter_add(a * x, batch_index, dim=0, dim_size=self.batch_size) #apply attention #shape = batch_size x ...
+            r = scatter_add(a * x, batch_index, dim=0, dim_size=num_graph) #apply attention #shape = batch_size x ...
             #update q_star
             q_star = torch.cat([q, r], dim=-1)
             # print(q_star.shape)
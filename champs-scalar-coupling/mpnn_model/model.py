@@ -10,6 +10,7 @@ from mpnn_model.common_model import *
 from mpnn_model.regression_head import * 
 from mpnn_model.message_passing import * 
 from mpnn_model.RNN_attention import * 
+from mpnn_model.profiling import phase
 
 
 
@@ -52,6 +53,11 @@ class Net(torch.nn.Module):
         # Process the nodes features 
         self.preprocess = get_node_encoder(**ConfigParams['model']['mpnn']['node_encoder'])
         
+        # Graph : fully connected molecules by default, optional section model: mpnn: graph: {cutoff, knn} of the 
+        # config to keep only the bonded, closer than cutoff and k-nearest atom pairs (see sparse_edges)
+        graph = ConfigParams['model']['mpnn'].get('graph') or {}
+        self.cutoff, self.knn = graph.get('cutoff'), graph.get('knn')
+        
         # Message 
         self.message_function = MessagePassing(ConfigParams)
 
@@ -84,28 +90,48 @@ class Net(torch.nn.Module):
                 node_index,
                 coupling_index,
                 bond_type,
-                x_atomic):
+                x_atomic,
+                batch_num_node=None):
         
         num_node, node_dim = node.shape
         num_edge, edge_dim = edge.shape
         
         #--- Build the graph representation using MPNN 
         # Process nodes representation
+        profiler = getattr(self, 'profiler', None)   # PhaseProfiler, see mpnn_model.profiling 
         if self.encoding == 'one_hot':
-            node   = self.preprocess(node)
+            with phase(profiler, 'node_encoding'):
+                node   = self.preprocess(node)
  
         elif self.encoding == 'label': 
             node_cat, node_cont = node[:,:6].long(), node[:,-1].view(-1,1).float()
-            node = self.preprocess(node_cat, node_cont) 
+            with phase(profiler, 'node_encoding'):
+                node = self.preprocess(node_cat, node_cont) 
+        
+        # Sparse neighbour graph, built once for the T steps (read with getattr : full modules pickled before the 
+        # graph options have no cutoff / knn) 
+        cutoff, knn = getattr(self, 'cutoff', None), getattr(self, 'knn', None)
+        with phase(profiler, 'graph'):
+            edge, edge_index = sparse_edges(edge, edge_index, num_node, cutoff, knn)
         
         # T-steps of message updates 
         for i in range(self.num_propagate):
             # node <- h_v^t
-            messages = self.message_function(node, edge_index, edge, reuse_graph_tensors=(i != 0)) # m_v^t+1 = sum_w(E_vw * h_vw^t)
-            node = self.update_function(messages, node)  # h_v^t+1 = GRU(m_v^t+1, h_v^t)
+            with phase(profiler, 'message_%d' % i):
+                messages = self.message_function(node, edge_index, edge, reuse_graph_tensors=(i != 0)) # m_v^t+1 = sum_w(E_vw * h_vw^t)
+            with phase(profiler, 'gru_%d' % i):
+                node = self.update_function(messages, node)  # h_v^t+1 = GRU(m_v^t+1, h_v^t)
 
-        # K-steps of readout function    
-        pool = self.readout(node, node_index)
+        # K-steps of readout function : the number of molecules varies with packed batches. It is read as a tensor 
+        # size, which needs no device sync and stays dynamic in a TorchScript trace, instead of a python int 
+        if batch_num_node is not None: 
+            num_graph = batch_num_node.size(0)
+        elif torch.jit.is_tracing(): 
+            num_graph = torch.unique_consecutive(node_index).size(0)
+        else: 
+            num_graph = int(node_index[-1]) + 1
+        with phase(profiler, 'set2set'):
+            pool = self.readout(node, node_index, num_graph)
         
 
         if self.RNN: 
@@ -124,7 +150,8 @@ class Net(torch.nn.Module):
             node3 = torch.index_select( node, dim=0, index=coupling_atom3_index.view(-1)+1).unsqueeze(1)
             node_seq = torch.cat([node0, node1, node2, node3], dim=1) # bs x 4 x node_dim 
             # Get attention hidden states
-            attention_node_seq = self.rnn_attention(node_seq, bond_type.view(-1, 4, 1), x_atomic.view(-1, 4, 1))
+            with phase(profiler, 'rnn_attention'):
+                attention_node_seq = self.rnn_attention(node_seq, bond_type.view(-1, 4, 1), x_atomic.view(-1, 4, 1))
             
             
             # embed type 
@@ -152,7 +179,8 @@ class Net(torch.nn.Module):
         
         self.pool = pool 
         
-        dense_representation = self.dense_layer(input_regression)
+        with phase(profiler, 'dense'):
+            dense_representation = self.dense_layer(input_regression)
         
         #---Get the outputs : coupling_preds, contribution_preds, type_classes : 
         #w.r.t the two flags : num_output (1: scalar vs 5: scalar+contribution) &  predict_type: False (use the actual type) Vs True (predict the type)
@@ -161,13 +189,15 @@ class Net(torch.nn.Module):
         
         #--- Get the regression predictions w.r.t the coupling type 
         if self.num_output ==1:
-            predict = self.predict(dense_representation)
+            with phase(profiler, 'predict'):
+                predict = self.predict(dense_representation)
             coupling_preds = (self.y_range[1]-self.y_range[0]) * torch.sigmoid(predict) + self.y_range[0]
             
             # when the model predicts a vector w.r.t target type (8) : Additional condition on jointly predict the type or not 
             if self.num_target != 1: 
                 if self.predict_type:
-                    predict_type = self.classify(dense_representation)
+                    with phase(profiler, 'predict'):
+                        predict_type = self.classify(dense_representation)
                 else: 
                     coupling_preds = torch.gather(predict, 1, coupling_type_index).view(-1)
                     coupling_preds = (self.y_range[1]-self.y_range[0]) * torch.sigmoid(coupling_preds) + self.y_range[0]
@@ -178,7 +208,8 @@ class Net(torch.nn.Module):
             if num_target==1: 
                 raise LookupError('Predicting coupling contributions only implemented for multi-types model')
                 
-            preds = [self.predicition_layers[i](dense_representation).view(-1, 1, 5) for i in range(8)]
+            with phase(profiler, 'predict'):
+                preds = [self.predicition_layers[i](dense_representation).view(-1, 1, 5) for i in range(8)]
             predict = torch.cat(preds, dim=1)
             predict = torch.gather(predict, 1, coupling_type_index.view(-1, 1, 1).expand(predict.size(0), 1, 
                                                                                          predict.size(2))).squeeze()
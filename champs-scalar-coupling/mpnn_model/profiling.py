@@ -0,0 +1,95 @@
+#############################################################################################################
+#                                                                                                           #
+#                              Named timers of the phases of a training step                                #
+#                                                                                                           #
+#############################################################################################################
+"""
+Opt-in instrumentation of the training step. A PhaseProfiler attached to the Net (net.profiler) and to the training
+BatchDataLoader (loader.profiler) times:
+    - collate, h2d: gather + collate of a batch, copy of the batch to the device (BatchDataLoader)
+    - node_encoding, graph, message_<t>, gru_<t>, set2set, rnn_attention, dense, predict: the submodule calls of
+      Net.forward
+    - forward, loss, backward, optimizer: the fastai training step (ProfilePhases callback of mpnn_model.callback)
+Nothing is recorded without a profiler, or while it is disabled: phase() is then a shared null context.
+On cuda the timers synchronize the device (sync=True) so that each phase gets its own kernels, which makes the
+profiled steps slower than the normal ones.
+"""
+import contextlib
+import json
+import threading
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+import torch
+
+__all__ = ['PhaseProfiler', 'phase']
+
+_NULL = contextlib.nullcontext()
+
+
+def phase(profiler, name):
+    """ time the block under `name` when profiler is an enabled PhaseProfiler, a null context otherwise """
+    if profiler is None or not profiler.enabled:
+        return _NULL
+    return profiler.phase(name)
+
+
+class PhaseProfiler(object):
+    """
+    Total time and number of calls of each named phase, and optionally the timeline of the phases for the Chrome
+    trace viewer (chrome://tracing, https://ui.perfetto.dev).
+    Args:
+        sync: synchronize cuda around each phase
+        trace: keep the start / end of every phase, at most max_events of them
+    """
+    def __init__(self, sync=False, trace=False, max_events=1000000):
+        self.sync = sync
+        self.trace = trace
+        self.max_events = max_events
+        self.enabled = True
+        self.origin = timer()
+        self.totals = OrderedDict()
+        self.events = []
+
+    def now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return timer()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.record(name, start, self.now())
+
+    def record(self, name, start, end):
+        calls, seconds = self.totals.get(name, (0, 0.))
+        self.totals[name] = (calls + 1, seconds + end - start)
+        if self.trace and len(self.events) < self.max_events:
+            self.events.append((name, start, end, threading.get_ident()))
+
+    def reset(self):
+        """ clear the totals, the trace events are kept """
+        self.totals = OrderedDict()
+
+    def summary(self):
+        """ list of (name, calls, total ms, mean ms), in order of first call """
+        return [(name, calls, seconds * 1000, seconds * 1000 / calls) for name, (calls, seconds) in self.totals.items()]
+
+    def format_summary(self, total=None):
+        """ table of the summary, with the share of `total` seconds (e.g. the epoch time) of each phase """
+        lines = ['%-16s %8s %12s %10s %7s' % ('phase', 'calls', 'total (ms)', 'mean (ms)', 'share')]
+        for name, calls, total_ms, mean_ms in self.summary():
+            share = '%6.1f%%' % (100 * total_ms / 1000 / total) if total else '      -'
+            lines.append('%-16s %8d %12.1f %10.3f %s' % (name, calls, total_ms, mean_ms, share))
+        return '\n'.join(lines) + '\n'
+
+    def export_chrome_trace(self, path):
+        """ write the recorded phases as complete events ('X') of the Chrome trace event format """
+        events = [{'name': name, 'cat': 'train', 'ph': 'X', 'pid': 0, 'tid': tid,
+                   'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6}
+                  for name, start, end, tid in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
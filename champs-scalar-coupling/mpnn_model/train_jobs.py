@@ -0,0 +1,286 @@
+#############################################################################################################
+#                                                                                                           #
+#                         Train the fold / per-type models of an experiment in parallel                     #
+#                                                                                                           #
+#############################################################################################################
+"""
+Schedule the (fold, type) trainings of one experiment on a pool of worker processes:
+    - parse_jobs: '0', '0:1JHC', '0-3:all' specifications -> list of Job
+    - run_jobs: run the jobs on `workers` processes of `threads` intra-op threads each and write the report
+    - train_job: one training in a worker: datasets of the fold (and type) over the shared FoldCache, fastai Learner,
+      training, validation predictions and checkpoints
+
+The two kinds of jobs follow the recipes of the training scripts:
+    - all types (train_mpnn_rnn.py): a new Net of the config, train_criterion of the config, one cycle of `epochs`
+    - one type (train_type.py): fine tune of the pretrained model pretrained_dir/coupling_<type>_<model>_fold_<k>_*.pth
+      with lmae_criterion, `freeze_cycle` epochs with the first layer groups frozen then `unfreeze_cycle` epochs of the
+      whole model
+Every job is seeded with set_environment(seed) before it starts; the seed is in the report.
+
+Every worker memory-maps the same FoldCache once and reuses it for all its jobs: the molecule table is read from
+disk once and its pages are shared by the workers through the page cache. The output directory holds:
+    logs/log.train.<job>.txt : the output of each job
+    logs/trace.<job>.json : Chrome trace of the phases of the training steps, with train: profile: True in the config
+    models/<model_name>_<job>*.pth : best, last epochs (AsyncCheckpoint) and final checkpoints, with
+        models/<model_name>_<job>_frozen*.pth for the frozen cycle of the per-type jobs
+    predictions/cv_<job>.csv.gz : validation predictions
+    report.json, report.txt : status, time, per epoch metrics, validation LMAE and files of every job
+"""
+import contextlib
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from timeit import default_timer as timer
+
+import torch
+
+from mpnn_model.common_constants import COUPLING_TYPE
+
+__all__ = ['Job', 'parse_jobs', 'train_job', 'run_jobs', 'format_report']
+
+
+class Job(namedtuple('Job', ['fold', 'type_'])):
+    """ a training: the model of all the coupling types of a fold (type_=None) or of one type """
+    __slots__ = ()
+
+    @property
+    def name(self):
+        return 'fold_%s' % self.fold if self.type_ is None else 'fold_%s_type_%s' % (self.fold, self.type_)
+
+
+# state of a worker process: its FoldCache, opened once for all its jobs
+_WORKER = {}
+
+
+def parse_jobs(specs):
+    """
+    Jobs of specifications 'FOLDS' or 'FOLDS:TYPES': FOLDS is a fold, a comma separated list or a range '0-3',
+    TYPES a comma separated list of coupling types or 'all' for the 8 types; without TYPES, one model of all the
+    types per fold.
+        parse_jobs(['0-1', '2:1JHC,2JHC']) -> fold 0, fold 1, fold 2 type 1JHC, fold 2 type 2JHC
+    """
+    jobs = []
+    for spec in specs:
+        folds, _, types = spec.partition(':')
+        fold_ids = []
+        for part in folds.split(','):
+            start, _, end = part.partition('-')
+            fold_ids += list(range(int(start), int(end or start) + 1))
+        type_ids = [None] if not types else COUPLING_TYPE if types == 'all' else types.split(',')
+        for type_ in type_ids:
+            assert type_ is None or type_ in COUPLING_TYPE, 'unknown coupling type %s' % type_
+        jobs += [Job(fold, type_) for fold in fold_ids for type_ in type_ids]
+    assert len(set(jobs)) == len(jobs), 'a job is given twice'
+    return jobs
+
+
+def _init_worker(cache_dir, threads, gpus, counter):
+    # one gpu per worker, in turn, before cuda is initialized in the process
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    if gpus:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(gpus[index % len(gpus)])
+    torch.set_num_threads(threads)
+    from mpnn_model.fold_cache import FoldCache
+    _WORKER['cache'] = FoldCache(cache_dir)
+
+
+def _epoch_metrics(recorder):
+    # per epoch train / validation loss and metrics of the fastai recorder
+    names = ['valid_loss'] + list(recorder.metrics_names)
+    rows = [[loss] + list(metrics) for loss, metrics in zip(recorder.val_losses, recorder.metrics)]
+    return [{name: None if value is None else float(value) for name, value in zip(names, row)} for row in rows]
+
+
+def train_job(cfg, job, out_dir, device='cpu', epochs=None, seed=None, pretrained_dir='pre_trained_models',
+              freeze_cycle=4, unfreeze_cycle=40):
+    """
+    Train the model of a job in a worker process, over the FoldCache of the worker. The output of the job goes to
+    its log file. epochs overrides the epochs of the config for the all types jobs and unfreeze_cycle for the
+    per-type jobs.
+    Returns: dict with the seed, the per epoch metrics, the validation LMAE and the paths of the job files
+    """
+    from fastai.basic_train import Learner
+
+    from mpnn_model.build_predictions import do_test
+    from mpnn_model.callback import LMAE, AsyncCheckpoint, ProfilePhases, atomic_save
+    from mpnn_model.common import set_environment
+    from mpnn_model.common_constants import model_dict
+    from mpnn_model.data_collate import tensor_collate_baseline, tensor_collate_rnn
+    from mpnn_model.dataset import BatchDataBunch, BatchDataLoader
+    from mpnn_model.GaussRank import load_gaussrank_map
+    from mpnn_model.model import Net
+    from mpnn_model.radam import RAdam
+    from mpnn_model.train_loss import lmae_criterion, train_criterion
+
+    seed, common_string = set_environment(seed)
+    print(common_string)
+    cache = _WORKER['cache']
+    cfg['train']['device'] = device
+    normalize = cfg['dataset']['normalize']
+    gaussrank = cfg['dataset']['gaussrank']
+    num_output = cfg['model']['regression']['num_output']
+    predict_type = cfg['model']['regression']['predict_type']
+    batch_size = cfg['train']['batch_size']
+    collate_fn = tensor_collate_rnn if cfg['model']['RNN'] else tensor_collate_baseline
+    model_name = cfg['train']['model_name'] + '_' + job.name
+
+    train_dataset = cache.dataset(job.fold, 'train', collate_fn, batch_size, type_=job.type_,
+                                  **cfg['train'].get('packing', {}))
+    valid_dataset = cache.dataset(job.fold, 'validation', collate_fn, batch_size, type_=job.type_)
+    data = BatchDataBunch.create(train_dataset, valid_dataset, device=device, bs=batch_size)
+    grm = load_gaussrank_map(os.path.join(cache.infor['data_dir'], 'fold_%s' % job.fold)) if gaussrank else None
+
+    if job.type_ is None:
+        net = Net(cfg, y_range=cfg['model']['y_range']).to(device)
+    else:
+        net = torch.load(os.path.join(pretrained_dir, 'coupling_%s_%s_fold_%s_%s.pth' % (
+            job.type_, model_dict[job.type_], job.fold, 'gaussrank' if gaussrank else 'wo_gaussrank')),
+            map_location=device)
+    learn = Learner(data,
+                    net,
+                    metrics=None,
+                    opt_func=partial(RAdam),
+                    path=out_dir,
+                    callback_fns=partial(LMAE,
+                                         grm=grm,
+                                         predict_type=predict_type,
+                                         normalize_coupling=normalize,
+                                         coupling_rank=gaussrank))
+    callbacks = [AsyncCheckpoint(learn, every='improvement', monitor='LMAE', name=model_name, mode='min')]
+    if cfg['train'].get('profile'):
+        callbacks.append(ProfilePhases(learn, trace_path=os.path.join(out_dir, 'logs', 'trace.%s.json' % job.name)))
+    start = timer()
+    if job.type_ is None:
+        learn.loss_func = partial(train_criterion,
+                                  criterion=cfg['train']['loss_name'],
+                                  num_output=num_output,
+                                  gaussrank=gaussrank,
+                                  pred_type=predict_type)
+        learn.fit_one_cycle(epochs or cfg['train']['epochs'], cfg['train']['max_lr'], callbacks=callbacks)
+    else:
+        # fine tune of the pretrained type model, as in scripts/train_type.py
+        learn.loss_func = lmae_criterion
+        learn.split([[learn.model.preprocess, learn.model.message_function, learn.model.update_function,
+                      learn.model.readout],
+                     [learn.model.rnn_attention], [learn.model.dense_layer, learn.model.predict]])
+        learn.lr_range(slice(1e-3))
+        learn.freeze()
+        learn.fit_one_cycle(freeze_cycle, callbacks=[
+            AsyncCheckpoint(learn, every='improvement', monitor='LMAE', name=model_name + '_frozen', mode='min')])
+        learn.unfreeze()
+        learn.fit_one_cycle(epochs or unfreeze_cycle, max_lr=cfg['train']['max_lr'],
+                            callbacks=callbacks)
+    train_time = timer() - start
+    final = os.path.join(out_dir, 'models', model_name + '_final_save.pth')
+    atomic_save(learn.model, final)
+
+    # validation predictions of the final model
+    valid_dataset = cache.dataset(job.fold, 'validation', collate_fn, batch_size, type_=job.type_, mode='test')
+    valid_loader = BatchDataLoader(valid_dataset, shuffle=False, pin_memory=False, drop_last=False, device=device)
+    num_coupling = int(cache.tensors[5][cache.rows(job.fold, 'validation', job.type_)].sum())
+    valid_loss, reverse_frame, _, _ = do_test(learn.model, valid_loader, num_coupling, num_output, predict_type, grm,
+                                             normalize=normalize, gaussrank=gaussrank)
+    predictions = os.path.join(out_dir, 'predictions', 'cv_%s.csv.gz' % job.name)
+    reverse_frame.to_csv(predictions, index=False, compression='gzip')
+
+    log_mae = dict(zip(COUPLING_TYPE, valid_loss[:len(COUPLING_TYPE)]))
+    result = {'seed': seed,
+              'epochs': _epoch_metrics(learn.recorder),
+              'train_time': train_time,
+              'valid_log_mae': {type_: float(value) for type_, value in log_mae.items()
+                                if job.type_ is None or type_ == job.type_},
+              'valid_lmae': float(valid_loss[-1] if job.type_ is None else log_mae[job.type_]),
+              'checkpoint_timings': callbacks[0].timings,
+              'best_checkpoint': os.path.join(out_dir, 'models', model_name + '.pth'),
+              'final_checkpoint': final,
+              'predictions': predictions}
+    if cfg['train'].get('profile'):
+        result['phases'] = callbacks[1].history
+        result['trace'] = callbacks[1].trace_path
+    return result
+
+
+def _run_job(cfg, job, out_dir, device, epochs, options):
+    # worker entry point: the job output goes to its log file and its errors to the report
+    log_path = os.path.join(out_dir, 'logs', 'log.train.%s.txt' % job.name)
+    result = {'job': job.name, 'fold': job.fold, 'type': job.type_, 'log': log_path, 'pid': os.getpid()}
+    start = timer()
+    with open(log_path, 'w') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            result.update(train_job(cfg, job, out_dir, device, epochs, **options))
+            result['status'] = 'done'
+        except Exception:
+            traceback.print_exc()
+            result['status'] = 'failed'
+            result['error'] = traceback.format_exc().strip().split('\n')[-1]
+    result['time'] = timer() - start
+    return result
+
+
+def run_jobs(cfg, jobs, cache_dir, out_dir, workers=1, threads=1, device='cpu', gpus=None, epochs=None, log=None,
+             seed=None, pretrained_dir='pre_trained_models', freeze_cycle=4, unfreeze_cycle=40):
+    """
+    Run the jobs on a pool of `workers` processes with `threads` intra-op threads each, over the FoldCache of
+    cache_dir. With gpus, the workers use the gpus of the list in turn. A failed job does not stop the others.
+    Every job is seeded with seed (default: one seed from the current time, shared by the jobs); pretrained_dir,
+    freeze_cycle and unfreeze_cycle set the fine tune of the per-type jobs, see train_job.
+    Returns: report, the result of each job in the order of jobs; it is also written to out_dir/report.json and
+    out_dir/report.txt
+    """
+    for directory in ['logs', 'models', 'predictions']:
+        os.makedirs(os.path.join(out_dir, directory), exist_ok=True)
+    # spawned workers: no copy of the parent threads and cuda state
+    context = multiprocessing.get_context('spawn')
+    counter = context.Value('i', 0)
+    seed = int(time.time()) if seed is None else seed
+    options = {'seed': seed, 'pretrained_dir': pretrained_dir, 'freeze_cycle': freeze_cycle,
+               'unfreeze_cycle': unfreeze_cycle}
+    results = {}
+    start = timer()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(cache_dir, threads, gpus, counter)) as pool:
+        futures = {pool.submit(_run_job, cfg, job, out_dir, device, epochs, options): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                results[job] = future.result()
+            except Exception as e:
+                # the worker itself died: no log of the job beyond this point
+                results[job] = {'job': job.name, 'fold': job.fold, 'type': job.type_, 'status': 'failed',
+                                'error': repr(e)}
+            if log is not None:
+                result = results[job]
+                log.write('%-20s %-6s %8.1f s  LMAE %s\n' % (result['job'], result['status'], result.get('time', 0),
+                                                             '%+0.3f' % result['valid_lmae'] if 'valid_lmae' in result
+                                                             else result.get('error')))
+    report = [results[job] for job in jobs]
+
+    with open(os.path.join(out_dir, 'report.json'), 'w') as f:
+        json.dump({'model_name': cfg['train']['model_name'], 'workers': workers, 'threads': threads,
+                   'device': device, 'seed': seed, 'time': timer() - start, 'jobs': report}, f, indent=2)
+    with open(os.path.join(out_dir, 'report.txt'), 'w') as f:
+        f.write(format_report(report))
+    return report
+
+
+def format_report(report):
+    """ one line per job: status, time, validation LMAE, per type log mae and final checkpoint """
+    lines = ['| job                  | status |  time (s) |   LMAE  | ' + ' | '.join('%6s' % t for t in COUPLING_TYPE)
+             + ' | checkpoint',
+             '|----------------------|--------|-----------|---------|' + '|'.join(['--------'] * len(COUPLING_TYPE))
+             + '|-----------']
+    for result in report:
+        log_mae = result.get('valid_log_mae', {})
+        lines.append('| %-20s | %-6s | %9.1f | %7s | ' % (
+            result['job'], result['status'], result.get('time', 0),
+            '%+0.3f' % result['valid_lmae'] if 'valid_lmae' in result else '-')
+            + ' | '.join('%+0.3f' % log_mae[t] if t in log_mae else '     -' for t in COUPLING_TYPE)
+            + ' | %s' % result.get('final_checkpoint', result.get('error', '')))
+    return '\n'.join(lines) + '\n'
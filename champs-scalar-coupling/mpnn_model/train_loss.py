@@ -33,6 +33,35 @@ def lmae(coupling_preds, coupling_value):
     loss = torch.log(loss+1e-8)
     return loss
 
+# per-type helpers of the multi-type losses : O(N) gather / scatter_add / bincount, on the device of the inputs 
+def own_type_diff(abs_diff, index):
+    '''
+    Pick in each row of abs_diff [N, num_type] the column of its type index [N] 
+    '''
+    return torch.gather(abs_diff, 1, index.view(-1, 1)).view(-1)
+
+def per_type_mean(diff, coupling_type, num_type, weights=None):
+    '''
+    Mean of diff [N] per coupling type (optionally multiplied by per-type weights) and the mask of the types 
+    present in the batch. The mean of an absent type is 1 (log 0), to be left out with masked_mean 
+    '''
+    count = torch.bincount(coupling_type, minlength=num_type)
+    total = torch.zeros(num_type, dtype=diff.dtype, device=diff.device).scatter_add_(0, coupling_type, diff)
+    if weights is not None: 
+        total = total * weights
+    present = count > 0
+    mean = torch.where(present, total / count.clamp(min=1).to(diff.dtype), torch.ones_like(total))
+    return mean, present
+
+def masked_mean(x, present): 
+    return (x * present.to(x.dtype)).sum() / present.sum().to(x.dtype)
+
+def add_type_loss(res, cross_entropy_loss, threshold=0.05): 
+    # + 2 * cross entropy while the type classification is not learned, without a host sync on the threshold 
+    return torch.where(cross_entropy_loss >= threshold, res + 2 * cross_entropy_loss, res)
+
+WMLMAE_TYPE_WEIGHTS = [10.,.1,.1,.1,.1,.1,.1,.1]
+
 # lmae for multi-type model 
 def train_criterion(predict,
                     coupling_value, coupling_rank, coupling_contribution, coupling_type ,
@@ -58,105 +87,35 @@ def train_criterion(predict,
     elif criterion == 'lmae':
         l = lmae_criterion
         
-    elif criterion == 'mlmae2ce':
-
-        cross_entropy_loss = torch.nn.CrossEntropyLoss()(type_preds, coupling_type)
-        abs_diff = torch.abs(coupling_preds - coupling_rank.view(-1,1).expand(coupling_preds.size()))
-
-        if criterion == 'mse': 
-            abs_diff = abs_diff**2
-
-        proba_types = F.softmax(type_preds)
-        weighted_diff = torch.mul(abs_diff, proba_types).sum(dim=1)
-
-        unique_labels, labels_count = coupling_type.unique(dim=0, return_counts=True)
-        res = torch.zeros(unique_labels.max()+1, dtype=torch.float, device='cuda')
-        res = res.scatter_add_(0, coupling_type, weighted_diff)
-        res = res[unique_labels]
-        res = res.div(labels_count.float())
-        res = res.log().mean()
-
-        return  res  + 2 * cross_entropy_loss 
-
-    elif criterion == 'mlmaeo2ce':
+    elif criterion in ['mlmae2ce', 'mlmaeo2ce', 'mlmaeo2ceh', 'mlmaeo2ceha', 'wmlmaeo2ceha', 'lmaeo2ceha']:
         cross_entropy_loss = torch.nn.CrossEntropyLoss()(type_preds, coupling_type)
         abs_diff = torch.abs(coupling_preds - coupling_rank.view(-1,1).expand(coupling_preds.size()))
-
-        proba_types = F.softmax(type_preds)
-        weighted_diff = torch.mul(abs_diff, proba_types).sum(dim=1)
-
-        unique_labels, labels_count = coupling_type.unique(dim=0, return_counts=True)
-        res = torch.zeros(unique_labels.max()+1, dtype=torch.float, device='cuda')
-        res = res.scatter_add_(0, coupling_type, weighted_diff)
-        res = res[unique_labels]
-        res = res.div(labels_count.float())
-        res = res.log().mean()
-
-        if cross_entropy_loss >= 0.05:
-            return  res  + 2 * cross_entropy_loss 
-        else:
-            return  res    
-
-    elif criterion == 'mlmaeo2ceh':
-        cross_entropy_loss = torch.nn.CrossEntropyLoss()(type_preds, coupling_type)
-        abs_diff = torch.abs(coupling_preds - coupling_rank.view(-1,1).expand(coupling_preds.size()))
-
-        proba_types = F.softmax(type_preds)
-        
-        weighted_diff = torch.sum((torch.index_select(abs_diff,1,torch.argmax(type_preds, dim=1))*torch.eye(len(coupling_type), device='cuda')), dim=1)
-
-        unique_labels, labels_count = coupling_type.unique(dim=0, return_counts=True)
-        res = torch.zeros(unique_labels.max()+1, dtype=torch.float, device='cuda')
-        res = res.scatter_add_(0, coupling_type, weighted_diff)
-        res = res[unique_labels]
-        res = res.div(labels_count.float())
-        res = res.log().mean()
-
-        if cross_entropy_loss >= 0.05:
-            return  res  + 2 * cross_entropy_loss 
-        else:
-            return  res 
-        
-    elif criterion == 'mlmaeo2ceha' or criterion == 'wmlmaeo2ceha':
-        cross_entropy_loss = torch.nn.CrossEntropyLoss()(type_preds, coupling_type)
-        abs_diff = torch.abs(coupling_preds - coupling_rank.view(-1,1).expand(coupling_preds.size()))
-
-        proba_types = F.softmax(type_preds)
-        
-        weighted_diff = torch.sum((torch.index_select(abs_diff,1,coupling_type)*torch.eye(len(coupling_type), device='cuda')), dim=1)
-        
-        unique_labels, labels_count = coupling_type.unique(dim=0, return_counts=True)
-        res = torch.zeros(unique_labels.max()+1, dtype=torch.float, device='cuda')
-        res = res.scatter_add_(0, coupling_type, weighted_diff)
-        if criterion == 'wmlmaeo2ceha':
-            res = res * torch.tensor([10.,.1,.1,.1,.1,.1,.1,.1], dtype=torch.float, device='cuda')
-        res = res[unique_labels]
-        res = res.div(labels_count.float())
-        if criterion == 'wmlmaeo2ceha':
-            res = res*res
-            res = res.mean()
-        else:
-            res = res.log().mean()
-
-        if cross_entropy_loss >= 0.05:
-            return  res  + 2 * cross_entropy_loss 
-        else:
-            return  res    
-               
-    elif criterion == 'lmaeo2ceha':
-        cross_entropy_loss = torch.nn.CrossEntropyLoss()(type_preds, coupling_type)
-        abs_diff = torch.abs(coupling_preds - coupling_rank.view(-1,1).expand(coupling_preds.size()))
-
-        proba_types = F.softmax(type_preds)
-        
-        weighted_diff = torch.sum((torch.index_select(abs_diff,1,coupling_type)*torch.eye(len(coupling_type), device='cuda')), dim=1)
-        
-        res = torch.log(weighted_diff.mean())
-
-        if cross_entropy_loss >= 0.05:
+        num_type = coupling_preds.size(1)
+
+        if criterion in ['mlmae2ce', 'mlmaeo2ce']: 
+            # diff of each type weighted by the predicted type probabilities 
+            proba_types = F.softmax(type_preds, dim=1)
+            weighted_diff = torch.mul(abs_diff, proba_types).sum(dim=1)
+        elif criterion == 'mlmaeo2ceh': 
+            # diff of the predicted type 
+            weighted_diff = own_type_diff(abs_diff, torch.argmax(type_preds, dim=1))
+        else: 
+            # diff of the actual type 
+            weighted_diff = own_type_diff(abs_diff, coupling_type)
+
+        if criterion == 'lmaeo2ceha': 
+            res = torch.log(weighted_diff.mean())
+        elif criterion == 'wmlmaeo2ceha': 
+            weights = torch.tensor(WMLMAE_TYPE_WEIGHTS, dtype=weighted_diff.dtype, device=weighted_diff.device)
+            res, present = per_type_mean(weighted_diff, coupling_type, num_type, weights)
+            res = masked_mean(res*res, present)
+        else: 
+            res, present = per_type_mean(weighted_diff, coupling_type, num_type)
+            res = masked_mean(res.log(), present)
+
+        if criterion == 'mlmae2ce': 
             return  res  + 2 * cross_entropy_loss 
-        else:
-            return  res   
+        return add_type_loss(res, cross_entropy_loss)
         
     elif criterion == 'lmae_embed_type': 
         return lmae(coupling_preds, coupling_rank)
@@ -171,7 +130,7 @@ def train_criterion(predict,
         if criterion == 'mse': 
             abs_diff = abs_diff**2
         
-        proba_types = F.softmax(type_preds)
+        proba_types = F.softmax(type_preds, dim=1)
         weighted_diff = torch.mul(abs_diff, proba_types).sum(dim=1)
         weighted_loss = torch.log(weighted_diff.mean())
         
@@ -0,0 +1,132 @@
+#############################################################################################################
+#                                                                                                           #
+#                   Micro-benchmark : vectorized collate functions Vs per-molecule loops                    #
+#                                                                                                           #
+#############################################################################################################
+"""
+Compare tensor_collate_rnn / tensor_collate_baseline with the previous implementation, that built the masks
+and the offsets with one python loop per molecule, on random padded molecules.
+Checks that both implementations return the same outputs and reports the time per batch.
+
+    python scripts/benchmark_collate.py --device cuda --batch_sizes 32 64 128 256 512 1024
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from mpnn_model.common_constants import NODE_MAX, EDGE_MAX
+from mpnn_model.data_collate import tensor_collate_rnn, tensor_collate_baseline
+
+COUPLING_MAX = 136
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='collate functions micro-benchmark')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[32, 64, 128, 256, 512, 1024])
+    parser.add_argument('--repeat', type=int, default=20, help='timed calls per batch size')
+    return parser
+
+
+def random_batch(batch_size, coupling_dim, device):
+    """
+    Padded molecules with the layout of the general frame: edge and coupling atom indices in the first columns
+    """
+    # fully connected molecules : num_node * (num_node - 1) edges must fit in EDGE_MAX
+    num_node = torch.randint(3, 30, (batch_size,))
+    num_edge = num_node * (num_node - 1)
+    num_coupling = torch.randint(1, COUPLING_MAX + 1, (batch_size,))
+    node = torch.randint(0, 5, (batch_size, NODE_MAX * 7)).float()
+    edge = torch.rand(batch_size, EDGE_MAX, 5)
+    edge[:, :, :2] = (edge[:, :, :2] * num_node.view(-1, 1, 1)).floor()
+    coupling = torch.rand(batch_size, COUPLING_MAX, coupling_dim)
+    coupling[:, :, :3] = (coupling[:, :, :3] * num_node.view(-1, 1, 1)).floor()
+    if coupling_dim == 21:
+        coupling[:, :, 10:] = (coupling[:, :, 10:] * num_node.view(-1, 1, 1)).floor()
+    tensors = [node, edge.view(batch_size, -1), coupling.view(batch_size, -1), num_node, num_edge, num_coupling]
+    return [t.to(device) for t in tensors]
+
+
+def legacy_unpad(batch, COUPLING_MAX, coupling_dim):
+    """ Masks and offsets of the previous implementation : one tensor per molecule """
+    batch_node, batch_edge, batch_coupling, batch_num_node, batch_num_edge, batch_num_coupling = batch
+    device = batch_node.device
+    batch_node = batch_node.reshape(-1, NODE_MAX, 7).float()
+    batch_edge = batch_edge.reshape(-1, EDGE_MAX, 5)
+    batch_coupling = batch_coupling.reshape(-1, COUPLING_MAX, coupling_dim)
+
+    mask = torch.cat([F.pad(torch.ones(i, device=device), (0,NODE_MAX-i)).unsqueeze(0) for i in batch_num_node], dim=0)
+    mask_coupling = torch.cat([F.pad(torch.ones(i, device=device), (0,COUPLING_MAX-i)).unsqueeze(0) for i in batch_num_coupling], dim=0)
+    mask_edge = torch.cat([F.pad(torch.ones(i, device=device), (0,EDGE_MAX-i)).unsqueeze(0) for i in batch_num_edge], dim=0)
+
+    node = batch_node[mask.bool()].view(-1, 7)
+    edge = batch_edge[mask_edge.bool()].view(-1, 5)
+    coupling = batch_coupling[mask_coupling.bool()].view(-1, coupling_dim)
+    node_index = mask.nonzero()[:, 0]
+    batch_coupling_index = mask_coupling.nonzero()[:, 0]
+
+    offset = torch.cat([torch.zeros(1, device=device).long(), batch_num_node[:-1]]).cumsum(0)
+    edge_offset = torch.cat([torch.zeros(num_edges, device=device)+offset[mol_index] for mol_index,num_edges in
+                             enumerate(batch_num_edge)], 0).long()
+    coupling_offset = torch.cat([torch.zeros(n_coupling, device=device)+offset[mol_index] for mol_index,n_coupling in
+                                 enumerate(batch_num_coupling)], 0).long()
+    return node, edge, coupling, node_index, batch_coupling_index, edge_offset, coupling_offset
+
+
+def legacy_collate_rnn(batch, batch_size, COUPLING_MAX, mode='train'):
+    node, edge, coupling, node_index, batch_coupling_index, edge_offset, coupling_offset = legacy_unpad(batch, COUPLING_MAX, 21)
+    edge_index = edge[:, :2].long() + edge_offset.unsqueeze(1)
+    coupling_index = coupling[:, 10:14].long() + coupling_offset.unsqueeze(1)
+    coupling_type = coupling[:, 2].long()
+    coupling_index = torch.cat([coupling_index, coupling_type.view(-1,1) , batch_coupling_index.view(-1, 1)], -1)
+    return (node, edge[:, 2:], edge_index, node_index, coupling_index), coupling
+
+
+def legacy_collate_baseline(batch, batch_size, COUPLING_MAX, mode='train'):
+    node, edge, coupling, node_index, batch_coupling_index, edge_offset, coupling_offset = legacy_unpad(batch, COUPLING_MAX, 10)
+    edge_index = edge[:, :2].long() + edge_offset.unsqueeze(1)
+    coupling_index = coupling[:, :2].long() + coupling_offset.unsqueeze(1)
+    coupling_type = coupling[:, 2].long()
+    coupling_index = torch.cat([coupling_index, coupling_type.view(-1,1) , batch_coupling_index.view(-1, 1)], -1)
+    return (node, edge[:, 2:], edge_index, node_index, coupling_index), coupling
+
+
+def check_outputs(new, legacy):
+    (node, edge_feats, edge_index, node_index, coupling_index, _, _, _), targets = new
+    legacy_inputs, legacy_coupling = legacy
+    for name, a, b in zip(['node', 'edge_feats', 'edge_index', 'node_index', 'coupling_index'],
+                          [node, edge_feats, edge_index, node_index, coupling_index], legacy_inputs):
+        assert torch.equal(a, b), '%s differs from the previous implementation' % name
+    assert torch.equal(targets[0], legacy_coupling[:, 3].float()), 'targets differ from the previous implementation'
+
+
+def timeit(fn, batch, repeat, device):
+    fn(batch, len(batch[0]), COUPLING_MAX)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(batch, len(batch[0]), COUPLING_MAX)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main(args):
+    print('| collate  | batch | loops (ms) | vectorized (ms) | speedup |')
+    print('|----------|-------|------------|-----------------|---------|')
+    for name, new_fn, legacy_fn, coupling_dim in [('rnn', tensor_collate_rnn, legacy_collate_rnn, 21),
+                                                  ('baseline', tensor_collate_baseline, legacy_collate_baseline, 10)]:
+        for batch_size in args.batch_sizes:
+            batch = random_batch(batch_size, coupling_dim, args.device)
+            check_outputs(new_fn(batch, batch_size, COUPLING_MAX), legacy_fn(batch, batch_size, COUPLING_MAX))
+            legacy_time = timeit(legacy_fn, batch, args.repeat, args.device)
+            new_time = timeit(new_fn, batch, args.repeat, args.device)
+            print('| %-8s | %5d | %10.2f | %15.2f | %6.1fx |' % (name, batch_size, legacy_time, new_time,
+                                                                  legacy_time / new_time))
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
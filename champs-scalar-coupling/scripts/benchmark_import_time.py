@@ -0,0 +1,105 @@
+#############################################################################################################
+#                                                                                                           #
+#                       Benchmark : import time and import side effects of mpnn_model                       #
+#                                                                                                           #
+#############################################################################################################
+"""
+Import each mpnn_model module in a fresh interpreter with `python -X importtime` and report its cumulative import
+time (median over the runs) and the slowest packages it pulls. Used as a regression check of the startup of the
+training / inference workers, the script exits with an error when a module:
+    - imports one of the optional packages that must load lazily (matplotlib, PIL, cv2, cudf, rdkit, ...)
+    - prints, initializes cuda or sets the cudnn flags at import
+    - takes more than --max_ms to import
+
+The training modules built on fastai v1 (dataset, common_model / model, callback, build_predictions, fold_cache)
+are not in the default check: they subclass fastai classes at import and fastai v1 imports matplotlib.pyplot in
+fastai.imports.core. With --modules they are timed and checked for side effects, without the lazy package check.
+
+    python scripts/benchmark_import_time.py --max_ms 3000
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+MODULES = ['mpnn_model.common', 'mpnn_model.common_constants', 'mpnn_model.helpers', 'mpnn_model.GaussRank',
+           'mpnn_model.train_loss', 'mpnn_model.data_collate', 'mpnn_model.profiling', 'mpnn_model.inference',
+           'mpnn_model.train_jobs']
+
+# modules importing fastai v1, which imports matplotlib.pyplot itself : no lazy package check
+FASTAI_MODULES = ['mpnn_model.dataset', 'mpnn_model.common_model', 'mpnn_model.model', 'mpnn_model.callback',
+                  'mpnn_model.build_predictions', 'mpnn_model.fold_cache']
+
+# packages only needed to plot, draw or build the graphs : never imported by the training / inference modules
+LAZY_PACKAGES = ['matplotlib', 'mpl_toolkits', 'PIL', 'cv2', 'cudf', 'rdkit', 'networkx', 'distutils']
+
+# run after the import of the module : the import must not touch the cuda / cudnn state
+SIDE_EFFECTS = """
+import torch
+assert not torch.cuda.is_initialized(), 'cuda initialized at import'
+assert not torch.backends.cudnn.benchmark, 'cudnn flags set at import'
+"""
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='mpnn_model import time benchmark')
+    parser.add_argument('--modules', type=str, nargs='+', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=3, help='fresh interpreters per module')
+    parser.add_argument('--top', type=int, default=5, help='slowest packages reported per module')
+    parser.add_argument('--max_ms', type=float, default=None, help='import time budget of each module')
+    return parser
+
+
+def parse_importtime(stderr, module):
+    """ {package: (self_us, cumulative_us)} of the packages imported by module, from the `-X importtime` report """
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, package = line[len('import time:'):].split('|')
+        times[package.strip()] = (int(self_us), int(cumulative_us))
+        # the next imports are the ones of the side effect checks
+        if package.strip() == module:
+            break
+    return times
+
+
+def import_module(module):
+    """ import times of a fresh interpreter importing module, and the errors of the side effect checks """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s\n%s' % (module, SIDE_EFFECTS)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    times = parse_importtime(process.stderr, module)
+    errors = []
+    if process.returncode != 0:
+        errors.append(process.stderr.strip().splitlines()[-1])
+    if process.stdout:
+        errors.append('prints at import: %r' % process.stdout.strip()[:80])
+    if module not in FASTAI_MODULES:
+        errors.extend('imports %s' % package for package in LAZY_PACKAGES if package in times)
+    return times, errors
+
+
+def main(args):
+    failures = []
+    print('| module                         | import (ms) | slowest packages (cumulative ms) ')
+    print('|--------------------------------|-------------|----------------------------------')
+    for module in args.modules:
+        runs = [import_module(module) for _ in range(args.repeat)]
+        times, errors = runs[-1]
+        total = statistics.median(run[0].get(module, (0, 0))[1] for run in runs) / 1000
+        # the slowest top level packages pulled by the module
+        slowest = sorted(((cumulative, package) for package, (_, cumulative) in times.items()
+                          if package != module and '.' not in package), reverse=True)[:args.top]
+        print('| %-30s | %11.1f | %s' % (module, total, ', '.join('%s %.0f' % (package, cumulative / 1000)
+                                                                   for cumulative, package in slowest)))
+        if args.max_ms is not None and total > args.max_ms:
+            errors.append('import takes %.0f ms > %.0f ms' % (total, args.max_ms))
+        failures.extend('%s: %s' % (module, error) for error in errors)
+
+    if failures:
+        print('\n'.join(['', 'FAILED:'] + failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
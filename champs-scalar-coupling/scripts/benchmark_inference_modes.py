@@ -0,0 +1,91 @@
+#############################################################################################################
+#                                                                                                           #
+#                   Benchmark : accuracy and throughput of the cpu inference modes                         #
+#                                                                                                           #
+#############################################################################################################
+"""
+Predict a validation frame (with the true coupling values) with each inference mode of prepare_inference ('fp32',
+'int8', 'bf16', 'int8_bf16') and report:
+    - the throughput (molecules / sec, p50 / p99 batch latency) and the speedup over fp32
+    - the per-type LMAE of compute_kaggle_metric and its delta with fp32
+and the fastest mode whose mean LMAE stays within --tolerance of the fp32 one.
+
+    python scripts/benchmark_inference_modes.py experiments/MPNN_RNN_EMBED_TYPE_LMAE_GAUSSRANK.yaml \
+        models/MPNN_RNN_EMBED_TYPE_LMAE_GAUSSRANK_fold_0_final_save.pth /input/rnn_parquet/fold_0/validation.parquet \
+        --gaussrank_dir /input/rnn_parquet/fold_0 --threads 8
+"""
+import argparse
+
+import numpy as np
+import torch
+
+from mpnn_model.callback import compute_kaggle_metric
+from mpnn_model.common_constants import COUPLING_TYPE
+from mpnn_model.GaussRank import load_gaussrank_map
+from mpnn_model.helpers import load_cfg
+from mpnn_model.inference import (export_torchscript, get_test_dataset, load_net, prepare_inference,
+                                  PredictionBuffer, run_inference, INFERENCE_MODES)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='cpu inference modes benchmark')
+    parser.add_argument('config', type=str, help='experiment yaml file')
+    parser.add_argument('checkpoint', type=str, help='saved Net: full module or state dict')
+    parser.add_argument('data', type=str, help='padded parquet frame or ragged molecules directory, with targets')
+    parser.add_argument('--modes', type=str, nargs='+', default=list(INFERENCE_MODES))
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads(), help='intra-op threads')
+    parser.add_argument('--trace', default=False, action='store_true',
+                        help='run the TorchScript trace of the modes without bf16 autocast')
+    parser.add_argument('--tolerance', type=float, default=0.01, help='accepted increase of the mean LMAE')
+    parser.add_argument('--gaussrank_dir', type=str, default=None,
+                        help='fold directory with the gaussrank mapping files, for models trained on gaussrank targets')
+    return parser
+
+
+def per_type_lmae(frame):
+    """ log mae of each coupling type (nan when absent) and their mean over the present types """
+    _, log_mae = compute_kaggle_metric(frame.scalar_coupling_constant.values,
+                                       frame.true_scalar_coupling_constant.values, frame.type_ind.values)
+    log_mae = np.array([np.nan if m is None else m for m in log_mae])
+    return log_mae, np.nanmean(log_mae)
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    cfg = load_cfg(args.config)
+    dataset = get_test_dataset(args.data, cfg, args.batch_size)
+    net = load_net(args.checkpoint, cfg)
+    grm = load_gaussrank_map(args.gaussrank_dir) if cfg['dataset']['gaussrank'] else None
+
+    results = {}
+    for mode in args.modes:
+        model = prepare_inference(net, mode, cfg['dataset']['normalize'])
+        if args.trace and 'bf16' not in mode:
+            model = export_torchscript(model, dataset[0][0])
+        buffer = PredictionBuffer()
+        report = run_inference(model, dataset, buffer)
+        report['log_mae'], report['lmae'] = per_type_lmae(buffer.frame(grm))
+        results[mode] = report
+
+    reference = results.get('fp32', results[args.modes[0]])
+    print('| mode      | molecules / s | speedup | p50 (ms) | p99 (ms) |   LMAE  | delta  |')
+    print('|-----------|---------------|---------|----------|----------|---------|--------|')
+    for mode, report in results.items():
+        print('| %-9s | %13.1f | %6.2fx | %8.1f | %8.1f | %+7.3f | %+6.3f |' % (
+            mode, report['molecules_per_sec'], report['molecules_per_sec'] / reference['molecules_per_sec'],
+            report['p50_ms'], report['p99_ms'], report['lmae'], report['lmae'] - reference['lmae']))
+
+    print('\nLMAE delta per type w.r.t %s' % ('fp32' if 'fp32' in results else args.modes[0]))
+    print('| mode      | ' + ' | '.join('%6s' % t for t in COUPLING_TYPE) + ' |')
+    print('|-----------|' + '|'.join(['--------'] * len(COUPLING_TYPE)) + '|')
+    for mode, report in results.items():
+        print('| %-9s | ' % mode + ' | '.join('%+6.3f' % d for d in report['log_mae'] - reference['log_mae']) + ' |')
+
+    accepted = [mode for mode, report in results.items() if report['lmae'] - reference['lmae'] <= args.tolerance]
+    fastest = max(accepted, key=lambda mode: results[mode]['molecules_per_sec'])
+    print('\nfastest mode within a tolerance of %.3f LMAE: %s' % (args.tolerance, fastest))
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
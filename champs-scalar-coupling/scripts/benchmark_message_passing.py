@@ -0,0 +1,140 @@
+#############################################################################################################
+#                                                                                                           #
+#                     Benchmark : memory and throughput of the message passing kernels                      #
+#                                                                                                           #
+#############################################################################################################
+"""
+Run T message passing steps, forward and backward, on random fully connected molecules with each message kernel
+('dense', 'chunked', 'low_rank', see MessagePassing) built from an experiment config. Reports the time per batch,
+the edges per second and the peak memory: allocated memory on cuda, growth of the peak resident memory of a fresh
+process over its setup on cpu (0 when the run stays below the memory used to build the model and the batch). Also checks that the 'chunked' kernel returns the same messages as the 'dense' one with the same weights.
+
+    python scripts/benchmark_message_passing.py experiments/MPNN_EMBED_TYPE_LMAE_GAUSSRANK.yaml --batch_sizes 64 128
+"""
+import argparse
+import copy
+import resource
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+from mpnn_model.helpers import load_cfg
+from mpnn_model.message_passing import MessagePassing, MESSAGE_KERNELS
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='message passing kernels benchmark')
+    parser.add_argument('config', type=str, help='experiment yaml file')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[32, 64, 128])
+    parser.add_argument('--kernels', type=str, nargs='+', default=list(MESSAGE_KERNELS))
+    parser.add_argument('--chunk_size', type=int, default=4096)
+    parser.add_argument('--rank', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=5, help='timed iterations')
+    return parser
+
+
+def kernel_config(cfg, kernel, args):
+    cfg = copy.deepcopy(cfg)
+    cfg['train']['device'] = args.device
+    cfg['model']['mpnn']['message'] = {'kernel': kernel, 'chunk_size': args.chunk_size, 'rank': args.rank}
+    return cfg
+
+
+def random_batch(batch_size, node_dim, device, seed=0):
+    """ node states, edge_index and label encoded edge features [bond_type, distance, angle] of complete graphs """
+    generator = torch.Generator().manual_seed(seed)
+    num_node = torch.randint(3, 30, (batch_size,), generator=generator)
+    offset = num_node.cumsum(0) - num_node
+    edge_index = []
+    for n, o in zip(num_node.tolist(), offset.tolist()):
+        i, j = torch.nonzero(~torch.eye(n, dtype=torch.bool), as_tuple=True)
+        edge_index.append(torch.stack([i, j], 1) + o)
+    edge_index = torch.cat(edge_index)
+    num_edge = edge_index.size(0)
+    edge = torch.cat([torch.randint(0, 5, (num_edge, 1), generator=generator).float(),
+                      torch.rand(num_edge, 2, generator=generator)], 1)
+    node = torch.randn(int(num_node.sum()), node_dim, generator=generator)
+    return node.to(device), edge_index.to(device), edge.to(device)
+
+
+def run_steps(message_function, node, edge_index, edge, num_steps):
+    for i in range(num_steps):
+        node = message_function(node, edge_index, edge, reuse_graph_tensors=(i != 0))
+    return node
+
+
+def check_chunked(cfg, args):
+    """ the chunked kernel computes the dense messages with the same weights """
+    torch.manual_seed(0)
+    dense = MessagePassing(kernel_config(cfg, 'dense', args)).to(args.device).eval()
+    chunked = MessagePassing(kernel_config(cfg, 'chunked', args)).to(args.device).eval()
+    chunked.load_state_dict(dense.state_dict())
+    node, edge_index, edge = random_batch(8, dense.node_dim, args.device)
+    with torch.no_grad():
+        expected = run_steps(dense, node, edge_index, edge, 2)
+        result = run_steps(chunked, node, edge_index, edge, 2)
+    assert torch.allclose(expected, result, rtol=1e-4, atol=1e-5), 'chunked messages differ from the dense kernel'
+
+
+def benchmark(cfg, kernel, batch_size, args, results=None):
+    num_steps = cfg['model']['mpnn']['T_steps']
+    message_function = MessagePassing(kernel_config(cfg, kernel, args)).to(args.device).train()
+    node, edge_index, edge = random_batch(batch_size, message_function.node_dim, args.device)
+    node.requires_grad_(True)
+
+    def step():
+        run_steps(message_function, node, edge_index, edge, num_steps).sum().backward()
+
+    if args.device == 'cuda':
+        step()
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base_memory = torch.cuda.memory_allocated()
+    else:
+        # ru_maxrss is a high water mark: take it before the first step
+        base_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        step()
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        step()
+    if args.device == 'cuda':
+        torch.cuda.synchronize()
+        peak_memory = torch.cuda.max_memory_allocated() - base_memory
+    else:
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - base_memory
+    elapsed = (time.perf_counter() - start) / args.repeat
+    result = {'edges': edge_index.size(0), 'time': elapsed, 'memory': peak_memory}
+    if results is not None:
+        results.put(result)
+    return result
+
+
+def main(args):
+    cfg = load_cfg(args.config)
+    if cfg['model']['mpnn']['edge_encoder']['encoding'] == 'label' and 'chunked' in args.kernels:
+        check_chunked(cfg, args)
+    context = mp.get_context('spawn')
+    print('| kernel   | batch | edges  | ms / batch | edges / s  | peak memory (MB) |')
+    print('|----------|-------|--------|------------|------------|------------------|')
+    for kernel in args.kernels:
+        for batch_size in args.batch_sizes:
+            if args.device == 'cuda':
+                result = benchmark(cfg, kernel, batch_size, args)
+                torch.cuda.empty_cache()
+            else:
+                # peak resident memory is per process: measure each run in a fresh one
+                results = context.SimpleQueue()
+                process = context.Process(target=benchmark, args=(cfg, kernel, batch_size, args, results))
+                process.start()
+                process.join()
+                assert process.exitcode == 0, 'benchmark of the %s kernel failed' % kernel
+                result = results.get()
+            print('| %-8s | %5d | %6d | %10.1f | %10.0f | %16.1f |' % (
+                kernel, batch_size, result['edges'], result['time'] * 1000, result['edges'] / result['time'],
+                result['memory'] / 2**20))
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
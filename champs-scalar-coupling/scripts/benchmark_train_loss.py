@@ -0,0 +1,149 @@
+#############################################################################################################
+#                                                                                                           #
+#                     Benchmark : parity and step time of the multi-type training losses                    #
+#                                                                                                           #
+#############################################################################################################
+"""
+Check the multi-type criterions of train_criterion (gather / scatter_add / bincount kernels) against the former
+implementation, which picked the column of each coupling type with index_select on an N x N matrix times
+torch.eye(N): same loss and same gradients w.r.t the coupling and type predictions, on random batches with all or
+only some of the 8 types. Then time a forward + backward of each criterion as the number of couplings grows (the
+former kernels up to --max_reference couplings, their N x N matrices do not fit beyond).
+
+    python scripts/benchmark_train_loss.py --num_couplings 1000 4000 16000 64000 256000
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from mpnn_model.train_loss import train_criterion, WMLMAE_TYPE_WEIGHTS
+
+CRITERIONS = ['mlmae2ce', 'mlmaeo2ce', 'mlmaeo2ceh', 'mlmaeo2ceha', 'wmlmaeo2ceha', 'lmaeo2ceha']
+NUM_TYPE = 8
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='multi-type training losses parity and benchmark')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--criterions', type=str, nargs='+', default=CRITERIONS)
+    parser.add_argument('--num_couplings', type=int, nargs='+', default=[1000, 4000, 16000, 64000])
+    parser.add_argument('--max_reference', type=int, default=16000,
+                        help='largest batch timed with the former N x N kernels')
+    parser.add_argument('--repeat', type=int, default=10, help='timed iterations')
+    return parser
+
+
+def reference_criterion(predict, coupling_rank, coupling_type, criterion):
+    """ the former index_select x eye implementation of the multi-type criterions, on any device """
+    coupling_preds, _, type_preds = predict
+    device = coupling_preds.device
+    cross_entropy_loss = torch.nn.CrossEntropyLoss()(type_preds, coupling_type)
+    abs_diff = torch.abs(coupling_preds - coupling_rank.view(-1, 1).expand(coupling_preds.size()))
+    eye = torch.eye(len(coupling_type), device=device)
+    if criterion in ['mlmae2ce', 'mlmaeo2ce']:
+        weighted_diff = torch.mul(abs_diff, F.softmax(type_preds, dim=1)).sum(dim=1)
+    elif criterion == 'mlmaeo2ceh':
+        weighted_diff = torch.sum(torch.index_select(abs_diff, 1, torch.argmax(type_preds, dim=1)) * eye, dim=1)
+    else:
+        weighted_diff = torch.sum(torch.index_select(abs_diff, 1, coupling_type) * eye, dim=1)
+
+    if criterion == 'lmaeo2ceha':
+        res = torch.log(weighted_diff.mean())
+    else:
+        unique_labels, labels_count = coupling_type.unique(dim=0, return_counts=True)
+        res = torch.zeros(NUM_TYPE, dtype=torch.float, device=device)
+        res = res.scatter_add_(0, coupling_type, weighted_diff)
+        if criterion == 'wmlmaeo2ceha':
+            res = res * torch.tensor(WMLMAE_TYPE_WEIGHTS, dtype=torch.float, device=device)
+        res = res[unique_labels].div(labels_count.float())
+        res = (res * res).mean() if criterion == 'wmlmaeo2ceha' else res.log().mean()
+
+    if criterion == 'mlmae2ce' or cross_entropy_loss >= 0.05:
+        return res + 2 * cross_entropy_loss
+    return res
+
+
+def random_batch(num_coupling, device, types=NUM_TYPE, seed=0):
+    """ predictions [N, 8] and type logits [N, 8] (with grad), gaussrank targets and types among the first `types` """
+    generator = torch.Generator().manual_seed(seed)
+    coupling_preds = torch.randn(num_coupling, NUM_TYPE, generator=generator).to(device).requires_grad_()
+    type_preds = (3 * torch.randn(num_coupling, NUM_TYPE, generator=generator)).to(device).requires_grad_()
+    coupling_rank = torch.randn(num_coupling, generator=generator).to(device)
+    coupling_type = torch.randint(0, types, (num_coupling,), generator=generator).to(device)
+    return coupling_preds, type_preds, coupling_rank, coupling_type
+
+
+def loss_and_grads(loss_function, batch):
+    coupling_preds, type_preds, _, _ = batch
+    loss = loss_function()
+    grads = torch.autograd.grad(loss, [coupling_preds, type_preds], allow_unused=True)
+    return loss.detach(), [torch.zeros_like(p) if g is None else g for g, p in zip(grads, [coupling_preds, type_preds])]
+
+
+def check_parity(criterions, device, num_coupling=500):
+    failures = []
+    for types in [NUM_TYPE, 3, 1]:
+        batch = random_batch(num_coupling, device, types, seed=types)
+        coupling_preds, type_preds, coupling_rank, coupling_type = batch
+        predict = [coupling_preds, [], type_preds]
+        for criterion in criterions:
+            loss, grads = loss_and_grads(lambda: train_criterion(predict, coupling_rank, coupling_rank, [], coupling_type,
+                                                                 criterion=criterion), batch)
+            ref_loss, ref_grads = loss_and_grads(lambda: reference_criterion(predict, coupling_rank, coupling_type,
+                                                                             criterion), batch)
+            ok = torch.allclose(loss, ref_loss, rtol=1e-5, atol=1e-6) and \
+                all(torch.allclose(g, r, rtol=1e-4, atol=1e-7) for g, r in zip(grads, ref_grads))
+            print('parity %-12s %d types : loss %+.6f reference %+.6f %s' % (
+                criterion, types, loss.item(), ref_loss.item(), 'ok' if ok else 'MISMATCH'))
+            if not ok:
+                failures.append((criterion, types))
+    return failures
+
+
+def step_time(loss_function, batch, device, repeat):
+    coupling_preds, type_preds, _, _ = batch
+
+    def step():
+        loss = loss_function()
+        loss.backward()
+        coupling_preds.grad, type_preds.grad = None, None
+
+    step()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        step()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main(args):
+    failures = check_parity(args.criterions, args.device)
+
+    print('\nforward + backward step time (ms) on %s' % args.device)
+    print('| criterion    | couplings | gather | index_select x eye | speedup |')
+    print('|--------------|-----------|--------|--------------------|---------|')
+    for criterion in args.criterions:
+        for num_coupling in args.num_couplings:
+            batch = random_batch(num_coupling, args.device)
+            coupling_preds, type_preds, coupling_rank, coupling_type = batch
+            predict = [coupling_preds, [], type_preds]
+            new = step_time(lambda: train_criterion(predict, coupling_rank, coupling_rank, [], coupling_type,
+                                                    criterion=criterion), batch, args.device, args.repeat)
+            if num_coupling <= args.max_reference:
+                ref = step_time(lambda: reference_criterion(predict, coupling_rank, coupling_type, criterion),
+                                batch, args.device, args.repeat)
+                print('| %-12s | %9d | %6.2f | %18.2f | %6.1fx |' % (criterion, num_coupling, new, ref, ref / new))
+            else:
+                print('| %-12s | %9d | %6.2f | %18s | %7s |' % (criterion, num_coupling, new, '-', '-'))
+
+    if failures:
+        raise SystemExit('criterions differing from the former implementation: %s' % failures)
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
@@ -28,14 +28,10 @@ def build_test_data(fold, grm, coupling_frame, molecule_edge, molecule_node):
 
     shared_cols = ['molecule_name', 'num_coupling', 'coupling_dim']
 
-    tmp = coupling_frame.groupby('molecule_name').apply(lambda x: x[coupling_cols].values.reshape(-1))
-    molecule_coupling = pd.DataFrame(tmp.values.tolist())
-    # pad coupling_max from 132 to 136
     COUPLING_MAX = 136
-    pad_cols = 21*5
-    d = dict.fromkeys([str(i) for i in range(molecule_coupling.shape[1], molecule_coupling.shape[1]+pad_cols)], 0.0)
-    molecule_coupling = molecule_coupling.assign(**d).fillna(0.0)
-    molecule_coupling['molecule_name'] = tmp.index
+    molecule_names, couplings = pad_by_molecule(coupling_frame, coupling_cols, COUPLING_MAX)
+    molecule_coupling = pd.DataFrame(couplings.reshape(len(molecule_names), -1))
+    molecule_coupling['molecule_name'] = molecule_names
     molecule_coupling = molecule_coupling.merge(coupling_frame[shared_cols].drop_duplicates(), on='molecule_name', how='left')
     cols = molecule_coupling.columns.tolist()
 
@@ -98,6 +94,7 @@ def run_train(yaml_filepath, fold, best_pred_file_path):
     y_range=cfg['model']['y_range']
     
     ############################------------- Init Log file ---------------################################
+    SEED, COMMON_STRING = set_environment()
     log = Logger()
     log.open(out_dir+'/train/log.train.%s.%s.txt' % (cfg['train']['model_name'], fold), mode='a')
     log.write('\n--- [START %s] %s\n\n' % (IDENTIFIER, '-' * 64))
@@ -115,16 +112,7 @@ def run_train(yaml_filepath, fold, best_pred_file_path):
     ############################----------- Load GRM transformer -------------################################
     log.write('\n Load GaussRank mapping for fold %s' %fold)
     data_dir = DATA_DIR + '/rnn_parquet'
-    files = glob.glob(data_dir+'/fold_%s/'%fold+'*.csv')
-    mapping_frames = ['']*8
-    coupling_order = ['']*8
-
-    for file in files:
-        type_ = file.split('/')[-1].split('_')[2]
-        order = int(file.split('/')[-1].split('_')[-1].strip('.csv'))
-        coupling_order[order] = type_
-        mapping_frames[order] = pd.read_csv(file)  
-    grm = GaussRankMap(mapping_frames, coupling_order)
+    grm = load_gaussrank_map(data_dir+'/fold_%s'%fold)
     
     
     ############################------------- Load Datasets ---------------################################
@@ -237,11 +225,12 @@ def run_train(yaml_filepath, fold, best_pred_file_path):
     log.write('\tfit one cycle of length: %s\n'%epochs)
     learn.fit_one_cycle(epochs,
                         max_lr, 
-                        callbacks=[SaveModelCallback(learn,
-                                                 every='improvement',
-                                                 monitor='LMAE', 
-                                                 name=cfg['train']['model_name']+'_fold_%s'%fold,
-                                                 mode='min')])
+                        callbacks=[AsyncCheckpoint(learn,
+                                               every='improvement',
+                                               monitor='LMAE', 
+                                               name=cfg['train']['model_name']+'_fold_%s'%fold,
+                                               mode='min',
+                                               log=log)])
     log.write('\nGet Validation loader\n')
     valid_dataset = TensorBatchDataset(mol_valid, 
                                 tensors=[nodes_matrix, edges_matrix, coupling_matrix,
@@ -278,7 +267,7 @@ def run_train(yaml_filepath, fold, best_pred_file_path):
     log.write('\n|%+0.3f, %+0.3f, %+0.3f, %+0.3f, %+0.3f, %+0.3f, %+0.3f, %+0.3f | %+5.3f %5.2f %+0.2f |  %s   |\n' %(*valid_loss[:11], fold))
     
     log.write('\nSave model to disk')
-    torch.save(learn.model, 'models/' + cfg['train']['model_name'] + '_fold_%s_final_save.pth'%fold)
+    atomic_save(learn.model, 'models/' + cfg['train']['model_name'] + '_fold_%s_final_save.pth'%fold)
     
     del nodes_matrix
     del edges_matrix
@@ -379,7 +368,6 @@ if __name__ == '__main__':
 
     import cudf as gd
     from fastai.basic_train import *
-    from fastai.callbacks import SaveModelCallback
     from functools import partial
     from torch.utils.dlpack import from_dlpack
     
@@ -388,12 +376,12 @@ if __name__ == '__main__':
     import warnings
     
     from mpnn_model.build_predictions import do_test 
-    from mpnn_model.callback import get_reverse_frame, lmae, LMAE
+    from mpnn_model.callback import get_reverse_frame, lmae, LMAE, AsyncCheckpoint, atomic_save
     from mpnn_model.common import * 
     from mpnn_model.common_constants import * 
     from mpnn_model.dataset import TensorBatchDataset, BatchDataBunch, BatchDataLoader
     from mpnn_model.data_collate import tensor_collate_rnn
-    from mpnn_model.GaussRank import GaussRankMap
+    from mpnn_model.GaussRank import GaussRankMap, load_gaussrank_map, pad_by_molecule
     from mpnn_model.helpers import load_cfg
     from mpnn_model.model import Net 
     from mpnn_model.radam import * 
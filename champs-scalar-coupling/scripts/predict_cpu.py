@@ -0,0 +1,72 @@
+#############################################################################################################
+#                                                                                                           #
+#                           Predict the couplings of a molecule set on cpu                                  #
+#                                                                                                           #
+#############################################################################################################
+"""
+Load a trained Net, trace it to TorchScript (or load a saved trace) and stream the predictions of a padded parquet
+frame or of a ragged molecules directory to a csv(.gz) / parquet file. Reports molecules / sec and the p50 / p99
+latency of a batch (collate + forward).
+
+    python scripts/predict_cpu.py experiments/MPNN_RNN_EMBED_TYPE_LMAE_GAUSSRANK.yaml \
+        models/MPNN_RNN_EMBED_TYPE_LMAE_GAUSSRANK_fold_0_final_save.pth /input/rnn_parquet/test.parquet \
+        --output sub_fold_0.csv.gz --torchscript models/fold_0.pt --threads 8 --gaussrank_dir /input/rnn_parquet/fold_0
+"""
+import argparse
+import os
+
+import torch
+
+from mpnn_model.GaussRank import load_gaussrank_map
+from mpnn_model.helpers import load_cfg
+from mpnn_model.inference import (export_torchscript, get_test_dataset, load_net, load_torchscript,
+                                  InferenceNet, PredictionWriter, run_inference)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='cpu batch inference of a trained Net')
+    parser.add_argument('config', type=str, help='experiment yaml file')
+    parser.add_argument('checkpoint', type=str, help='saved Net: full module or state dict')
+    parser.add_argument('data', type=str, help='padded parquet frame or ragged molecules directory')
+    parser.add_argument('--output', type=str, required=True, help='predictions file: .csv, .csv.gz or .parquet')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads(), help='intra-op threads')
+    parser.add_argument('--torchscript', type=str, default=None,
+                        help='trace file: loaded if it exists, otherwise the trace is saved there')
+    parser.add_argument('--eager', default=False, action='store_true', help='run the python Net, no trace')
+    parser.add_argument('--gaussrank_dir', type=str, default=None,
+                        help='fold directory with the gaussrank mapping files, for models trained on gaussrank targets')
+    return parser
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    cfg = load_cfg(args.config)
+    dataset = get_test_dataset(args.data, cfg, args.batch_size)
+    normalize = cfg['dataset']['normalize']
+
+    if args.torchscript is not None and os.path.exists(args.torchscript) and not args.eager:
+        model = load_torchscript(args.torchscript)
+    else:
+        net = load_net(args.checkpoint, cfg)
+        if args.eager:
+            model = InferenceNet(net, normalize).eval()
+        else:
+            model = export_torchscript(net, dataset[0][0], args.torchscript, normalize)
+
+    grm = None
+    if cfg['dataset']['gaussrank']:
+        assert args.gaussrank_dir is not None, 'the model predicts gaussrank values: --gaussrank_dir is needed'
+        grm = load_gaussrank_map(args.gaussrank_dir)
+
+    writer = PredictionWriter(args.output, grm)
+    report = run_inference(model, dataset, writer)
+    writer.close()
+
+    print('%d molecules, %d couplings written to %s' % (report['molecules'], report['couplings'], args.output))
+    print('threads %d | %.1f molecules / sec | batch latency p50 %.1f ms p99 %.1f ms' % (
+        args.threads, report['molecules_per_sec'], report['p50_ms'], report['p99_ms']))
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
@@ -0,0 +1,79 @@
+#############################################################################################################
+#                                                                                                           #
+#                       Predict the couplings of a molecule set with the models of K folds                  #
+#                                                                                                           #
+#############################################################################################################
+"""
+Load the fold checkpoints of an experiment, collate each batch of the test set once, run the K fold models on it
+(one after the other or in K threads) and write a single submission file with the mean / median of the folds, or
+with one column per fold (--reduce stack). Reports molecules / sec and the p50 / p99 latency of a batch.
+
+    python scripts/predict_ensemble.py experiments/MPNN_RNN_EMBED_TYPE_LMAE_GAUSSRANK.yaml /input/rnn_parquet/test.parquet \
+        --checkpoints models/MPNN_RNN_EMBED_TYPE_LMAE_GAUSSRANK_fold_{0,1,2,3}_final_save.pth \
+        --gaussrank_dirs /input/rnn_parquet/fold_{0,1,2,3} --output submission.csv.gz --threads 8 --parallel
+
+With --parallel, the --threads intra-op threads are split between the fold models (8 threads, 4 folds: 2 per model).
+"""
+import argparse
+
+import torch
+
+from mpnn_model.GaussRank import load_gaussrank_map
+from mpnn_model.helpers import load_cfg
+from mpnn_model.inference import (export_torchscript, get_test_dataset, load_net, prepare_inference,
+                                  FoldEnsemble, PredictionWriter, run_inference, ENSEMBLE_REDUCTIONS, INFERENCE_MODES)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='cpu batch inference of the fold models of an experiment')
+    parser.add_argument('config', type=str, help='experiment yaml file')
+    parser.add_argument('data', type=str, help='padded parquet frame or ragged molecules directory')
+    parser.add_argument('--checkpoints', type=str, nargs='+', required=True, help='saved Net of each fold')
+    parser.add_argument('--gaussrank_dirs', type=str, nargs='+', default=None,
+                        help='fold directories with the gaussrank mapping files, in the order of --checkpoints')
+    parser.add_argument('--output', type=str, required=True, help='predictions file: .csv, .csv.gz or .parquet')
+    parser.add_argument('--reduce', type=str, default='mean', choices=ENSEMBLE_REDUCTIONS)
+    parser.add_argument('--mode', type=str, default='fp32', choices=INFERENCE_MODES)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads(),
+                        help='intra-op threads in total, split between the fold models with --parallel')
+    parser.add_argument('--parallel', default=False, action='store_true', help='run the fold models in K threads')
+    parser.add_argument('--eager', default=False, action='store_true', help='run the python Nets, no trace')
+    return parser
+
+
+def main(args):
+    # each of the K model threads of --parallel runs its ops on its own intra-op threads: K x threads per model
+    threads = max(1, args.threads // len(args.checkpoints)) if args.parallel else args.threads
+    torch.set_num_threads(threads)
+    cfg = load_cfg(args.config)
+    dataset = get_test_dataset(args.data, cfg, args.batch_size)
+
+    models = []
+    for checkpoint in args.checkpoints:
+        model = prepare_inference(load_net(checkpoint, cfg), args.mode, cfg['dataset']['normalize'])
+        if not args.eager and 'bf16' not in args.mode:
+            model = export_torchscript(model, dataset[0][0])
+        models.append(model)
+
+    grms = None
+    if cfg['dataset']['gaussrank']:
+        assert args.gaussrank_dirs is not None and len(args.gaussrank_dirs) == len(args.checkpoints), \
+            'the models predict gaussrank values: one --gaussrank_dirs per checkpoint is needed'
+        grms = [load_gaussrank_map(directory) for directory in args.gaussrank_dirs]
+
+    ensemble = FoldEnsemble(models, grms, args.reduce, args.parallel)
+    writer = PredictionWriter(args.output)
+    report = run_inference(ensemble, dataset, writer)
+    writer.close()
+    ensemble.close()
+
+    print('%d folds | %d molecules, %d couplings written to %s' % (
+        len(models), report['molecules'], report['couplings'], args.output))
+    print('threads %s | %.1f molecules / sec | batch latency p50 %.1f ms p99 %.1f ms' % (
+        '%d x %d folds = %d' % (threads, len(models), threads * len(models)) if args.parallel else threads,
+        report['molecules_per_sec'], report['p50_ms'], report['p99_ms']))
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
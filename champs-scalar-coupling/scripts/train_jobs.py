@@ -0,0 +1,79 @@
+#############################################################################################################
+#                                                                                                           #
+#                     Train the folds and per-type models of an experiment on a pool of workers             #
+#                                                                                                           #
+#############################################################################################################
+"""
+Run the (fold, type) trainings of an experiment in worker processes sharing one memory-mapped FoldCache, instead of
+one train_mpnn_rnn.py / train_type.py process per fold and type. The per-type jobs fine tune the pretrained models of
+--pretrained_dir like train_type.py. The cache is built from --data_dir first when
+cache_dir does not hold one. Writes the logs, checkpoints, validation predictions and report.json / report.txt of
+all the jobs to --output.
+
+    python scripts/train_jobs.py experiments/MPNN_RNN_EMBED_TYPE_LMAE_GAUSSRANK.yaml /input/fold_cache \
+        --data_dir /input/rnn_parquet --jobs 0-3 0-3:all --workers 4 --threads 4 --gpus 0 1 2 3 --output output/jobs
+
+On a cpu only box (e.g. a smoke test of the pipeline on a small cache):
+
+    python scripts/train_jobs.py experiments/MPNN_RNN_EMBED_TYPE_LMAE_GAUSSRANK.yaml /tmp/fold_cache \
+        --jobs 0,1 0:1JHC --workers 2 --threads 1 --device cpu --epochs 1 --output /tmp/jobs
+"""
+import argparse
+import os
+
+from mpnn_model.common import Logger
+from mpnn_model.fold_cache import build_fold_cache
+from mpnn_model.helpers import load_cfg
+from mpnn_model.train_jobs import parse_jobs, run_jobs, format_report
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='parallel fold / per-type trainings of an experiment')
+    parser.add_argument('config', type=str, help='experiment yaml file')
+    parser.add_argument('cache_dir', type=str, help='FoldCache directory, see mpnn_model/fold_cache.py')
+    parser.add_argument('--data_dir', type=str, default=None,
+                        help='padded parquet directory to build the cache from when cache_dir has none')
+    parser.add_argument('--jobs', type=str, nargs='+', required=True,
+                        help="jobs 'FOLDS' or 'FOLDS:TYPES', e.g. 0-3 (all types models) 0:1JHC,2JHC 1:all")
+    parser.add_argument('--workers', type=int, default=1, help='worker processes')
+    parser.add_argument('--threads', type=int, default=1, help='intra-op threads per worker')
+    parser.add_argument('--device', type=str, default=None, help='cpu or cuda (default: device of the config)')
+    parser.add_argument('--gpus', type=int, nargs='+', default=None, help='gpus given to the workers in turn')
+    parser.add_argument('--epochs', type=int, default=None,
+                        help='override the epochs of the config, and the unfrozen cycle of the per-type jobs')
+    parser.add_argument('--seed', type=int, default=None, help='seed of every job (default: from the current time)')
+    parser.add_argument('--pretrained_dir', type=str, default='pre_trained_models',
+                        help='pretrained type models fine tuned by the per-type jobs, as in train_type.py')
+    parser.add_argument('--freeze_cycle', type=int, default=4, help='per-type jobs: epochs with frozen weights')
+    parser.add_argument('--unfreeze_cycle', type=int, default=40, help='per-type jobs: epochs with unfrozen weights')
+    parser.add_argument('--profile', default=False, action='store_true',
+                        help='time the phases of the training steps, per epoch in the job logs and as Chrome traces')
+    parser.add_argument('--output', type=str, required=True, help='directory of the logs, checkpoints and report')
+    return parser
+
+
+def main(args):
+    cfg = load_cfg(args.config)
+    cfg['train']['profile'] = args.profile or cfg['train'].get('profile', False)
+    jobs = parse_jobs(args.jobs)
+    if not os.path.exists(os.path.join(args.cache_dir, 'cache.json')):
+        assert args.data_dir is not None, 'no fold cache in %s: --data_dir is needed to build it' % args.cache_dir
+        build_fold_cache(args.data_dir, args.cache_dir, sorted(set(job.fold for job in jobs)))
+
+    os.makedirs(args.output, exist_ok=True)
+    log = Logger()
+    log.open(os.path.join(args.output, 'log.train_jobs.txt'), mode='a')
+    log.write('%d jobs of %s on %d workers x %d threads\n' % (len(jobs), args.config, args.workers, args.threads))
+    report = run_jobs(cfg, jobs, args.cache_dir, args.output, workers=args.workers, threads=args.threads,
+                      device=args.device or cfg['train']['device'], gpus=args.gpus, epochs=args.epochs, log=log,
+                      seed=args.seed, pretrained_dir=args.pretrained_dir, freeze_cycle=args.freeze_cycle,
+                      unfreeze_cycle=args.unfreeze_cycle)
+    log.write('\n' + format_report(report))
+
+    failed = [result['job'] for result in report if result['status'] != 'done']
+    if failed:
+        raise SystemExit('failed jobs: %s, see %s' % (failed, os.path.join(args.output, 'logs')))
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
@@ -48,6 +48,7 @@ def run_train(yaml_filepath, fold):
     y_range=cfg['model']['y_range']
     
     ############################------------- Init Log file ---------------################################
+    SEED, COMMON_STRING = set_environment()
     log = Logger()
     log.open(out_dir+'/train/log.train.%s.%s.txt' % (cfg['train']['model_name'], fold), mode='a')
     log.write('\n--- [START %s] %s\n\n' % (IDENTIFIER, '-' * 64))
@@ -63,51 +64,59 @@ def run_train(yaml_filepath, fold):
     
     ############################------------- Load Datasets ---------------################################
     log.write('** dataset setting **\n')
-    log.write('** load parquet data for fold %s  **\n' %fold)
-    validation = gd.read_parquet(DATA_DIR +'/parquet/fold_%s/validation.parquet'%fold)
-    train = gd.read_parquet(DATA_DIR +'/parquet/fold_%s/train.parquet' %fold)
-    # convert tensors
-    log.write('** Convert train tensors **\n')
-    num_nodes_tensor = from_dlpack(train['num_nodes'].to_dlpack()).long()
-    num_edges_tensor = from_dlpack(train['num_edge'].to_dlpack()).long()
-    num_coupling_tensor = from_dlpack(train['num_coupling'].to_dlpack()).long()
-    node_cols = [i for i in train.columns if re.compile("^node_[0-9]+").findall(i)]
-    nodes_matrix = from_dlpack(train[node_cols].to_dlpack()).type(torch.float32)
-    edge_cols = [i for i in train.columns if re.compile("^edge_[0-9]+").findall(i)]
-    edges_matrix = from_dlpack(train[edge_cols].to_dlpack()).type(torch.float32)
-    coupling_cols = [i for i in train.columns if re.compile("^coupling_[0-9]+").findall(i)]
-    coupling_matrix = from_dlpack(train[coupling_cols].to_dlpack()).type(torch.float32)
-    mol_train = train.molecule_name.unique().to_pandas().values
-    train_dataset = TensorBatchDataset(mol_train, 
-                                    tensors=[nodes_matrix, edges_matrix, coupling_matrix,
-                                            num_nodes_tensor, num_edges_tensor, num_coupling_tensor], 
-                                    batch_size=batch_size,
-                                    collate_fn=tensor_collate_baseline,
-                                    COUPLING_MAX=COUPLING_MAX,
-                                    mode='train',
-                                    csv='train')
-    del train
-    # convert validation to tensors 
-    log.write('** Convert validation tensors **\n')
-    num_nodes_tensor = from_dlpack(validation['num_nodes'].to_dlpack()).long()
-    num_edges_tensor = from_dlpack(validation['num_edge'].to_dlpack()).long()
-    num_coupling_tensor = from_dlpack(validation['num_coupling'].to_dlpack()).long()
-    node_cols = [i for i in validation.columns if re.compile("^node_[0-9]+").findall(i)]
-    nodes_matrix = from_dlpack(validation[node_cols].to_dlpack()).type(torch.float32)
-    edge_cols = [i for i in validation.columns if re.compile("^edge_[0-9]+").findall(i)]
-    edges_matrix = from_dlpack(validation[edge_cols].to_dlpack()).type(torch.float32)
-    coupling_cols = [i for i in validation.columns if re.compile("^coupling_[0-9]+").findall(i)]
-    coupling_matrix = from_dlpack(validation[coupling_cols].to_dlpack()).type(torch.float32)
-    mol_valid = validation.molecule_name.unique().to_pandas().values
-    valid_dataset = TensorBatchDataset(mol_valid, 
-                                    tensors=[nodes_matrix, edges_matrix, coupling_matrix,
+    cache_path = cfg['dataset'].get('cache_path')
+    if cache_path:
+        log.write('** memory-mapped fold cache %s for fold %s  **\n' %(cache_path, fold))
+        cache = FoldCache(cache_path)
+        train_dataset = cache.dataset(fold, 'train', tensor_collate_baseline, batch_size, **cfg['train'].get('packing', {}))
+        valid_dataset = cache.dataset(fold, 'validation', tensor_collate_baseline, batch_size)
+    else:
+        log.write('** load parquet data for fold %s  **\n' %fold)
+        validation = gd.read_parquet(DATA_DIR +'/parquet/fold_%s/validation.parquet'%fold)
+        train = gd.read_parquet(DATA_DIR +'/parquet/fold_%s/train.parquet' %fold)
+        # convert tensors
+        log.write('** Convert train tensors **\n')
+        num_nodes_tensor = from_dlpack(train['num_nodes'].to_dlpack()).long()
+        num_edges_tensor = from_dlpack(train['num_edge'].to_dlpack()).long()
+        num_coupling_tensor = from_dlpack(train['num_coupling'].to_dlpack()).long()
+        node_cols = [i for i in train.columns if re.compile("^node_[0-9]+").findall(i)]
+        nodes_matrix = from_dlpack(train[node_cols].to_dlpack()).type(torch.float32)
+        edge_cols = [i for i in train.columns if re.compile("^edge_[0-9]+").findall(i)]
+        edges_matrix = from_dlpack(train[edge_cols].to_dlpack()).type(torch.float32)
+        coupling_cols = [i for i in train.columns if re.compile("^coupling_[0-9]+").findall(i)]
+        coupling_matrix = from_dlpack(train[coupling_cols].to_dlpack()).type(torch.float32)
+        mol_train = train.molecule_name.unique().to_pandas().values
+        train_dataset = TensorBatchDataset(mol_train, 
+                                        tensors=[nodes_matrix, edges_matrix, coupling_matrix,
                                                 num_nodes_tensor, num_edges_tensor, num_coupling_tensor], 
-                                    batch_size=batch_size,
-                                    collate_fn=tensor_collate_baseline,
-                                    COUPLING_MAX=COUPLING_MAX,
-                                    mode='train',
-                                    csv='train')
-    del validation 
+                                        batch_size=batch_size,
+                                        collate_fn=tensor_collate_baseline,
+                                        COUPLING_MAX=COUPLING_MAX,
+                                        mode='train',
+                                        csv='train',
+                                        **cfg['train'].get('packing', {}))
+        del train
+        # convert validation to tensors 
+        log.write('** Convert validation tensors **\n')
+        num_nodes_tensor = from_dlpack(validation['num_nodes'].to_dlpack()).long()
+        num_edges_tensor = from_dlpack(validation['num_edge'].to_dlpack()).long()
+        num_coupling_tensor = from_dlpack(validation['num_coupling'].to_dlpack()).long()
+        node_cols = [i for i in validation.columns if re.compile("^node_[0-9]+").findall(i)]
+        nodes_matrix = from_dlpack(validation[node_cols].to_dlpack()).type(torch.float32)
+        edge_cols = [i for i in validation.columns if re.compile("^edge_[0-9]+").findall(i)]
+        edges_matrix = from_dlpack(validation[edge_cols].to_dlpack()).type(torch.float32)
+        coupling_cols = [i for i in validation.columns if re.compile("^coupling_[0-9]+").findall(i)]
+        coupling_matrix = from_dlpack(validation[coupling_cols].to_dlpack()).type(torch.float32)
+        mol_valid = validation.molecule_name.unique().to_pandas().values
+        valid_dataset = TensorBatchDataset(mol_valid, 
+                                        tensors=[nodes_matrix, edges_matrix, coupling_matrix,
+                                                    num_nodes_tensor, num_edges_tensor, num_coupling_tensor], 
+                                        batch_size=batch_size,
+                                        collate_fn=tensor_collate_baseline,
+                                        COUPLING_MAX=COUPLING_MAX,
+                                        mode='train',
+                                        csv='train')
+        del validation 
     ### log dataset info
     log.write('batch_size = %d\n'%(batch_size))
     log.write('train_dataset : \n%s\n'%(train_dataset))
@@ -126,17 +135,7 @@ def run_train(yaml_filepath, fold):
     log.write('\n Load GaussRank mapping')
     data_dir = DATA_DIR + '/parquet'
     normalize = cfg['dataset']['normalize']
-    files = glob.glob(data_dir+'/fold_%s/'%fold+'*.csv')
-    mapping_frames = ['']*8
-    coupling_order = ['']*8
-
-    for file in files:
-        type_ = file.split('/')[-1].split('_')[2]
-        order = int(file.split('/')[-1].split('_')[-1].strip('.csv'))
-        coupling_order[order] = type_
-        mapping_frames[order] = pd.read_csv(file)  
-
-    grm = GaussRankMap(mapping_frames, coupling_order)
+    grm = load_gaussrank_map(data_dir+'/fold_%s'%fold)
 
     optal = partial(RAdam)
 
@@ -158,22 +157,30 @@ def run_train(yaml_filepath, fold):
 
     log.write('\tTraining loss: %s\n'%(learn.loss_func))
     log.write('\tfit one cycle of length: %s\n'%epochs)
+    # optional timings of the phases of the training steps: train: profile: True in the config 
+    profile = [ProfilePhases(learn, log=log, 
+                             trace_path=out_dir+'/train/trace.%s.%s.json' % (cfg['train']['model_name'], fold))] \
+        if cfg['train'].get('profile') else []
     learn.fit_one_cycle(epochs,
                         max_lr, 
-                        callbacks=[SaveModelCallback(learn,
-                                                 every='improvement',
-                                                 monitor='LMAE', 
-                                                 name=cfg['train']['model_name']+'_fold_%s'%fold,
-                                                 mode='min')])
+                        callbacks=[AsyncCheckpoint(learn,
+                                               every='improvement',
+                                               monitor='LMAE', 
+                                               name=cfg['train']['model_name']+'_fold_%s'%fold,
+                                               mode='min',
+                                               log=log)] + profile)
     log.write('\nGet Validation loader\n')
-    valid_dataset = TensorBatchDataset(mol_valid, 
-                                tensors=[nodes_matrix, edges_matrix, coupling_matrix,
-                                        num_nodes_tensor, num_edges_tensor, num_coupling_tensor], 
-                                batch_size=batch_size,
-                                collate_fn=tensor_collate_baseline,
-                                COUPLING_MAX=COUPLING_MAX,
-                                mode='test',
-                                csv='train')
+    if cache_path:
+        valid_dataset = cache.dataset(fold, 'validation', tensor_collate_baseline, batch_size, mode='test')
+    else:
+        valid_dataset = TensorBatchDataset(mol_valid, 
+                                    tensors=[nodes_matrix, edges_matrix, coupling_matrix,
+                                            num_nodes_tensor, num_edges_tensor, num_coupling_tensor], 
+                                    batch_size=batch_size,
+                                    collate_fn=tensor_collate_baseline,
+                                    COUPLING_MAX=COUPLING_MAX,
+                                    mode='test',
+                                    csv='train')
 
     valid_loader = BatchDataLoader(valid_dataset, 
                                    shuffle=False, 
@@ -201,38 +208,42 @@ def run_train(yaml_filepath, fold):
     log.write('\n|%+0.3f, %+0.3f, %+0.3f, %+0.3f, %+0.3f, %+0.3f, %+0.3f, %+0.3f | %+5.3f %5.2f %+0.2f |  %s   |\n' %(*valid_loss[:11], fold))
     
     log.write('\nSave model to disk')
-    torch.save(learn.model, 'models/' + cfg['train']['model_name'] + '_fold_%s_final_save.pth'%fold)
+    atomic_save(learn.model, 'models/' + cfg['train']['model_name'] + '_fold_%s_final_save.pth'%fold)
     
-    del nodes_matrix
-    del edges_matrix
-    del coupling_matrix 
-    torch.cuda.empty_cache()
+    if cache_path:
+        log.write('load test data')
+        test_dataset = cache.dataset(None, 'test', tensor_collate_baseline, batch_size, mode='test')
+    else:
+        del nodes_matrix
+        del edges_matrix
+        del coupling_matrix 
+        torch.cuda.empty_cache()
     
     
-    log.write('load test data')
-    test = gd.read_parquet(DATA_DIR +'/parquet/test.parquet')
-    num_nodes_tensor = from_dlpack(test['num_nodes'].to_dlpack())
-    num_edges_tensor = from_dlpack(test['num_edge'].to_dlpack())
-    num_coupling_tensor = from_dlpack(test['num_coupling'].to_dlpack())
-    node_cols = [i for i in test.columns if re.compile("^node_[0-9]+").findall(i)]
-    nodes_matrix = from_dlpack(test[node_cols].to_dlpack())
-    nodes_matrix = from_dlpack(test[node_cols].to_dlpack()).type(torch.float32)
-    edge_cols = [i for i in test.columns if re.compile("^edge_[0-9]+").findall(i)]
-    edges_matrix = from_dlpack(test[edge_cols].to_dlpack()).type(torch.float32)
-    coupling_cols = [i for i in test.columns if re.compile("^coupling_[0-9]+").findall(i)]
-    coupling_matrix = from_dlpack(test[coupling_cols].to_dlpack()).type(torch.float32)
+        log.write('load test data')
+        test = gd.read_parquet(DATA_DIR +'/parquet/test.parquet')
+        num_nodes_tensor = from_dlpack(test['num_nodes'].to_dlpack())
+        num_edges_tensor = from_dlpack(test['num_edge'].to_dlpack())
+        num_coupling_tensor = from_dlpack(test['num_coupling'].to_dlpack())
+        node_cols = [i for i in test.columns if re.compile("^node_[0-9]+").findall(i)]
+        nodes_matrix = from_dlpack(test[node_cols].to_dlpack())
+        nodes_matrix = from_dlpack(test[node_cols].to_dlpack()).type(torch.float32)
+        edge_cols = [i for i in test.columns if re.compile("^edge_[0-9]+").findall(i)]
+        edges_matrix = from_dlpack(test[edge_cols].to_dlpack()).type(torch.float32)
+        coupling_cols = [i for i in test.columns if re.compile("^coupling_[0-9]+").findall(i)]
+        coupling_matrix = from_dlpack(test[coupling_cols].to_dlpack()).type(torch.float32)
 
-    mol_test  = test.molecule_name.unique().to_pandas().values
-    del test
+        mol_test  = test.molecule_name.unique().to_pandas().values
+        del test
 
-    test_dataset = TensorBatchDataset(mol_test, 
-                                    tensors=[nodes_matrix, edges_matrix, coupling_matrix,
-                                             num_nodes_tensor, num_edges_tensor, num_coupling_tensor], 
-                                    batch_size=batch_size,
-                                    collate_fn=tensor_collate_baseline,
-                                    COUPLING_MAX=COUPLING_MAX,
-                                    mode='test',
-                                    csv='test')
+        test_dataset = TensorBatchDataset(mol_test, 
+                                        tensors=[nodes_matrix, edges_matrix, coupling_matrix,
+                                                 num_nodes_tensor, num_edges_tensor, num_coupling_tensor], 
+                                        batch_size=batch_size,
+                                        collate_fn=tensor_collate_baseline,
+                                        COUPLING_MAX=COUPLING_MAX,
+                                        mode='test',
+                                        csv='test')
 
     test_loader = BatchDataLoader(test_dataset, 
                                    shuffle=False, 
@@ -303,7 +314,6 @@ if __name__ == '__main__':
 
     import cudf as gd
     from fastai.basic_train import *
-    from fastai.callbacks import SaveModelCallback
     from functools import partial
     from torch.utils.dlpack import from_dlpack
     
@@ -311,12 +321,13 @@ if __name__ == '__main__':
     import warnings
     
     from mpnn_model.build_predictions import do_test 
-    from mpnn_model.callback import get_reverse_frame, lmae, LMAE
+    from mpnn_model.callback import get_reverse_frame, lmae, LMAE, AsyncCheckpoint, ProfilePhases, atomic_save
     from mpnn_model.common import * 
     from mpnn_model.common_constants import * 
     from mpnn_model.dataset import TensorBatchDataset, BatchDataBunch, BatchDataLoader
+    from mpnn_model.fold_cache import FoldCache
     from mpnn_model.data_collate import tensor_collate_baseline
-    from mpnn_model.GaussRank import GaussRankMap
+    from mpnn_model.GaussRank import GaussRankMap, load_gaussrank_map
     from mpnn_model.helpers import load_cfg
     from mpnn_model.model import Net 
     from mpnn_model.radam import * 
@@ -55,6 +55,7 @@ def run(yaml_filepath, fold, type_, freeze_cycle=4, unfreeze_cycle=40):
 
     
     ############################------------- Init Log file ---------------################################
+    SEED, COMMON_STRING = set_environment()
     log = Logger()
     
         
@@ -79,62 +80,69 @@ def run(yaml_filepath, fold, type_, freeze_cycle=4, unfreeze_cycle=40):
     id_test = test.id.values
     mol_test = test.molecule_name.values
 
-    print('\n Load Train/Validation features for fold %s' %fold)
-    validation = gd.read_parquet(DATA_DIR +'/rnn_parquet/fold_%s/%s/validation.parquet'%(fold, type_))
-    train = gd.read_parquet(DATA_DIR +'/rnn_parquet/fold_%s/%s/train.parquet' %(fold, type_))
-
-    print('\n Get In-memory Tensor ')
-
-    # Convert train to tensors 
-    num_nodes_tensor = from_dlpack(train['num_nodes'].to_dlpack()).long()
-    num_edges_tensor = from_dlpack(train['num_edge'].to_dlpack()).long()
-    num_coupling_tensor = from_dlpack(train['num_coupling'].to_dlpack()).long()
-
-    node_cols = [i for i in train.columns if re.compile("^node_[0-9]+").findall(i)]
-    nodes_matrix = from_dlpack(train[node_cols].to_dlpack()).type(torch.float32)
-
-    edge_cols = [i for i in train.columns if re.compile("^edge_[0-9]+").findall(i)]
-    edges_matrix = from_dlpack(train[edge_cols].to_dlpack()).type(torch.float32)
-
-    coupling_cols = [i for i in train.columns if re.compile("^coupling_[0-9]+").findall(i)]
-    coupling_matrix = from_dlpack(train[coupling_cols].to_dlpack()).type(torch.float32)
-
-    mol_train = train.molecule_name.unique().to_pandas().values
-    train_dataset = TensorBatchDataset(mol_train, 
-                                       tensors=[nodes_matrix, edges_matrix, coupling_matrix,
-                                                num_nodes_tensor, num_edges_tensor, num_coupling_tensor], 
-                                        batch_size=batch_size,
-                                       collate_fn=tensor_collate_rnn,
-                                       COUPLING_MAX=COUPLING_MAX,
-                                        mode='train',
-                                        csv='train')
-    # convert validation to tensors 
-    num_nodes_tensor = from_dlpack(validation['num_nodes'].to_dlpack()).long()
-    num_edges_tensor = from_dlpack(validation['num_edge'].to_dlpack()).long()
-    num_coupling_tensor = from_dlpack(validation['num_coupling'].to_dlpack()).long()
-
-    node_cols = [i for i in validation.columns if re.compile("^node_[0-9]+").findall(i)]
-    nodes_matrix = from_dlpack(validation[node_cols].to_dlpack()).type(torch.float32)
-
-    edge_cols = [i for i in validation.columns if re.compile("^edge_[0-9]+").findall(i)]
-    edges_matrix = from_dlpack(validation[edge_cols].to_dlpack()).type(torch.float32)
-
-    coupling_cols = [i for i in validation.columns if re.compile("^coupling_[0-9]+").findall(i)]
-    coupling_matrix = from_dlpack(validation[coupling_cols].to_dlpack()).type(torch.float32)
-
-
-    mol_valid = validation.molecule_name.unique().to_pandas().values
-    valid_dataset = TensorBatchDataset(mol_valid, 
-                                       tensors=[nodes_matrix, edges_matrix, coupling_matrix,
-                                                num_nodes_tensor, num_edges_tensor, num_coupling_tensor], 
-                                        batch_size=batch_size,
-                                       collate_fn=tensor_collate_rnn,
-                                       COUPLING_MAX=COUPLING_MAX,
-                                        mode='train',
-                                        csv='train')
-
-    del train 
-    del validation 
+    cache_path = cfg['dataset'].get('cache_path')
+    if cache_path:
+        print('\n Memory-map the fold cache %s for fold %s and type %s' %(cache_path, fold, type_))
+        cache = FoldCache(cache_path)
+        train_dataset = cache.dataset(fold, 'train', tensor_collate_rnn, batch_size, type_=type_)
+        valid_dataset = cache.dataset(fold, 'validation', tensor_collate_rnn, batch_size, type_=type_)
+    else:
+        print('\n Load Train/Validation features for fold %s' %fold)
+        validation = gd.read_parquet(DATA_DIR +'/rnn_parquet/fold_%s/%s/validation.parquet'%(fold, type_))
+        train = gd.read_parquet(DATA_DIR +'/rnn_parquet/fold_%s/%s/train.parquet' %(fold, type_))
+
+        print('\n Get In-memory Tensor ')
+
+        # Convert train to tensors 
+        num_nodes_tensor = from_dlpack(train['num_nodes'].to_dlpack()).long()
+        num_edges_tensor = from_dlpack(train['num_edge'].to_dlpack()).long()
+        num_coupling_tensor = from_dlpack(train['num_coupling'].to_dlpack()).long()
+
+        node_cols = [i for i in train.columns if re.compile("^node_[0-9]+").findall(i)]
+        nodes_matrix = from_dlpack(train[node_cols].to_dlpack()).type(torch.float32)
+
+        edge_cols = [i for i in train.columns if re.compile("^edge_[0-9]+").findall(i)]
+        edges_matrix = from_dlpack(train[edge_cols].to_dlpack()).type(torch.float32)
+
+        coupling_cols = [i for i in train.columns if re.compile("^coupling_[0-9]+").findall(i)]
+        coupling_matrix = from_dlpack(train[coupling_cols].to_dlpack()).type(torch.float32)
+
+        mol_train = train.molecule_name.unique().to_pandas().values
+        train_dataset = TensorBatchDataset(mol_train, 
+                                           tensors=[nodes_matrix, edges_matrix, coupling_matrix,
+                                                    num_nodes_tensor, num_edges_tensor, num_coupling_tensor], 
+                                            batch_size=batch_size,
+                                           collate_fn=tensor_collate_rnn,
+                                           COUPLING_MAX=COUPLING_MAX,
+                                            mode='train',
+                                            csv='train')
+        # convert validation to tensors 
+        num_nodes_tensor = from_dlpack(validation['num_nodes'].to_dlpack()).long()
+        num_edges_tensor = from_dlpack(validation['num_edge'].to_dlpack()).long()
+        num_coupling_tensor = from_dlpack(validation['num_coupling'].to_dlpack()).long()
+
+        node_cols = [i for i in validation.columns if re.compile("^node_[0-9]+").findall(i)]
+        nodes_matrix = from_dlpack(validation[node_cols].to_dlpack()).type(torch.float32)
+
+        edge_cols = [i for i in validation.columns if re.compile("^edge_[0-9]+").findall(i)]
+        edges_matrix = from_dlpack(validation[edge_cols].to_dlpack()).type(torch.float32)
+
+        coupling_cols = [i for i in validation.columns if re.compile("^coupling_[0-9]+").findall(i)]
+        coupling_matrix = from_dlpack(validation[coupling_cols].to_dlpack()).type(torch.float32)
+
+
+        mol_valid = validation.molecule_name.unique().to_pandas().values
+        valid_dataset = TensorBatchDataset(mol_valid, 
+                                           tensors=[nodes_matrix, edges_matrix, coupling_matrix,
+                                                    num_nodes_tensor, num_edges_tensor, num_coupling_tensor], 
+                                            batch_size=batch_size,
+                                           collate_fn=tensor_collate_rnn,
+                                           COUPLING_MAX=COUPLING_MAX,
+                                            mode='train',
+                                            csv='train')
+
+        del train 
+        del validation 
 
     data = BatchDataBunch.create(train_dataset, valid_dataset, device=device, bs=batch_size)
     
@@ -172,29 +180,34 @@ def run(yaml_filepath, fold, type_, freeze_cycle=4, unfreeze_cycle=40):
     learn.lr_range(slice(1e-3))
 
     learn.freeze()
-    learn.fit_one_cycle(freeze_cycle, callbacks=[SaveModelCallback(learn,
+    learn.fit_one_cycle(freeze_cycle, callbacks=[AsyncCheckpoint(learn,
                                                      every='improvement',
                                                      monitor='LMAE', 
                                                      name=cfg['train']['model_name']+'_fold_%s_frozen_type_%s_'%(fold, type_),
-                                                     mode='min')])
+                                                     mode='min',
+                                                     log=log)])
     
     learn.unfreeze()
-    learn.fit_one_cycle(unfreeze_cycle, max_lr=max_lr, callbacks=[SaveModelCallback(learn,
+    learn.fit_one_cycle(unfreeze_cycle, max_lr=max_lr, callbacks=[AsyncCheckpoint(learn,
                                                      every='improvement',
                                                      monitor='LMAE', 
                                                      name=cfg['train']['model_name']+'_fold_%s_pretrained_%s_'%(fold, type_),
-                                                     mode='min')])
+                                                     mode='min',
+                                                     log=log)])
 
    
     ############################------------- Build predictions ---------------################################
-    valid_dataset = TensorBatchDataset(mol_valid, 
-                                    tensors=[nodes_matrix, edges_matrix, coupling_matrix,
-                                            num_nodes_tensor, num_edges_tensor, num_coupling_tensor], 
-                                    batch_size=batch_size,
-                                    collate_fn=tensor_collate_rnn,
-                                    COUPLING_MAX=COUPLING_MAX,
-                                    mode='test',
-                                    csv='train')
+    if cache_path:
+        valid_dataset = cache.dataset(fold, 'validation', tensor_collate_rnn, batch_size, type_=type_, mode='test')
+    else:
+        valid_dataset = TensorBatchDataset(mol_valid, 
+                                        tensors=[nodes_matrix, edges_matrix, coupling_matrix,
+                                                num_nodes_tensor, num_edges_tensor, num_coupling_tensor], 
+                                        batch_size=batch_size,
+                                        collate_fn=tensor_collate_rnn,
+                                        COUPLING_MAX=COUPLING_MAX,
+                                        mode='test',
+                                        csv='train')
 
     valid_loader = BatchDataLoader(valid_dataset, 
                                    shuffle=False, 
@@ -218,34 +231,37 @@ def run(yaml_filepath, fold, type_, freeze_cycle=4, unfreeze_cycle=40):
     log.write('\nValidation loss is : %s' %val_loss)
     
     log.write('\nSave model to disk')
-    torch.save(learn.model, 'models/' + cfg['train']['model_name'] + '_fold_%s_final_save.pth'%fold)
+    atomic_save(learn.model, 'models/' + cfg['train']['model_name'] + '_fold_%s_final_save.pth'%fold)
     
     log.write('load test data')
-    torch.cuda.empty_cache()
-    test = gd.read_parquet(DATA_DIR +'/rnn_parquet/test_%s.parquet'%type_)
-    num_nodes_tensor = from_dlpack(test['num_nodes'].to_dlpack())
-    num_edges_tensor = from_dlpack(test['num_edge'].to_dlpack())
-    num_coupling_tensor = from_dlpack(test['num_coupling'].to_dlpack())
-    node_cols = [i for i in test.columns if re.compile("^node_[0-9]+").findall(i)]
-    nodes_matrix = from_dlpack(test[node_cols].to_dlpack())
-    nodes_matrix = from_dlpack(test[node_cols].to_dlpack()).type(torch.float32)
-    edge_cols = [i for i in test.columns if re.compile("^edge_[0-9]+").findall(i)]
-    edges_matrix = from_dlpack(test[edge_cols].to_dlpack()).type(torch.float32)
-    coupling_cols = [i for i in test.columns if re.compile("^coupling_[0-9]+").findall(i)]
-    coupling_matrix = from_dlpack(test[coupling_cols].to_dlpack()).type(torch.float32)
-
-    mol_test  = test.molecule_name.unique().to_pandas().values
-    #batch_node, batch_edge, batch_coupling, batch_graussrank, batch_num_node, batch_num_edge, batch_num_coupling
-    del test
-    
-    test_dataset = TensorBatchDataset(mol_test, 
-                                    tensors=[nodes_matrix, edges_matrix, coupling_matrix,
-                                             num_nodes_tensor, num_edges_tensor, num_coupling_tensor], 
-                                    batch_size=batch_size,
-                                    collate_fn=tensor_collate_rnn,
-                                    COUPLING_MAX=COUPLING_MAX,
-                                    mode='test',
-                                    csv='test')
+    if cache_path:
+        test_dataset = cache.dataset(None, 'test', tensor_collate_rnn, batch_size, type_=type_, mode='test')
+    else:
+        torch.cuda.empty_cache()
+        test = gd.read_parquet(DATA_DIR +'/rnn_parquet/test_%s.parquet'%type_)
+        num_nodes_tensor = from_dlpack(test['num_nodes'].to_dlpack())
+        num_edges_tensor = from_dlpack(test['num_edge'].to_dlpack())
+        num_coupling_tensor = from_dlpack(test['num_coupling'].to_dlpack())
+        node_cols = [i for i in test.columns if re.compile("^node_[0-9]+").findall(i)]
+        nodes_matrix = from_dlpack(test[node_cols].to_dlpack())
+        nodes_matrix = from_dlpack(test[node_cols].to_dlpack()).type(torch.float32)
+        edge_cols = [i for i in test.columns if re.compile("^edge_[0-9]+").findall(i)]
+        edges_matrix = from_dlpack(test[edge_cols].to_dlpack()).type(torch.float32)
+        coupling_cols = [i for i in test.columns if re.compile("^coupling_[0-9]+").findall(i)]
+        coupling_matrix = from_dlpack(test[coupling_cols].to_dlpack()).type(torch.float32)
+
+        mol_test  = test.molecule_name.unique().to_pandas().values
+        #batch_node, batch_edge, batch_coupling, batch_graussrank, batch_num_node, batch_num_edge, batch_num_coupling
+        del test
+    
+        test_dataset = TensorBatchDataset(mol_test, 
+                                        tensors=[nodes_matrix, edges_matrix, coupling_matrix,
+                                                 num_nodes_tensor, num_edges_tensor, num_coupling_tensor], 
+                                        batch_size=batch_size,
+                                        collate_fn=tensor_collate_rnn,
+                                        COUPLING_MAX=COUPLING_MAX,
+                                        mode='test',
+                                        csv='test')
 
     test_loader = BatchDataLoader(test_dataset, 
                                    shuffle=False, 
@@ -330,7 +346,6 @@ if __name__ == '__main__':
 
     import cudf as gd
     from fastai.basic_train import *
-    from fastai.callbacks import SaveModelCallback
     from functools import partial
     from torch.utils.dlpack import from_dlpack
     
@@ -338,10 +353,11 @@ if __name__ == '__main__':
     import warnings
     
     from mpnn_model.build_predictions import do_test 
-    from mpnn_model.callback import get_reverse_frame, lmae, LMAE
+    from mpnn_model.callback import get_reverse_frame, lmae, LMAE, AsyncCheckpoint, atomic_save
     from mpnn_model.common import * 
     from mpnn_model.common_constants import * 
     from mpnn_model.dataset import TensorBatchDataset, BatchDataBunch, BatchDataLoader
+    from mpnn_model.fold_cache import FoldCache
     from mpnn_model.data_collate import tensor_collate_rnn
     from mpnn_model.GaussRank import GaussRankMap
     from mpnn_model.helpers import load_cfg
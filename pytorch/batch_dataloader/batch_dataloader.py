@@ -1,6 +1,13 @@
+import threading
+import queue
+
 import torch
 from torch import _utils
 
+# Seconds the prefetch thread waits on a full queue before re-checking whether
+# the iterator has been shut down.
+_PREFETCH_POLL_INTERVAL = 0.1
+
 class BatchDataLoader(object):
     """Batch Data loader. Takes in a batch dataset and returns iterators that return whole batches of data.
     Arguments:
@@ -13,26 +20,97 @@ class BatchDataLoader(object):
             if the dataset size is not divisible by the batch size. If ``False`` and
             the size of dataset is not divisible by the batch size, then the last batch
             will be smaller. (default: ``False``)
+        prefetch_batches (int, optional): number of batches to stage ahead of the
+            training loop on a background thread. The thread slices (and pins, if
+            requested) the next batches while the current one is being consumed,
+            blocking once ``prefetch_batches`` batches are waiting. ``0`` loads
+            every batch synchronously in ``__next__``. (default: ``0``)
+        num_replicas (int, optional): number of processes taking part in data
+            parallel training. Each of them iterates over a disjoint shard of the
+            batches, all shards holding the same number of batches. By default
+            the world size of the ``torch.distributed`` default process group
+            when it is initialized, ``1`` otherwise.
+        rank (int, optional): rank of the current process within ``num_replicas``.
+            By default the rank in the ``torch.distributed`` default process group.
+        seed (int, optional): seed of the per-epoch shuffle. All replicas shuffle
+            with ``seed + epoch`` so they agree on the order of the data without
+            exchanging it. The global random state is left untouched. ``None``
+            shuffles from the global random state, which is only allowed with a
+            single replica. (default: ``0`` when sharding, ``None`` otherwise)
+
+    When sharding, batch ``i`` of the (shuffled) dataset goes to rank ``i % num_replicas``.
+    With ``drop_last`` only full batches are used and the tail batches that do not
+    divide evenly between the replicas are dropped. Otherwise the shards are padded to
+    the same length by wrapping around to the first batches of the epoch, so a few
+    batches are seen twice. Streamed datasets such as ``ParquetBatchDataset`` have to
+    be read in order and cannot be sharded this way.
     """
 
     def __init__(self, batchdataset, shuffle=False,
-                 pin_memory=False, drop_last=False):
+                 pin_memory=False, drop_last=False, prefetch_batches=0,
+                 num_replicas=None, rank=None, seed=None):
+        if prefetch_batches < 0:
+            raise ValueError('prefetch_batches should be a non-negative integer, '
+                             'but got prefetch_batches={}'.format(prefetch_batches))
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if distributed else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if distributed else 0
+        if rank < 0 or rank >= num_replicas:
+            raise ValueError('Invalid rank {}, rank should be in the interval '
+                             '[0, {}]'.format(rank, num_replicas - 1))
+        if seed is None and num_replicas > 1:
+            seed = 0
         self.batchdataset = batchdataset
         self.batch_size = batchdataset.batch_size
 
         self.shuffle = shuffle
         self.pin_memory = pin_memory
         self.drop_last = drop_last
+        self.prefetch_batches = prefetch_batches
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
 
 
     def __iter__(self):
-        return _BatchDataLoaderIter(self)
+        if self.prefetch_batches > 0:
+            iterator = _PrefetchBatchDataLoaderIter(self)
+        else:
+            iterator = _BatchDataLoaderIter(self)
+        self.epoch += 1
+        return iterator
 
     def __len__(self):
-        if self.drop_last and self.batchdataset.num_samples%self.batch_size != 0:
-            return len(self.batchdataset)-1
+        return len(self._batch_indices())
+
+    def set_epoch(self, epoch):
+        """Sets the epoch used to seed the next shuffle. Epochs otherwise count the
+        iterators created from this loader, starting from ``0``."""
+        self.epoch = epoch
+
+    def _shuffle(self):
+        if self.seed is None:
+            self.batchdataset.shuffle()
         else:
-            return len(self.batchdataset)
+            with torch.random.fork_rng():
+                torch.manual_seed(self.seed + self.epoch)
+                self.batchdataset.shuffle()
+
+    def _batch_indices(self):
+        """The batches of the dataset to iterate over in this process, in order."""
+        num_batches = len(self.batchdataset)
+        if self.drop_last and self.batchdataset.num_samples%self.batch_size != 0:
+            num_batches = num_batches - 1
+        if self.num_replicas == 1:
+            return range(num_batches)
+        if self.drop_last:
+            num_batches = num_batches - num_batches % self.num_replicas
+            return range(self.rank, num_batches, self.num_replicas)
+        num_shard_batches = -(-num_batches // self.num_replicas)
+        return [(self.rank + i * self.num_replicas) % num_batches for i in range(num_shard_batches)]
 
     
 class _BatchDataLoaderIter(object):
@@ -44,21 +122,19 @@ class _BatchDataLoaderIter(object):
         self.drop_last = loader.drop_last
 
         if loader.shuffle:
-            self.batchdataset.shuffle()
+            loader._shuffle()
+        self.batch_indices = loader._batch_indices()
 
         self.idx = 0
 
     def __len__(self):
-        if self.drop_last and self.batchdataset.num_samples%self.batch_size != 0:
-            return len(self.batchdataset)-1
-        else:
-            return len(self.batchdataset)
+        return len(self.batch_indices)
          
     
     def __next__(self):
         if self.idx >= len(self):
             raise StopIteration
-        batch = self.batchdataset[self.idx]
+        batch = self.batchdataset[self.batch_indices[self.idx]]
         # Note Pinning memory was ~10% _slower_ for the test examples I explored
         if self.pin_memory:
             batch = _utils.pin_memory.pin_memory_batch(batch)
@@ -69,3 +145,95 @@ class _BatchDataLoaderIter(object):
 
     def __iter__(self):
         return self
+
+
+class _PrefetchBatchDataLoaderIter(_BatchDataLoaderIter):
+    """Iterates once over the BatchDataLoader's batchdataset, loading batches ahead of time
+    on a background thread into a queue bounded by ``prefetch_batches``.
+
+    The dataset is shuffled on the calling thread before the prefetch thread starts, so
+    the thread only ever reads from it. The thread is stopped when the iterator is
+    exhausted, when ``_shutdown`` is called or when the iterator is garbage collected,
+    which covers loops that ``break`` out early.
+    """
+    def __init__(self, loader):
+        # Set first so __del__ is a no-op if anything below fails
+        self.shutdown = True
+        super(_PrefetchBatchDataLoaderIter, self).__init__(loader)
+        self.num_batches = len(self)
+        self.data_queue = queue.Queue(maxsize=loader.prefetch_batches)
+        self.done_event = threading.Event()
+
+        self.prefetch_thread = threading.Thread(
+            target=_prefetch_loop,
+            args=(self.batchdataset, self.batch_indices, self.pin_memory,
+                  self.data_queue, self.done_event))
+        self.prefetch_thread.daemon = True
+        self.prefetch_thread.start()
+        self.shutdown = False
+
+    def __next__(self):
+        if self.idx >= self.num_batches:
+            self._shutdown()
+            raise StopIteration
+        batch = self._get_batch()
+        self.idx = self.idx+1
+        if isinstance(batch, _utils.ExceptionWrapper):
+            self._shutdown()
+            batch.reraise()
+        return batch
+
+    next = __next__  # Python 2 compatibility
+
+    def _get_batch(self):
+        while True:
+            try:
+                return self.data_queue.get(timeout=_PREFETCH_POLL_INTERVAL)
+            except queue.Empty:
+                if not self.prefetch_thread.is_alive():
+                    # The thread may have queued its last batch right after the timeout
+                    try:
+                        return self.data_queue.get_nowait()
+                    except queue.Empty:
+                        raise RuntimeError('Batch prefetch thread exited unexpectedly')
+
+    def _shutdown(self):
+        if not self.shutdown:
+            self.shutdown = True
+            self.done_event.set()
+            # Free a slot so a thread blocked on a full queue notices the event
+            while True:
+                try:
+                    self.data_queue.get_nowait()
+                except queue.Empty:
+                    break
+            self.prefetch_thread.join()
+
+    def __del__(self):
+        if not getattr(self, 'shutdown', True):
+            self._shutdown()
+
+
+def _prefetch_loop(batchdataset, batch_indices, pin_memory, data_queue, done_event):
+    """Loads ``batch_indices`` in order and puts the batches on ``data_queue`` until
+    every batch is queued or ``done_event`` is set. Errors are forwarded to the consumer
+    as ``ExceptionWrapper`` objects and end the loop."""
+    for idx in batch_indices:
+        if done_event.is_set():
+            return
+        try:
+            batch = batchdataset[idx]
+            if pin_memory:
+                batch = _utils.pin_memory.pin_memory_batch(batch)
+        except Exception:
+            batch = _utils.ExceptionWrapper(where='in batch prefetch thread')
+
+        while not done_event.is_set():
+            try:
+                data_queue.put(batch, timeout=_PREFETCH_POLL_INTERVAL)
+                break
+            except queue.Full:
+                continue
+
+        if isinstance(batch, _utils.ExceptionWrapper):
+            return
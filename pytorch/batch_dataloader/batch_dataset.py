@@ -1,5 +1,12 @@
+import json
+import os
+
+import numpy as np
 import torch
 
+SHUFFLE_MODES = ('reorder', 'random', 'block')
+MEMMAP_MANIFEST = 'manifest.json'
+
 class BatchDataset(object):
     """An abstract class representing a Batch Dataset.
     All other datasets should subclass this. All subclasses should override
@@ -31,11 +38,25 @@ class TensorBatchDataset(BatchDataset):
         batch_size: The size of the batch to return
         pin_memory (bool, optional): If ``True``, the dataset will be pinned memory for faster copy to GPU.  
         I saw no performance improvement to doing so but results may vary.        
+        shuffle_mode (str, optional): how ``shuffle`` randomizes the data (default: ``'reorder'``).
+            ``'reorder'``: gather every tensor into a new random order, each batch is then a contiguous slice.
+            This briefly holds two copies of the data.
+            ``'random'``: keep the tensors in place and store a random permutation of the rows, each batch
+            is gathered through it.
+            ``'block'``: like ``'random'`` but the permutation shuffles blocks of ``block_size`` contiguous
+            rows, then the rows inside each block, so batches read from a few contiguous regions.
+        block_size (int, optional): number of contiguous rows per block for ``shuffle_mode='block'``
+            (default: ``batch_size``)
     """
-    def __init__(self, tensors, batch_size=1, pin_memory=False):
+    def __init__(self, tensors, batch_size=1, pin_memory=False, shuffle_mode='reorder', block_size=None):
         assert all(tensors[0].size(0) == tensor.size(0) for tensor in tensors)
+        assert shuffle_mode in SHUFFLE_MODES, 'shuffle_mode should be one of {}'.format(SHUFFLE_MODES)
         self.tensors = tensors      
         self.batch_size=batch_size
+        self.shuffle_mode = shuffle_mode
+        self.block_size = block_size if block_size is not None else batch_size
+        # row order of the current epoch when shuffling through a permutation, None means storage order
+        self.permutation = None
         
         self.num_samples = tensors[0].size(0)
         
@@ -53,11 +74,17 @@ class TensorBatchDataset(BatchDataset):
         idx = item*self.batch_size
         #Need to handle odd sized batches if data isn't divisible by batchsize
         if idx < self.num_samples and (idx + self.batch_size < self.num_samples or self.num_samples%self.batch_size == 0):
-            return [tensor[idx:idx+self.batch_size] for tensor in self.tensors]
+            return self._get_rows(idx, idx+self.batch_size)
         elif idx < self.num_samples and idx + self.batch_size> self.num_samples :
-            return [tensor[idx:] for tensor in self.tensors]
+            return self._get_rows(idx, self.num_samples)
         else:
             raise IndexError
+
+    def _get_rows(self, start, end):
+        if self.permutation is None:
+            return [tensor[start:end] for tensor in self.tensors]
+        rows = self.permutation[start:end]
+        return [tensor[rows] for tensor in self.tensors]
         
     def __add__(self, tensors):
         assert all(tensors[0].size(0) == tensor.size(0) for tensor in tensors)
@@ -67,7 +94,271 @@ class TensorBatchDataset(BatchDataset):
         num_add_samples = tensors[0].size(0)
         self.num_samples = self.num_samples + num_add_samples
         self.tensors  = [torch.cat((self_tensor, tensor)) for self_tensor, tensor in zip(self.tensors, tensors)]
+        self.permutation = None
     
     def shuffle(self):
-        idx = torch.randperm(self.num_samples, dtype=torch.int64)
-        self.tensors = [tensor[idx] for tensor in self.tensors]
+        if self.shuffle_mode == 'reorder':
+            idx = torch.randperm(self.num_samples, dtype=torch.int64)
+            self.tensors = [tensor[idx] for tensor in self.tensors]
+        else:
+            block_size = self.block_size if self.shuffle_mode == 'block' else 1
+            self.permutation = block_permutation(self.num_samples, block_size, device=self.tensors[0].device)
+
+
+def block_permutation(num_samples, block_size, device=None):
+    """Returns a permutation of ``range(num_samples)`` that visits blocks of ``block_size``
+    contiguous rows in random order and the rows inside each block in random order.
+    ``block_size=1`` gives a uniformly random permutation."""
+    if block_size <= 1:
+        return torch.randperm(num_samples, dtype=torch.int64, device=device)
+    num_blocks = (num_samples + block_size - 1) // block_size
+    block_start = torch.randperm(num_blocks, dtype=torch.int64, device=device) * block_size
+    offset = torch.rand(num_blocks, block_size, device=device).argsort(dim=1)
+    idx = (block_start.unsqueeze(1) + offset).view(-1)
+    # the last block may be partial: drop the positions past the end of the data
+    return idx[idx < num_samples]
+
+
+class MemmapTensorBatchDataset(BatchDataset):
+    """Batch Dataset reading tensors from fixed-dtype ``.npy`` files on disk through ``numpy`` memory maps,
+    for datasets that do not fit in memory. Only the rows of the current batch are read, so the operating
+    system page cache rather than the process holds the data.
+    The directory is written by ``save_memmap_tensors`` or ``parquet_to_memmap``: one ``.npy`` file per tensor
+    plus a ``manifest.json`` listing them in order.
+    Arguments:
+        path (str): directory holding the manifest and the ``.npy`` files.
+        batch_size: The size of the batch to return
+        shuffle_mode (str, optional): ``'block'`` or ``'random'``, see ``TensorBatchDataset``. The files are
+            read-only so ``'reorder'`` is not available. ``'block'`` keeps each batch to a few contiguous
+            regions of the files. (default: ``'block'``)
+        block_size (int, optional): number of contiguous rows per block for ``shuffle_mode='block'``
+            (default: ``batch_size``)
+    When shuffled, the rows of each batch are read in file order, so the order of the rows within a
+    batch follows the files rather than the permutation.
+    """
+    def __init__(self, path, batch_size=1, shuffle_mode='block', block_size=None):
+        assert shuffle_mode in ('random', 'block'), "shuffle_mode should be 'random' or 'block'"
+        with open(os.path.join(path, MEMMAP_MANIFEST)) as f:
+            manifest = json.load(f)
+        self.path = path
+        self.names = [entry['name'] for entry in manifest['tensors']]
+        self.arrays = [np.load(os.path.join(path, entry['file']), mmap_mode='r') for entry in manifest['tensors']]
+        assert all(self.arrays[0].shape[0] == array.shape[0] for array in self.arrays)
+        self.batch_size = batch_size
+        self.shuffle_mode = shuffle_mode
+        self.block_size = block_size if block_size is not None else batch_size
+        self.permutation = None
+
+        self.num_samples = self.arrays[0].shape[0]
+
+    def __len__(self):
+        if self.num_samples%self.batch_size == 0:
+            return self.num_samples // self.batch_size
+        else:
+            return self.num_samples // self.batch_size + 1
+
+    def __getitem__(self, item):
+        idx = item*self.batch_size
+        if idx < self.num_samples:
+            return self._get_rows(idx, min(idx+self.batch_size, self.num_samples))
+        else:
+            raise IndexError
+
+    def _get_rows(self, start, end):
+        if self.permutation is None:
+            return [torch.from_numpy(np.array(array[start:end])) for array in self.arrays]
+        rows = np.sort(self.permutation[start:end])
+        return [torch.from_numpy(array[rows]) for array in self.arrays]
+
+    def shuffle(self):
+        block_size = self.block_size if self.shuffle_mode == 'block' else 1
+        self.permutation = block_permutation(self.num_samples, block_size).numpy()
+
+
+class ParquetBatchDataset(BatchDataset):
+    """Batch Dataset streaming a directory of parquet files one row group at a time, for datasets
+    that do not fit in memory. Memory stays bounded by ``shuffle_buffer_size`` plus one row group
+    and one batch, whatever the size of the dataset.
+    When shuffled, each epoch visits the files in random order and the row groups of each file in
+    random order, and mixes the rows through a shuffle buffer: every row group read is appended to the
+    buffer, the buffer is permuted and batches are emitted from it while it holds more than
+    ``shuffle_buffer_size`` rows. This works best on files that were shuffled when written.
+    Batches can only be read in order, starting from ``0``, as ``BatchDataLoader`` does. Reading
+    batch ``0`` (or calling ``shuffle``) restarts the stream.
+    Arguments:
+        path (str or list of str): directory of ``*.parquet`` files, or a list of files.
+        columns (dict): maps each output tensor name to a column name, which gives a 1-d tensor, or to
+            a list of column names, which gives a ``batch_size x len(columns)`` tensor. Batches are
+            returned as a list of tensors in the dict order, as with ``TensorBatchDataset``.
+        batch_size: The size of the batch to return
+        dtypes (dict, optional): numpy dtype per tensor name (default: ``float32``)
+        shuffle_buffer_size (int, optional): number of rows kept back to mix row groups together.
+            ``0`` only shuffles within each row group. (default: ``10 * batch_size``)
+        engine (str, optional): ``'pyarrow'`` reads row groups on the CPU. ``'cudf'`` reads them with
+            cuDF and hands them to torch through dlpack, which returns CUDA tensors. (default: ``'pyarrow'``)
+        seed (int, optional): seed of the shuffling random generator.
+    """
+    def __init__(self, path, columns, batch_size=1, dtypes=None, shuffle_buffer_size=None, engine='pyarrow', seed=None):
+        assert engine in ('pyarrow', 'cudf'), "engine should be 'pyarrow' or 'cudf'"
+        import pyarrow.parquet as pq
+
+        if isinstance(path, str):
+            self.files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.parquet'))
+        else:
+            self.files = list(path)
+        self.columns = dict((name, [cols] if isinstance(cols, str) else list(cols)) for name, cols in columns.items())
+        self.is_vector = dict((name, isinstance(cols, str)) for name, cols in columns.items())
+        self.dtypes = dict((name, np.dtype((dtypes or {}).get(name, 'float32'))) for name in self.columns)
+        self.batch_size = batch_size
+        self.shuffle_buffer_size = shuffle_buffer_size if shuffle_buffer_size is not None else 10 * batch_size
+        self.engine = engine
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+
+        metadata = [pq.ParquetFile(file).metadata for file in self.files]
+        self.num_row_groups = [m.num_row_groups for m in metadata]
+        self.num_samples = sum(m.num_rows for m in metadata)
+
+        self._batches = None
+        self._next_item = None
+
+    def __len__(self):
+        if self.num_samples%self.batch_size == 0:
+            return self.num_samples // self.batch_size
+        else:
+            return self.num_samples // self.batch_size + 1
+
+    def __getitem__(self, item):
+        if item == 0 and self._next_item != 0:
+            self._start_epoch(shuffle=False)
+        if item >= len(self):
+            raise IndexError
+        if item != self._next_item:
+            raise RuntimeError('ParquetBatchDataset is streamed: expected batch {} but got {}'.format(self._next_item, item))
+        self._next_item += 1
+        return next(self._batches)
+
+    def shuffle(self):
+        self._start_epoch(shuffle=True)
+
+    def _start_epoch(self, shuffle):
+        self._batches = self._iter_batches(shuffle)
+        self._next_item = 0
+
+    def _randperm(self, n):
+        return torch.randperm(n, generator=self.generator).tolist()
+
+    def _iter_batches(self, shuffle):
+        file_order = self._randperm(len(self.files)) if shuffle else range(len(self.files))
+        buffer_size = self.shuffle_buffer_size if shuffle else 0
+        buffer = None
+        for f in file_order:
+            row_group_order = self._randperm(self.num_row_groups[f]) if shuffle else range(self.num_row_groups[f])
+            for row_group in self._read_row_groups(self.files[f], row_group_order):
+                buffer = row_group if buffer is None else [torch.cat((b, r)) for b, r in zip(buffer, row_group)]
+                if shuffle:
+                    buffer = self._permute(buffer)
+                while buffer[0].size(0) >= buffer_size + self.batch_size:
+                    yield [b[:self.batch_size] for b in buffer]
+                    buffer = [b[self.batch_size:] for b in buffer]
+        if buffer is not None:
+            while buffer[0].size(0) > 0:
+                yield [b[:self.batch_size] for b in buffer]
+                buffer = [b[self.batch_size:] for b in buffer]
+
+    def _permute(self, tensors):
+        idx = torch.randperm(tensors[0].size(0), generator=self.generator).to(tensors[0].device)
+        return [tensor[idx] for tensor in tensors]
+
+    def _read_row_groups(self, file, row_groups):
+        """Yields each of ``row_groups`` of ``file`` as a list of tensors in ``self.columns`` order."""
+        source_columns = [col for cols in self.columns.values() for col in cols]
+        if self.engine == 'pyarrow':
+            import pyarrow.parquet as pq
+            parquet_file = pq.ParquetFile(file)
+            for row_group in row_groups:
+                table = parquet_file.read_row_group(row_group, columns=source_columns)
+                tensors = []
+                for name, cols in self.columns.items():
+                    array = np.empty((table.num_rows, len(cols)), dtype=self.dtypes[name])
+                    for i, col in enumerate(cols):
+                        array[:, i] = table.column(col).to_numpy()
+                    tensors.append(torch.from_numpy(array[:, 0] if self.is_vector[name] else array))
+                yield tensors
+        else:
+            import cudf
+            from torch.utils.dlpack import from_dlpack
+            for row_group in row_groups:
+                gdf = cudf.read_parquet(file, columns=source_columns, row_groups=[row_group])
+                tensors = []
+                for name, cols in self.columns.items():
+                    tensor = from_dlpack(gdf[cols].astype(self.dtypes[name]).to_dlpack())
+                    tensors.append(tensor.view(-1) if self.is_vector[name] else tensor.view(len(gdf), -1))
+                yield tensors
+
+
+def save_memmap_tensors(tensors, path, names=None):
+    """Writes ``tensors`` as one ``.npy`` file each plus a manifest into ``path``, in the layout read by
+    ``MemmapTensorBatchDataset``."""
+    assert all(tensors[0].size(0) == tensor.size(0) for tensor in tensors)
+    names = names if names is not None else ['tensor_%d' % i for i in range(len(tensors))]
+    os.makedirs(path, exist_ok=True)
+    for name, tensor in zip(names, tensors):
+        np.save(os.path.join(path, name + '.npy'), tensor.cpu().numpy())
+    _write_memmap_manifest(path, names, [tensor.size(0) for tensor in tensors][0])
+
+
+def parquet_to_memmap(files, path, columns, dtypes=None, read_batch_size=65536):
+    """Converts parquet files into the layout read by ``MemmapTensorBatchDataset`` without loading them
+    in memory: the ``.npy`` files are preallocated and filled one record batch at a time.
+    Arguments:
+        files (list of str): parquet files, concatenated in the given order.
+        path (str): output directory.
+        columns (dict): maps each output tensor name to a column name, which gives a 1-d tensor, or to
+            a list of column names, which gives a ``num_rows x len(columns)`` tensor. Tensors are written
+            in the dict order, e.g. ``{'cats': cat_names, 'conts': cont_names, 'label': 'target'}``.
+        dtypes (dict, optional): numpy dtype per tensor name (default: ``float32``)
+        read_batch_size (int, optional): rows read from parquet at a time.
+    Requires ``pyarrow``.
+    """
+    import pyarrow.parquet as pq
+
+    dtypes = dtypes if dtypes is not None else {}
+    names = list(columns)
+    source_columns = []
+    for name in names:
+        source_columns += [columns[name]] if isinstance(columns[name], str) else list(columns[name])
+
+    num_samples = sum(pq.ParquetFile(file).metadata.num_rows for file in files)
+    os.makedirs(path, exist_ok=True)
+    arrays = {}
+    for name in names:
+        shape = (num_samples,) if isinstance(columns[name], str) else (num_samples, len(columns[name]))
+        arrays[name] = np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+',
+                                                 dtype=np.dtype(dtypes.get(name, 'float32')), shape=shape)
+
+    start = 0
+    for file in files:
+        for record_batch in pq.ParquetFile(file).iter_batches(batch_size=read_batch_size, columns=source_columns):
+            end = start + record_batch.num_rows
+            for name in names:
+                cols = [columns[name]] if isinstance(columns[name], str) else columns[name]
+                for i, col in enumerate(cols):
+                    values = record_batch.column(record_batch.schema.get_field_index(col)).to_numpy(zero_copy_only=False)
+                    if arrays[name].ndim == 1:
+                        arrays[name][start:end] = values
+                    else:
+                        arrays[name][start:end, i] = values
+            start = end
+
+    for array in arrays.values():
+        array.flush()
+    _write_memmap_manifest(path, names, num_samples)
+
+
+def _write_memmap_manifest(path, names, num_samples):
+    manifest = {'num_samples': int(num_samples),
+                'tensors': [{'name': name, 'file': name + '.npy'} for name in names]}
+    with open(os.path.join(path, MEMMAP_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
@@ -0,0 +1,106 @@
+"""Scaling benchmark for data parallel training with a sharded BatchDataLoader.
+
+Spawns 1 to ``--max_procs`` processes on the local machine, joined in a ``gloo`` process
+group, each training a small MLP wrapped in ``DistributedDataParallel`` on its shard of a
+synthetic tabular dataset. For every world size it reports the epoch time, the total
+throughput and the speedup over a single process, and checks that the shards cover the
+dataset with the expected number of duplicated rows (none with ``--drop_last``).
+
+    python benchmark_distributed.py --max_procs 8 --num_samples 1000000 --batch_size 4096
+"""
+import argparse
+import os
+import socket
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+from batch_dataset import TensorBatchDataset
+from batch_dataloader import BatchDataLoader
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='BatchDataLoader data parallel scaling benchmark')
+    parser.add_argument('--max_procs', type=int, default=8, help='largest number of processes to run')
+    parser.add_argument('--num_samples', type=int, default=500000, help='rows of the synthetic dataset')
+    parser.add_argument('--num_features', type=int, default=32, help='continuous features per row')
+    parser.add_argument('--batch_size', type=int, default=4096, help='batch size of each process')
+    parser.add_argument('--epochs', type=int, default=3, help='timed epochs, after one warm up epoch')
+    parser.add_argument('--threads', type=int, default=1, help='torch intra-op threads per process')
+    parser.add_argument('--shuffle_mode', type=str, default='random', help="'reorder', 'random' or 'block'")
+    parser.add_argument('--drop_last', default=False, action='store_true', help='drop uneven tail batches')
+    return parser
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run_worker(rank, world_size, port, args, results):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(args.threads)
+
+    # every rank builds the same data, only the sharding differs
+    generator = torch.Generator().manual_seed(0)
+    row_id = torch.arange(args.num_samples)
+    x = torch.randn(args.num_samples, args.num_features, generator=generator)
+    y = x[:, :4].sum(dim=1, keepdim=True)
+    dataset = TensorBatchDataset([row_id, x, y], batch_size=args.batch_size, shuffle_mode=args.shuffle_mode)
+    loader = BatchDataLoader(dataset, shuffle=True, drop_last=args.drop_last)
+
+    model = nn.parallel.DistributedDataParallel(nn.Sequential(
+        nn.Linear(args.num_features, 256), nn.ReLU(), nn.Linear(256, 256), nn.ReLU(), nn.Linear(256, 1)))
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3)
+    loss_func = nn.MSELoss()
+
+    seen = torch.zeros(args.num_samples, dtype=torch.int32)
+    epoch_times = []
+    for epoch in range(args.epochs + 1):
+        dist.barrier()
+        start = time.perf_counter()
+        for rows, xb, yb in loader:
+            if epoch == 0:
+                seen[rows] += 1
+            optimizer.zero_grad()
+            loss = loss_func(model(xb), yb)
+            loss.backward()
+            optimizer.step()
+        dist.barrier()
+        if epoch > 0:
+            epoch_times.append(time.perf_counter() - start)
+
+    dist.all_reduce(seen)
+    if rank == 0:
+        results.put({'world_size': world_size,
+                     'batches_per_rank': len(loader),
+                     'epoch_time': sum(epoch_times) / len(epoch_times),
+                     'missing': int((seen == 0).sum()),
+                     'duplicated': int((seen - 1).clamp(min=0).sum())})
+    dist.destroy_process_group()
+
+
+def main(args):
+    context = mp.get_context('spawn')
+    results = context.SimpleQueue()
+    print('| procs | batches/rank | epoch (s) | rows/s     | speedup | missing | duplicated |')
+    print('|-------|--------------|-----------|------------|---------|---------|------------|')
+    baseline = None
+    for world_size in range(1, args.max_procs + 1):
+        mp.spawn(run_worker, args=(world_size, free_port(), args, results), nprocs=world_size, join=True)
+        result = results.get()
+        rows_per_second = args.num_samples / result['epoch_time']
+        baseline = baseline or rows_per_second
+        print('| %5d | %12d | %9.3f | %10.0f | %6.2fx | %7d | %10d |' % (
+            world_size, result['batches_per_rank'], result['epoch_time'], rows_per_second,
+            rows_per_second / baseline, result['missing'], result['duplicated']))
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())